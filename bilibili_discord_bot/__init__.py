@@ -5,13 +5,30 @@ import sys
 import os
 import logging
 import json
+import re
+import time
 import click
+from concurrent.futures import ProcessPoolExecutor
 
 from discord.ext import commands
 # the command control
 from .bot import Music
 # for database
 from .db import VideoDatabase
+# for download connection caps
+from .bilibili_api import set_connection_limits, set_dash_api_url
+from .download_scheduler import get_download_scheduler
+# for the page parser benchmark
+from .bilibili_api import parse_initial_state, extract_initial_state
+# for verifying and repairing the cache
+from .cache_verify import verify_video
+from .bilibili_data import VideoSegmentInfo, video_dir, segments_to_json
+from .common import size2str, str2size
+from .bilibili_downloader import BilibiliVideo
+from .session import SessionManager
+from .db import AsyncVideoDatabase
+from .cache_manager import CacheManager
+from .executors import get_executors, set_executor_limits
 
 logger = logging.getLogger(__name__)
 
@@ -54,10 +71,18 @@ def main(ctx):
 
 @main.command('run')
 def run():
-    req_keys = ['token', 'file_path']
+    req_keys = ['token', 'file_path', 'db', 'download_connections', 'max_connections',
+                'prefetch_count', 'prefetch_rate', 'gapless', 'opus_cache', 'cache_budget', 'cache_policy',
+                'api_rate', 'quality', 'dash_api', 'download_rate', 'playback_workers', 'cpu_workers', 'io_workers']
     config = get_config(req_keys)
     token = config.get('token')
     file_path = config.get('file_path')
+    set_connection_limits(config.get('download_connections'),
+                          config.get('max_connections'))
+    set_dash_api_url(config.get('dash_api'))
+    set_executor_limits(config.get('cpu_workers'), config.get('io_workers'))
+    if config.get('download_rate'):
+        get_download_scheduler().set_rate(str2size(config.get('download_rate')))
 
     if token is None:
         exit('Token is not configured.')
@@ -67,7 +92,25 @@ def run():
 
     bot = commands.Bot(command_prefix=commands.when_mentioned_or('\''),
                        description='The bilibili playlist')
-    bot.add_cog(Music(bot, file_path=file_path))
+    music = Music(bot, file_path=file_path, db_path=config.get('db'),
+                  prefetch_count=config.get('prefetch_count'),
+                  prefetch_rate=config.get('prefetch_rate'),
+                  gapless=config.get('gapless'),
+                  opus_cache=config.get('opus_cache'),
+                  cache_budget=config.get('cache_budget'),
+                  cache_policy=config.get('cache_policy'),
+                  api_rate=config.get('api_rate'),
+                  quality=config.get('quality'),
+                  playback_workers=config.get('playback_workers'))
+    bot.add_cog(music)
+
+    # release the cog resources before the loop is closed on logout
+    bot_close = bot.close
+
+    async def close():
+        await music.close()
+        await bot_close()
+    bot.close = close
 
     @bot.event
     async def on_ready():
@@ -92,6 +135,125 @@ def init_db_command():
     db_path = db_path if db_path is not None else 'bot.sqlite'
     db = VideoDatabase(db_path)
     db.init_db()
-    click.echo('Initialized the database.')
+    click.echo('Database is at schema version %d.' % db.version())
+    db.close()
+
+@main.command('bench-parse')
+@click.argument('pages', nargs=-1, type=click.Path(exists=True))
+@click.option('--rounds', default=10, help='Parse each page this many times.')
+def bench_parse_command(pages, rounds):
+    '''Compare the streaming extractor with BeautifulSoup on saved pages'''
+    for page in pages:
+        with open(page, 'rb') as f:
+            html = f.read()
+        text = html.decode('utf-8', errors='replace')
+        start = time.perf_counter()
+        for _ in range(rounds):
+            expected = parse_initial_state(text)
+        soup_time = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            data = extract_initial_state(html)
+        stream_time = (time.perf_counter() - start) / rounds
+        status = 'ok' if data == expected else 'MISMATCH'
+        click.echo('%s: bs4 %.2fms stream %.2fms speedup %.1fx %s' %
+                   (page, soup_time * 1000, stream_time * 1000,
+                    soup_time / max(stream_time, 1e-9), status))
+
+def video_name(aid, page):
+    return 'av%d' % aid if page == 1 else 'av%d p%d' % (aid, page)
+
+async def repair_videos(broken, file_path, db_path):
+    sessions = SessionManager()
+    db = AsyncVideoDatabase(db_path)
+    try:
+        for (aid, page), orders in sorted(broken.items()):
+            name = video_name(aid, page)
+            video = BilibiliVideo('av%d?p=%d' % (aid, page), session=sessions.get(), db=db, file_path=file_path)
+            try:
+                msgs = await video.repair_segments(orders)
+                click.echo('%s: repaired %s' % (name, ', '.join(msgs)))
+            except Exception as e:
+                logger.exception('repair %s failed' % name)
+                click.echo('%s: repair failed: %s' % (name, e))
+    finally:
+        await sessions.close()
+        db.close()
+        get_executors().shutdown()
+
+@main.command('verify-cache')
+@click.option('--workers', default=None, type=int, help='Number of verifying processes.')
+@click.option('--repair/--no-repair', default=True, help='Download the broken segments again.')
+def verify_cache_command(workers, repair):
+    '''Check size and checksum of every cached segment'''
+    config = get_config(['file_path', 'db'])
+    file_path = config.get('file_path')
+    db_path = config.get('db')
+    db_path = db_path if db_path is not None else 'bot.sqlite'
+    if file_path is None:
+        exit('File path is not configured.')
+
+    db = VideoDatabase(db_path)
+    videos = dict(((row['aid'], row['page']), row['segmentinfo']) for row in db.get_cached_videos())
+    aids = set(aid for aid, page in videos)
+    for name in sorted(os.listdir(file_path)):
+        match = re.fullmatch(r'av(\d+)', name)
+        if match is not None and int(match.group(1)) not in aids:
+            click.echo('%s: not in the database' % name)
+
+    broken = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = dict((key, pool.submit(verify_video, video_dir(file_path, *key), seg_json))
+                       for key, seg_json in videos.items())
+        for key, future in sorted(futures.items()):
+            good = {}
+            for order, error, checksum in future.result():
+                if error is not None:
+                    click.echo('%s: segment %d %s' % (video_name(*key), order, error))
+                    broken.setdefault(key, []).append(order)
+                else:
+                    good[order] = checksum
+            # remember the checksums of segments cached before they were recorded
+            segments = VideoSegmentInfo.from_json(videos[key])
+            missing = [segment for segment in segments if segment.checksum is None and segment.order in good]
+            for segment in missing:
+                segment.checksum = good[segment.order]
+            if len(missing) > 0:
+                aid, page = key
+                db.update_segmentinfo(aid, segments_to_json(segments), page)
+    db.close()
+    click.echo('verified %d videos, %d with broken segments' % (len(videos), len(broken)))
+
+    if repair and len(broken) > 0:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(repair_videos(broken, file_path, db_path))
+
+@main.command('cache-stats')
+@click.option('--top', default=20, help='Number of videos to list.')
+def cache_stats_command(top):
+    '''Show the cached videos in eviction order'''
+    config = get_config(['db', 'cache_budget', 'cache_policy'])
+    db_path = config.get('db')
+    db_path = db_path if db_path is not None else 'bot.sqlite'
+    budget = str2size(config.get('cache_budget')) if config.get('cache_budget') else None
+    policy = config.get('cache_policy') or CacheManager.LRU
+    db = VideoDatabase(db_path)
+    rows = [row for row in db.get_cache_entries() if row['size'] > 0]
+    db.close()
+    if policy == CacheManager.LFU:
+        rows.sort(key=lambda row: (row['play_count'], row['last_played']))
+    else:
+        rows.sort(key=lambda row: row['last_played'])
+    total = sum(row['size'] for row in rows)
+    pinned = sum(row['size'] for row in rows if row['pinned'])
+    click.echo('%d videos, %s cached (%s pinned), budget %s, policy %s' %
+               (len(rows), size2str(total), size2str(pinned),
+                size2str(budget) if budget is not None else 'unlimited', policy))
+    for row in rows[:top]:
+        last_played = time.strftime('%Y-%m-%d %H:%M', time.localtime(row['last_played'])) \
+            if row['last_played'] else 'never'
+        click.echo('av%-12d %10s %5d plays  last %s%s' %
+                   (row['aid'], size2str(row['size']), row['play_count'], last_played,
+                    '  pinned' if row['pinned'] else ''))
 
 __all__ = ['main']
@@ -1,12 +1,23 @@
 import io
+import os
 import aiohttp
 import asyncio
 import re
+import time
+import random
 import hashlib
+import collections
+import codecs
 from bs4 import BeautifulSoup
 
 from .bilibili_data import *
 from .buffered_writer import FileWriter
+from .download_journal import SegmentJournal
+from .cache_verify import verify_segment
+from .quality import QN_AUDIO, QN_480P, get_throughput_history
+from .download_scheduler import ARCHIVE, connection, get_download_scheduler
+from .executors import run_cpu, run_io, run_pipe
+from .simple_ffmpeg import INTERACTIVE
 
 _bilibili_url = 'https://www.bilibili.com'
 _user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.117 Safari/537.36'
@@ -54,6 +65,110 @@ def parse_initial_state(html):
     return None
 
 
+class InitialStateExtractor:
+    '''Find the __INITIAL_STATE__ JSON while the video page streams in
+
+    Bytes are fed as they arrive. Once the marker is seen the braces of the
+    JSON object are matched (ignoring those inside strings) and feed returns
+    True as soon as the object is complete, so the rest of the page does not
+    have to be read at all.
+    '''
+    _marker = 'window.__INITIAL_STATE__='
+    _outside = re.compile(r'[{}"]')
+    _inside = re.compile(r'["\\]')
+
+    def __init__(self, encoding='utf-8'):
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._tail = ''
+        self._parts = []
+        self._found = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+    def feed(self, data):
+        '''Feed the next bytes of the page, return True once the JSON is complete
+        '''
+        if self.done:
+            return True
+        text = self._decoder.decode(data)
+        if not self._found:
+            text = self._tail + text
+            idx = text.find(self._marker)
+            if idx < 0:
+                # keep enough to find a marker split between chunks
+                self._tail = text[-len(self._marker):]
+                return False
+            self._found = True
+            self._tail = ''
+            text = text[idx + len(self._marker):]
+        end = self._scan(text)
+        if end < 0:
+            self._parts.append(text)
+            return False
+        self._parts.append(text[:end])
+        self.done = True
+        return True
+
+    def _scan(self, text):
+        '''Return the index just after the closing brace, or -1
+        '''
+        pos = 0
+        if self._escape and len(text) > 0:
+            self._escape = False
+            pos = 1
+        while True:
+            if self._in_string:
+                match = self._inside.search(text, pos)
+                if match is None:
+                    return -1
+                pos = match.end()
+                if match.group() == '"':
+                    self._in_string = False
+                elif pos < len(text):
+                    # skip the escaped character
+                    pos += 1
+                else:
+                    self._escape = True
+                    return -1
+            else:
+                match = self._outside.search(text, pos)
+                if match is None:
+                    return -1
+                pos = match.end()
+                c = match.group()
+                if c == '"':
+                    self._in_string = True
+                elif c == '{':
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        return pos
+
+    def get_data(self):
+        '''The parsed JSON, None if it was not found or is not valid
+        '''
+        if not self.done:
+            return None
+        try:
+            return json.loads(''.join(self._parts))
+        except ValueError:
+            logger.exception('streamed initial state is not valid JSON')
+            return None
+
+
+def extract_initial_state(html, block_size=32 * 4096):
+    '''Run InitialStateExtractor over a whole page given as bytes
+    '''
+    extractor = InitialStateExtractor()
+    for idx in range(0, len(html), block_size):
+        if extractor.feed(html[idx:idx + block_size]):
+            break
+    return extractor.get_data()
+
+
 class VideoPlayUrl:
     def __init__(self, url, aid, cid, qn):
         self.url = url
@@ -106,76 +221,554 @@ class VideoPlayUrlV2(VideoPlayUrl):
             return data
 
 
-class VideoSegmentDownloader:
-    _block_size = 32 * 4096
+# endpoint of the DASH playurl api, a local server can stand in for it
+_dash_api_url = 'https://api.bilibili.com/x/player/playurl'
+
+
+def set_dash_api_url(url=None):
+    '''Point the DASH playurl requests to url, the bilibili api when None
+    '''
+    global _dash_api_url
+    _dash_api_url = url if url is not None else 'https://api.bilibili.com/x/player/playurl'
+
+
+class VideoPlayUrlDash(VideoPlayUrl):
+    '''Audio only stream of the DASH playurl api
+
+    The response is turned into the durl form of VideoPlayUrlV2 holding a
+    single m4a segment, so the cache and the players handle it like any
+    other segment. get_data returns None when no audio stream is served.
+    '''
+    _fnval = 16
+
+    async def get_data(self, session: aiohttp.ClientSession):
+        params = {
+            'avid': str(self.aid),
+            'cid': str(self.cid),
+            'qn': str(self.qn),
+            'fnval': str(self._fnval),
+            'fnver': '0',
+        }
+        async with session.get(_dash_api_url, params=params, headers=self._app_headers) as resp:
+            logger.info(params)
+            status = resp.status
+            result = await resp.json()
+        data = result.get('data') or {}
+        audios = (data.get('dash') or {}).get('audio') or []
+        if result.get('code') != 0 or len(audios) == 0:
+            logger.warning('no dash audio for av%d: %s' % (self.aid, result.get('message')))
+            return None
+        # the best audio, it is a small part of the video anyway
+        audio = max(audios, key=lambda stream: stream.get('bandwidth', 0))
+        url = audio.get('baseUrl') or audio.get('base_url')
+        length = data.get('timelength') or int(data['dash'].get('duration', 0) * 1000)
+        durl = {
+            'order': 1,
+            'url': url,
+            'length': length,
+            'size': await self._get_size(session, url),
+            'backup_url': audio.get('backupUrl') or audio.get('backup_url') or [],
+        }
+        return {'quality': QN_AUDIO, 'format': 'm4a', 'timelength': length, 'durl': [durl]}
+
+    async def _get_size(self, session, url):
+        '''Size of the stream from the Content-Range of its first byte, 0
+        when the CDN does not tell
+        '''
+        headers = dict(self._app_headers)
+        headers['Range'] = 'bytes=0-0'
+        try:
+            async with session.get(url, headers=headers) as resp:
+                match = re.search(r'/(\d+)$', resp.headers.get('Content-Range', ''))
+                if match is not None:
+                    return int(match.group(1))
+                if resp.status == 200 and resp.content_length is not None:
+                    return resp.content_length
+        except aiohttp.ClientError:
+            logger.exception('size request failed for %s' % url)
+        return 0
+
+
+class RangeNotSupported(Exception):
+    '''Exception for CDN servers that ignore the Range header
+    '''
+    pass
+
+
+class DownloadStalled(IOError):
+    '''The CDN sent less than the throughput floor for a whole window
+    '''
+    pass
+
 
-    def __init__(self, url: str, session: aiohttp.ClientSession, segment: VideoSegmentInfo, loop=None):
+class BadStatus(IOError):
+    '''The CDN answered with a status that carries no video
+    '''
+    pass
+
+
+class ConnectionTruncated(IOError):
+    '''The CDN closed the response before the requested range was sent
+    '''
+    pass
+
+
+class DownloadCounters:
+    '''Counts of the download failures and recoveries of the process
+    '''
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def count(self, event):
+        self.counts[event] += 1
+
+    def __str__(self):
+        if len(self.counts) == 0:
+            return 'download events: none'
+        return 'download events: ' + ', '.join('%s %d' % item for item in sorted(self.counts.items()))
+
+
+_counters = None
+
+
+def get_download_counters():
+    '''The process wide DownloadCounters
+    '''
+    global _counters
+    if _counters is None:
+        _counters = DownloadCounters()
+    return _counters
+
+
+# connection cap of one video in the concurrent download mode
+_video_connections = 4
+
+
+def set_connection_limits(video_connections=None, global_connections=None):
+    '''Configure the per video and the process wide CDN connection caps
+    '''
+    global _video_connections
+    if video_connections is not None:
+        _video_connections = max(1, int(video_connections))
+    if global_connections is not None:
+        get_download_scheduler().max_connections = max(1, int(global_connections))
+
+
+class CdnReader:
+    '''Read bytes of a segment from the CDN, surviving stalls and failures
+
+    A read that takes longer than _read_timeout or a window of _stall_window
+    seconds below _min_speed counts as a stall. Stalls, dropped connections,
+    short responses and bad statuses are retried with a Range request from
+    the byte reached, switching to the next of the backup urls, after a
+    jittered exponential backoff. Time spent waiting for the bandwidth or
+    the consumer never counts against the CDN.
+    '''
+    _block_size = 32 * 4096
+    _read_timeout = 15
+    _stall_window = 5
+    _min_speed = 16 * 1024
+    _max_retries = 5
+    _backoff_base = 0.5
+    _backoff_max = 8
+
+    def __init__(self, url: str, session: aiohttp.ClientSession, segment: VideoSegmentInfo, loop=None,
+                 *, limiter=None, task=None):
+        '''limiter is an optional RateLimiter capping the bandwidth used,
+        task the DownloadTask the connection and the bytes are scheduled for
+        '''
         self.url = url
         self.session = session
         self.segment = segment
         self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.limiter = limiter
+        self.task = task
 
-    async def download(self, file, dup_f=None):
-        '''file can be blocked and dup_f cannot be blocked
-        '''
-        logger.info('start download for %s, %s' % (self.url, str(self.segment)))
-        video_url = self.segment.url
-        headers = {
-            'Range': 'byte=0-',
+    def _urls(self):
+        return [self.segment.url] + list(self.segment.backup_url)
+
+    def _headers(self, start, end):
+        return {
+            'Range': 'bytes=%d-%s' % (start, end if end is not None else ''),
             'Origin': _bilibili_url,
             'User-Agent': _user_agent,
             'Referer': self.url,
             'Connection': 'keep-alive',
         }
-        # keep track the byte and time of download
-        file_info = FileDownloadInfo(self.segment.size)
-        file_info.start()
-        #f = FileWriter(file)
-        # f is a file-like object and it can be blocked
-        f = file
-        async with self.session.get(video_url, headers=headers) as resp:
+
+    def _backoff(self, attempt):
+        delay = min(self._backoff_max, self._backoff_base * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _throttle(self, length, file_info):
+        start = time.time()
+        if self.limiter is not None:
+            await self.limiter.acquire(length)
+        if self.task is not None:
+            await self.task.transfer(length)
+        file_info.wait(time.time() - start)
+
+    async def _transfer(self, start, end, consume, file_info):
+        '''Read bytes [start, end], or to the end of the segment when end is
+        None, awaiting consume(data, position) for every block. Returns the
+        position reached.
+
+        Only failures of the CDN are retried, an error raised by consume,
+        such as a full disk, is raised at once.
+        '''
+        counters = get_download_counters()
+        urls = self._urls()
+        current = 0
+        position = start
+        attempt = 0
+
+        async def track(data, offset):
+            # a retry starts after the last byte consumed
+            nonlocal position
+            await consume(data, offset)
+            position = offset + len(data)
+
+        while True:
+            try:
+                await self._read(urls[current], position, end, track, file_info)
+                last = end if end is not None else (self.segment.size or 0) - 1
+                if position <= last:
+                    raise ConnectionTruncated('connection closed at %d of %d for %s' %
+                                              (position, last + 1, urls[current]))
+                return position
+            except DownloadStalled as e:
+                counters.count('stalls')
+                error = e
+            except asyncio.TimeoutError as e:
+                counters.count('timeouts')
+                error = e
+            except BadStatus as e:
+                counters.count('bad_status')
+                error = e
+            except aiohttp.ClientError as e:
+                counters.count('connection_errors')
+                error = e
+            except ConnectionTruncated as e:
+                counters.count('truncated')
+                error = e
+            attempt += 1
+            if attempt > self._max_retries:
+                counters.count('given_up')
+                logger.error('giving up %s after %d attempts' % (str(self.segment), attempt))
+                raise error
+            counters.count('retries')
+            if len(urls) > 1:
+                current = (current + 1) % len(urls)
+                counters.count('failovers')
+            delay = self._backoff(attempt)
+            logger.warning('download of %s failed at %d (%s: %s), retry %d in %.1fs from %s' %
+                           (str(self.segment), position, type(error).__name__, error, attempt, delay,
+                            urls[current]))
+            await asyncio.sleep(delay)
+
+    async def _read(self, video_url, position, end, consume, file_info):
+        async with connection(self.task), self.session.get(video_url, headers=self._headers(position, end)) as resp:
             status = resp.status
+            if status not in (200, 206):
+                raise BadStatus('status %d for %s' % (status, video_url))
+            if status == 200 and end is not None:
+                raise RangeNotSupported('range request returned status %d for %s' % (status, video_url))
+            # the server ignored the range, drop the bytes we already have
+            skip = position if status == 200 else 0
+            if skip > 0:
+                logger.warning('range ignored by server, skipping %d bytes' % skip)
+            window_start = time.time()
+            window_waited = file_info.waited
+            window_bytes = 0
             while True:
-                data = await resp.content.read(self._block_size)
+                data = await asyncio.wait_for(resp.content.read(self._block_size), self._read_timeout)
                 data_len = len(data)
                 file_info.log(data_len)
                 if file_info.is_timeout() or data_len == 0:
                     logger.info('downloading: %s' % file_info.get_status())
                 if data_len == 0:
                     break
-                await self.loop.run_in_executor(None, f.write, data)
-                if dup_f is not None:
-                    dup_f.write(data)
-
+                window_bytes += data_len
+                elapsed = time.time() - window_start - (file_info.waited - window_waited)
+                if elapsed >= self._stall_window:
+                    if window_bytes / elapsed < self._min_speed:
+                        raise DownloadStalled('%s sent %d bytes in %.1fs' % (video_url, window_bytes, elapsed))
+                    window_start = time.time()
+                    window_waited = file_info.waited
+                    window_bytes = 0
+                await self._throttle(data_len, file_info)
+                if skip > 0:
+                    data, skip = data[skip:], max(0, skip - data_len)
+                    if len(data) == 0:
+                        continue
+                # a slow consumer must not count as a slow host
+                consume_start = time.time()
+                await consume(data, position)
+                file_info.wait(time.time() - consume_start)
+                position += len(data)
+
+
+class VideoSegmentDownloader(CdnReader):
+    async def _fetch(self, offset, consume):
+        '''Request the segment from offset and await consume(data, position)
+        for every block received, return where the download stopped and the
+        FileDownloadInfo of the transfer
+        '''
+        logger.info('start download for %s, %s from %d' % (self.url, str(self.segment), offset))
+        # keep track the byte and time of download
+        file_info = FileDownloadInfo(self.segment.size - offset)
+        file_info.start()
+        position = await self._transfer(offset, None, consume, file_info)
         file_info.end()
+        get_throughput_history().record(self.segment.url, file_info.current, file_info.throughput())
+        return position, file_info
+
+    def _check_size(self, position, file_info):
+        if self.segment.size and position != self.segment.size:
+            raise IOError('segment size mismatch %d != %d for %s' %
+                          (position, self.segment.size, self.segment.url))
         msg = 'average speed: %s' % file_info.avg_speed()
         logger.info(msg)
         return msg
 
+    async def download(self, file, dup_f=None, *, offset=0):
+        '''file can be blocked and dup_f cannot be blocked
+
+        With offset the download continues from that byte with a Range
+        request.
+        '''
+        async def consume(data, position):
+            await run_pipe(file.write, data)
+            if dup_f is not None:
+                dup_f.write(data)
+
+        position, file_info = await self._fetch(offset, consume)
+        return self._check_size(position, file_info)
+
+    async def save(self, writer, *, offset=0):
+        '''Download from offset into a FileWriter positioned at offset
+        '''
+        async def consume(data, position):
+            writer.write(data)
+            await writer.drain()
+
+        position, file_info = await self._fetch(offset, consume)
+        return self._check_size(position, file_info)
+
+    async def stream(self, buffer, *, offset=0):
+        '''Download into a FanoutBuffer and close it, with the error if any
+
+        Never blocks on a consumer itself, the buffer decides when the
+        download has to wait for its readers.
+        '''
+        async def consume(data, position):
+            await buffer.write(data)
+
+        try:
+            position, file_info = await self._fetch(offset, consume)
+            msg = self._check_size(position, file_info)
+        except asyncio.CancelledError:
+            buffer.close(IOError('download of %s cancelled' % self.segment.url))
+            raise
+        except Exception as e:
+            buffer.close(e)
+            raise
+        buffer.close()
+        return msg
+
+
+def split_ranges(size, chunk_size):
+    '''Split [0, size) into inclusive (start, end) byte ranges
+    '''
+    return [(start, min(start + chunk_size, size) - 1)
+            for start in range(0, size, chunk_size)]
+
+
+class VideoRangeDownloader(CdnReader):
+    '''Download one byte range of a segment into a preallocated file through
+    a FileWriter
+    '''
+
+    async def download(self, writer, start, end, file_info=None):
+        async def consume(data, position):
+            writer.write_at(data, position)
+            await writer.drain()
+            if file_info is not None:
+                file_info.log(len(data))
+                if file_info.is_timeout():
+                    logger.info('downloading: %s' % file_info.get_status())
+
+        # throughput of this connection alone
+        range_info = FileDownloadInfo(end - start + 1)
+        range_info.start()
+        position = await self._transfer(start, end, consume, range_info)
+        range_info.end()
+        get_throughput_history().record(self.segment.url, range_info.current, range_info.throughput())
+        return position - start
+
 
 class VideoDownloader:
-    def __init__(self, url: str, session: aiohttp.ClientSession, segments):
+    '''Download all segments of a video
+
+    In concurrent mode several segments are fetched at once and every segment
+    is split into HTTP Range chunks written in place into a preallocated file.
+    The number of connections is capped per video, the DownloadScheduler
+    shares the connections and the bandwidth of the process.
+    '''
+    _chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, url: str, session: aiohttp.ClientSession, segments, *,
+                 concurrent=False, connections=None, chunk_size=None, loop=None, limiter=None, task=None,
+                 priority=None):
+        '''task is the DownloadTask to schedule the download as, without it
+        the download registers an archive task of its own. priority orders
+        its file operations in the executors
+        '''
         self.url = url
         self.session = session
         self.segments = segments
+        self.limiter = limiter
+        self.task = task
+        self.priority = priority if priority is not None else INTERACTIVE
+        self.concurrent = concurrent
+        self.connections = connections if connections is not None else _video_connections
+        self.chunk_size = chunk_size if chunk_size is not None else self._chunk_size
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
 
     async def download(self, file_path):
+        if self.task is None:
+            total = sum(segment.size or 0 for segment in self.segments)
+            self.task = get_download_scheduler().task(self.url, ARCHIVE, total=total)
+            return await self.task.run(self._download(file_path))
+        return await self._download(file_path)
+
+    async def _download(self, file_path):
+        if self.concurrent:
+            return await self._download_concurrent(file_path)
+
         msgs = []
         for segment in self.segments:
-            downloader = VideoSegmentDownloader(
-                self.url, self.session, segment)
-            file_name = segment.file_name
-            full_path = path.join(file_path, file_name)
-            with open(full_path, 'wb') as f:
-                msgs.append(await downloader.download(f))
+            full_path = path.join(file_path, segment.file_name)
+            msgs.append(await self._download_locked(segment, full_path))
 
         return msgs
 
+    async def _download_concurrent(self, file_path):
+        video_semaphore = asyncio.Semaphore(self.connections)
+        tasks = [self._download_locked(segment, path.join(file_path, segment.file_name), video_semaphore)
+                 for segment in self.segments]
+        return await asyncio.gather(*tasks)
+
+    async def _download_locked(self, segment, full_path, video_semaphore=None):
+        '''Download a segment while holding its journal, so any other writer
+        of the same file waits and then resumes from what this one wrote
+        '''
+        journal = await SegmentJournal.acquire(full_path, segment.size, priority=self.priority)
+        try:
+            if journal.is_complete():
+                logger.info('segment already downloaded: %s' % str(journal))
+                msg = 'resumed: complete'
+            elif video_semaphore is None:
+                msg = await self._download_whole(segment, full_path, journal)
+            else:
+                msg = await self._download_segment(segment, full_path, journal, video_semaphore)
+            await self._verify(segment, full_path)
+            return msg
+        finally:
+            journal.release()
+
+    async def _verify(self, segment, full_path):
+        '''Check the size of a downloaded segment and record its checksum
+        '''
+        error, checksum = await run_io(verify_segment, full_path, segment.size, priority=self.priority)
+        if error is not None:
+            raise IOError('verify %s failed: %s' % (full_path, error))
+        segment.checksum = checksum
+
+    async def _download_segment(self, segment, full_path, journal, video_semaphore):
+        if not segment.size:
+            # without a known size the segment cannot be split
+            async with video_semaphore:
+                return await self._download_whole(segment, full_path, journal)
+
+        logger.info('start concurrent download for %s, %s' % (self.url, str(journal)))
+        missing = journal.missing()
+        file_info = FileDownloadInfo(sum(end - start + 1 for start, end in missing))
+        file_info.start()
+        downloader = VideoRangeDownloader(self.url, self.session, segment, self.loop,
+                                          limiter=self.limiter, task=self.task)
+
+        async def download_range(writer, start, end):
+            async with video_semaphore:
+                length = await downloader.download(writer, start, end, file_info)
+            if length != end - start + 1:
+                raise IOError('incomplete range %d-%d (%d bytes) for %s' %
+                              (start, end, length, segment.url))
+
+        ranges = []
+        for start, end in missing:
+            ranges.extend((start + r_start, start + r_end)
+                          for r_start, r_end in split_ranges(end - start + 1, self.chunk_size))
+        # the writer journals every chunk once it is on disk
+        writer = await run_io(lambda: FileWriter(
+            full_path, size=segment.size, journal=journal, fsync=True, loop=self.loop), priority=self.priority)
+        try:
+            # probe with the first range before opening more connections
+            await download_range(writer, *ranges[0])
+            tasks = [asyncio.ensure_future(download_range(writer, start, end))
+                     for start, end in ranges[1:]]
+            try:
+                await asyncio.gather(*tasks)
+            except:
+                # make sure no range is still writing before the writer is closed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        except RangeNotSupported:
+            logger.warning('range not supported, fall back to single connection for %s' % str(segment))
+            fallback = True
+        else:
+            fallback = False
+        finally:
+            await run_io(writer.close, priority=self.priority)
+
+        if fallback:
+            async with video_semaphore:
+                return await self._download_whole(segment, full_path, journal)
+
+        file_info.end()
+        msg = 'average speed: %s' % file_info.avg_speed()
+        logger.info(msg)
+        return msg
+
+    async def _download_whole(self, segment, full_path, journal):
+        offset = journal.prefix()
+        downloader = VideoSegmentDownloader(
+            self.url, self.session, segment, self.loop, limiter=self.limiter, task=self.task)
+        writer = await run_io(lambda: FileWriter(
+            full_path, size=segment.size, offset=offset, journal=journal, fsync=True, loop=self.loop),
+            priority=self.priority)
+        try:
+            return await downloader.save(writer, offset=offset)
+        finally:
+            await run_io(writer.close, priority=self.priority)
+
 
 class Video:
     _bilibili_video_url = 'https://www.bilibili.com/video/'
+    _block_size = 16 * 4096
 
-    def __init__(self, url: str, session: aiohttp.ClientSession):
+    _qn = 80
+
+    def __init__(self, url: str, session: aiohttp.ClientSession, cache=None, *, limiter=None, quality=None,
+                 priority=None):
+        '''cache is an optional MetadataCache shared between Video objects,
+        limiter an optional RateLimiter for the playurl requests and quality
+        an optional QualitySelector choosing the qn. priority orders its jobs
+        in the executors, BACKGROUND for bulk imports
+        '''
         logger.info('create Video object with url: %s' % url)
         match = re.search(r'av(\d+)', url)
         if match is None:
@@ -190,9 +783,27 @@ class Video:
         # remake the url to avoid miss paste
         self.url = self._bilibili_video_url + self.name
         self.session = session
+        self.cache = cache
+        self.limiter = limiter
+        self.quality = quality
+        self.priority = priority if priority is not None else INTERACTIVE
         self.web_data = None
         self.page_data = None
 
+    def page(self, pnum):
+        '''The Video of page pnum, sharing the page data already fetched
+        '''
+        video = Video('%s?p=%d' % (self.url, pnum), self.session, self.cache, limiter=self.limiter,
+                      quality=self.quality, priority=self.priority)
+        video.web_data = self.web_data
+        return video
+
+    async def get_pages(self):
+        '''All pages of the video, each with its cid and part title
+        '''
+        video_data = await self.get_video_data()
+        return video_data['pages']
+
     async def get_web(self):
         headers = {
             'User-Agent': _user_agent
@@ -201,12 +812,50 @@ class Video:
             status = resp.status
             return await resp.text()
 
+    async def get_web_initial_state(self):
+        '''Stream the page and stop reading once the initial state is complete
+
+        Falls back to parse_initial_state over the whole page when the
+        streamed JSON cannot be found or parsed.
+        '''
+        headers = {
+            'User-Agent': _user_agent
+        }
+        extractor = InitialStateExtractor()
+        chunks = []
+        data = None
+        async with self.session.get(self.url, headers=headers) as resp:
+            status = resp.status
+            while True:
+                block = await resp.content.read(self._block_size)
+                if len(block) == 0:
+                    break
+                chunks.append(block)
+                if not extractor.done and extractor.feed(block):
+                    data = extractor.get_data()
+                    if data is not None:
+                        break
+            charset = resp.charset or 'utf-8'
+
+        if data is not None:
+            logger.info('streamed initial state after %d bytes for %s' %
+                        (sum(map(len, chunks)), self.name))
+            return data
+        logger.warning('streaming extractor failed, parsing whole page for %s' % self.name)
+        html = b''.join(chunks).decode(charset, errors='replace')
+        return await run_cpu(parse_initial_state, html, priority=self.priority)
+
     async def get_web_data(self):
         if self.web_data is not None:
             return self.web_data
-        html = await self.get_web()
-        loop = asyncio.get_event_loop()
-        self.web_data = await loop.run_in_executor(None, parse_initial_state, html)
+        if self.cache is not None:
+            self.web_data = await self.cache.get_web_data(self.aid)
+            if self.web_data is not None:
+                logger.info('web data cache hit for: %s' % self.name)
+                return self.web_data
+        self.web_data = await self.get_web_initial_state()
+        if self.cache is not None and self.web_data is not None:
+            await self.cache.put_web_data(self.aid, self.web_data)
         return self.web_data
 
     async def get_video_data(self):
@@ -214,19 +863,65 @@ class Video:
         web_data = await self.get_web_data()
         return web_data['videoData']
 
+    async def get_page_data(self):
+        if self.page_data is None:
+            pages = await self.get_pages()
+            if self.pnum > len(pages):
+                raise NotBilibiliVideo('%s has no page %d.' % (self.name, self.pnum))
+            self.page_data = pages[self.pnum - 1]
+        return self.page_data
+
     async def get_cid(self):
-        video_data = await self.get_video_data()
-        pages = video_data['pages']
-        self.page_data = pages[self.pnum - 1]
-        return self.page_data['cid']
+        page_data = await self.get_page_data()
+        return page_data['cid']
 
-    async def get_segment_info(self, qn=80):
+    async def get_playurl(self, qn):
+        '''Playurl response in the durl form, QN_AUDIO asks for the audio only
+        DASH stream and gets None when there is none
+        '''
+        data = None
+        if self.cache is not None:
+            data = await self.cache.get_playurl(self.aid, self.pnum, qn)
+        if data is None:
+            cid = await self.get_cid()
+            if self.limiter is not None:
+                await self.limiter.acquire(1)
+            if qn == QN_AUDIO:
+                player = VideoPlayUrlDash(self.url, self.aid, cid, QN_480P)
+            else:
+                player = VideoPlayUrlV2(self.url, self.aid, cid, qn)
+            data = await player.get_data(self.session)
+            if self.cache is not None and data is not None and 'durl' in data:
+                await self.cache.put_playurl(self.aid, self.pnum, qn, data)
+        else:
+            logger.info('playurl cache hit for: %s' % self.name)
+        return data
+
+    async def get_segment_info(self, qn=None):
+        '''Segments of the page in quality qn, chosen by the QualitySelector
+        when not given
+        '''
         logger.info('get segments info for: %s' % self.name)
-        cid = await self.get_cid()
-        player = VideoPlayUrlV2(self.url, self.aid, cid, qn)
-        data = await player.get_data(self.session)
+        selected = qn is None and self.quality is not None
+        if qn is None:
+            qn = self.quality.pick() if selected else self._qn
+        data = None
+        if qn == QN_AUDIO:
+            try:
+                data = await self.get_playurl(QN_AUDIO)
+            except (aiohttp.ClientError, ValueError):
+                logger.exception('dash playurl failed for %s' % self.name)
+            if data is None:
+                qn = self.quality.fallback() if self.quality is not None else QN_480P
+                logger.warning('falling back to flv qn %d for %s' % (qn, self.name))
+        if data is None:
+            data = await self.get_playurl(qn)
+            lower = self.quality.adjust(data) if selected else None
+            if lower is not None:
+                data = await self.get_playurl(lower)
         durls = data['durl']
         format = data['format']
-        results = [VideoSegmentInfo(durl, format) for durl in durls]
+        qn = data.get('quality', qn)
+        results = [VideoSegmentInfo(durl, format, qn) for durl in durls]
         logger.info('segments results %s' % str(results))
         return results
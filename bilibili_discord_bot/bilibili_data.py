@@ -2,16 +2,36 @@ from os import path
 import json
 from .common import *
 
+def video_dir(file_path, aid, page=1):
+    '''Cache directory of one page of a video, pages after the first live
+    inside the directory of the first so a video is evicted as a whole
+    '''
+    video_path = path.join(file_path, 'av%d' % aid)
+    if page == 1:
+        return video_path
+    return path.join(video_path, 'p%d' % page)
+
+
+def segments_to_json(segments):
+    '''JSON of a list of VideoSegmentInfo, as recorded in the database,
+    run in the CPU pool of the executors by the async callers
+    '''
+    return json.dumps(segments, default=obj_dict)
+
+
 class VideoInfo:
     _file_name = 'videoinfo.json'
 
-    def __init__(self, url=None, video_data=None):
+    def __init__(self, url=None, video_data=None, page_data=None):
+        '''page_data is given for the pages of a multi part video
+        '''
         self.url = ''
         self.title = ''
         self.upload_time = ''
         self.description = ''
         self.duration = 0
         self.uploader = ''
+        self.part = ''
 
         if url is not None:
             self.url = url
@@ -23,17 +43,27 @@ class VideoInfo:
             self.duration = video_data['duration']
             self.uploader = video_data['owner']['name']
 
+        if page_data is not None:
+            self.part = page_data.get('part', '')
+            self.duration = page_data.get('duration', self.duration)
+
     def to_json(self):
         return json.dumps(self, default=obj_dict)
 
     @staticmethod
     def from_json(str):
         vi = VideoInfo()
-        vi.__dict__ = json.loads(str)
+        vi.__dict__.update(json.loads(str))
         return vi
 
+    @property
+    def full_title(self):
+        if self.part:
+            return '%s - %s' % (self.title, self.part)
+        return self.title
+
     def __str__(self):
-        fmt = 'title: {0.title} uploader: {0.uploader} \ndescription: {0.description}'
+        fmt = 'title: {0.full_title} uploader: {0.uploader} \ndescription: {0.description}'
         return fmt.format(self)
 
     def __repr__(self):
@@ -43,10 +73,14 @@ class VideoInfo:
 class VideoSegmentInfo:
     _flv = 'flv'
     _mp4 = 'mp4'
+    # audio only DASH stream
+    _m4a = 'm4a'
 
-    def __init__(self, durl, format: str):
+    def __init__(self, durl, format: str, qn=None):
         if format.find(self._flv) >= 0:
             self.format = self._flv
+        elif format.find(self._m4a) >= 0:
+            self.format = self._m4a
         else:
             self.format = self._mp4
 
@@ -54,6 +88,12 @@ class VideoSegmentInfo:
         self.length = durl['length']
         self.size = durl['size']
         self.order = durl['order']
+        # mirrors of url on other CDN nodes
+        self.backup_url = durl.get('backup_url') or []
+        # md5 of the cached file, set once the download is verified
+        self.checksum = durl.get('checksum')
+        # quality the segment was served in
+        self.qn = qn if qn is not None else durl.get('qn')
 
     @property
     def file_name(self):
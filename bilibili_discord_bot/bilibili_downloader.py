@@ -6,8 +6,8 @@ import re
 import os
 import io
 import logging
+import time
 from os import path
-import logging
 from bs4 import BeautifulSoup
 # for bilibili player classes
 from .player import *
@@ -17,8 +17,17 @@ from .simple_ffmpeg import *
 from .buffered_writer import FileWriter
 # for bilibili video api
 from .bilibili_api import Video, VideoDownloader
-# for database
-from .db import VideoDatabase
+# for the pre transcoded audio
+from .opus_player import OPUS_FILE_NAME
+# for sharing concurrent work on the same video
+from .single_flight import default_flights
+from .priority_slots import PrioritySlots
+# for checking the cached segments
+from .cache_verify import segments_on_disk, remove_segment
+# for sharing the connections and the bandwidth
+from .download_scheduler import ARCHIVE, PREFETCH, get_download_scheduler
+# for the CPU bound steps and the file operations
+from .executors import run_cpu, run_io
 
 logger = logging.getLogger(__name__)
 
@@ -26,85 +35,293 @@ _bilibili_url = 'https://www.bilibili.com'
 _user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.117 Safari/537.36'
 
 
+# background transcodes run one at a time
+_transcode_slots = None
+# the opus transcodes in progress by flight key
+_transcodes = {}
+
+
+def _get_transcode_slots():
+    global _transcode_slots
+    if _transcode_slots is None:
+        _transcode_slots = PrioritySlots(1)
+    return _transcode_slots
+
+
+class _Transcode:
+    '''Priority of an opus transcode in progress, raised when a more urgent
+    caller joins it
+    '''
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.runner = None
+
+    def promote(self, priority):
+        if priority >= self.priority:
+            return
+        self.priority = priority
+        _get_transcode_slots().promote(self, priority)
+        if self.runner is not None:
+            self.runner.promote(priority)
+
+
 class BilibiliVideo:
-    def __init__(self, url, *, file_path=None, loop=None, db=None):
+    def __init__(self, url, *, session, db, file_path=None, loop=None, cache=None, opus_cache=False,
+                 flights=None, cache_manager=None, video=None, api_limiter=None, quality=None, guild=None,
+                 workers=None):
+        '''session is the shared aiohttp.ClientSession used for every request,
+        db the shared AsyncVideoDatabase and cache the shared MetadataCache.
+        With opus_cache the segments are
+        transcoded to Opus in the background once they are all downloaded.
+        Concurrent work on the same page is shared through the SingleFlight
+        flights. cache_manager, a CacheManager, is told about plays and
+        about files added to the cache. video is a Video of url already
+        holding the page data, api_limiter a RateLimiter for playurl requests
+        and quality the QualitySelector choosing the qn. Downloads are
+        scheduled for the guild that asked for them, its players decode in
+        the PlaybackWorkers workers when given.
+        '''
         logger.info('create BilibiliVideo object with url: %s' % url)
-        self.session = aiohttp.ClientSession()
-        self.video = Video(url, self.session)
+        self.opus_cache = opus_cache
+        self.session = session
+        self.video = video if video is not None else Video(url, self.session, cache, limiter=api_limiter,
+                                                           quality=quality)
         self.url = self.video.url
         self.name = self.video.name
+        self.page = self.video.pnum
         self.path = None
         self.loop = loop if loop is not None else asyncio.get_event_loop()
-        self.db = db if db is not None else VideoDatabase()
+        self.db = db
+        self.flights = flights if flights is not None else default_flights
+        self.cache_manager = cache_manager
+        self.guild = guild
+        self.workers = workers
+        self.priority = self.video.priority
         if file_path is not None:
-            self.path = path.join(file_path, self.name)
+            self.path = video_dir(file_path, self.video.aid, self.page)
             if not path.exists(self.path):
                 os.makedirs(self.path)
 
-    def _is_downloaded(self):
+    @property
+    def aid(self):
+        return self.video.aid
+
+    async def played(self):
+        '''Record a play of the video for cache eviction
+        '''
+        if self.cache_manager is not None and self.path is not None:
+            await self.cache_manager.played(self.video.aid)
+
+    def _stored(self):
+        if self.cache_manager is not None and self.path is not None:
+            self.loop.create_task(self.cache_manager.stored(self.video.aid))
+
+    async def _is_downloaded(self):
+        '''The segments are recorded in the database and their files are on
+        disk with the recorded sizes
+        '''
         if self.path is None:
             return False
-        data = self.db.get_video(self.video.aid)
-        if data is not None:
-            return data['segmentinfo'] is not None and len(data['segmentinfo']) > 0
+        data = await self.db.get_video(self.video.aid, self.page)
+        if data is None or data['segmentinfo'] is None or len(data['segmentinfo']) == 0:
+            return False
+        segments = VideoSegmentInfo.from_json(data['segmentinfo'])
+        if await run_io(segments_on_disk, self.path, segments, priority=self.priority):
+            return True
+        logger.warning('cached segments of %s are missing or truncated' % self.name)
         return False
 
-    def _read_segments(self):
+    async def _read_segments(self):
         if self.path is None:
             return None
         logger.info('loading segments for %s' % self.name)
-        seg_json = self.db.get_video(self.video.aid)['segmentinfo']
+        seg_json = (await self.db.get_video(self.video.aid, self.page))['segmentinfo']
         return VideoSegmentInfo.from_json(seg_json)
 
-    def _write_segments(self, segments):
-        if self.path is None:
-            return
-        logger.info('saving segments for %s' % self.name)
-        seg_json = json.dumps(segments, default=obj_dict)
-        self.db.update_segmentinfo(self.video.aid, seg_json)
+    def _flight_key(self, kind):
+        return (kind, self.video.aid, self.video.pnum)
+
+    async def download_segments(self, *, concurrent=True, limiter=None, klass=ARCHIVE):
+        '''Download all segments into the cache, or wait for the download of
+        this page that is already running
+
+        Prefetching passes concurrent=False, a RateLimiter and the PREFETCH
+        class so it does not compete with the track that is playing. The
+        class is part of the flight key: a prefetch joins a download of the
+        page in another class, while any other download cancels a running
+        prefetch and starts over without its throttling. The journals keep
+        the bytes the prefetch already downloaded.
+        '''
+        page_key = self._flight_key('download')
+        key = page_key + (klass,)
+        if klass == PREFETCH:
+            for running in self.flights.keys():
+                if running[:len(page_key)] == page_key:
+                    key = running
+                    break
+        else:
+            await self.flights.cancel(page_key + (PREFETCH,))
+        return await self.flights.do(key, self._download_segments,
+                                     concurrent=concurrent, limiter=limiter, klass=klass)
 
-    async def download_segments(self):
+    def _download_task(self, segments, klass):
+        total = sum(segment.size or 0 for segment in segments)
+        return get_download_scheduler().task(self.name, klass, guild=self.guild, total=total)
+
+    async def _download_segments(self, *, concurrent, limiter, klass):
         logger.info('start download: %s' % self.name)
         if self.path is None:
             return
-        if self._is_downloaded():
-            segments = self._read_segments()
+        if await self._is_downloaded():
+            segments = await self._read_segments()
             file_name = 'local: ' + ', '.join(map(str, segments))
             return file_name
 
-        self.db.insert_video(self.video.aid)
-        video_data = await self.video.get_video_data()
-        video_info = VideoInfo(self.url, video_data)
-        if self.path is not None:
-            self.db.insert_video(self.video.aid)
-            self.db.update_videoinfo(self.video.aid, video_info.to_json())
-
+        video_info = await self._get_video_info()
         logger.info('video info: %s, %s' % (self.name, str(video_info)))
         segments = await self.video.get_segment_info()
-        downloader = VideoDownloader(self.url, self.session, segments)
-        msgs = await downloader.download(self.path)
-        self._write_segments(segments)
+        task = self._download_task(segments, klass)
+        downloader = VideoDownloader(self.url, self.session, segments,
+                                     concurrent=concurrent, loop=self.loop, limiter=limiter, task=task,
+                                     priority=self.priority)
+        msgs = await task.run(downloader.download(self.path))
+        logger.info('saving segments for %s' % self.name)
+        seg_json = segments_to_json(segments)
+        # the row, its info and its segments are committed together
+        await self.db.save_video(self.video.aid, video_info.to_json(), seg_json, self.page)
+        self._stored()
+        # a prefetched track is next in a queue, its transcode goes before the background ones
+        self._schedule_transcode(INTERACTIVE if klass == PREFETCH else BACKGROUND)
         return 'online: ' + ', '.join(msgs)
 
-    async def get_player(self, voice, loop, *, after=None):
+    async def repair_segments(self, orders):
+        '''Download again the cached segments with the given orders
+
+        The other segments are kept unless the video is now served in
+        different segments, then all of them are downloaded again.
+        '''
+        logger.info('repairing segments %s of %s' % (orders, self.name))
+        stored = await self._read_segments()
+        # ask for the quality the cached segments were downloaded in
+        segments = await self.video.get_segment_info(stored[0].qn if len(stored) > 0 else None)
+        sizes = dict((segment.order, segment.size) for segment in stored)
+        if len(stored) != len(segments) or any(sizes.get(segment.order) != segment.size
+                                               for segment in segments if segment.order not in orders):
+            logger.warning('segments of %s changed, downloading all of them' % self.name)
+            orders = [segment.order for segment in segments]
+        broken = [segment for segment in segments if segment.order in orders]
+
+        def remove():
+            for segment in broken:
+                remove_segment(path.join(self.path, segment.file_name))
+            opus_file = path.join(self.path, OPUS_FILE_NAME)
+            if path.exists(opus_file):
+                os.remove(opus_file)
+        await run_io(remove, priority=self.priority)
+
+        downloader = VideoDownloader(self.url, self.session, broken, concurrent=True, loop=self.loop,
+                                     priority=self.priority)
+        msgs = await downloader.download(self.path)
+        by_order = dict((segment.order, segment) for segment in stored if segment.order not in orders)
+        by_order.update((segment.order, segment) for segment in broken)
+        seg_json = segments_to_json([by_order[order] for order in sorted(by_order)])
+        await self.db.update_segmentinfo(self.video.aid, seg_json, self.page)
+        self._stored()
+        self._schedule_transcode()
+        return msgs
+
+    def _schedule_transcode(self, priority=BACKGROUND):
+        if self.opus_cache and self.path is not None:
+            self.loop.create_task(self.transcode_opus(priority=priority))
+
+    async def transcode_opus(self, *, priority=BACKGROUND):
+        '''Transcode the cached segments once into an Ogg/Opus file that the
+        local player sends without running ffmpeg
+
+        A transcode above BACKGROUND priority skips the line of background
+        transcodes, so a prefetched track is ready to be sent without ffmpeg
+        when its turn comes. Joining a transcode in progress raises it to
+        the priority of the caller, in that line and in the ffmpeg
+        scheduler.
+        '''
+        if self.path is None or not await self._is_downloaded():
+            return
+        opus_file = path.join(self.path, OPUS_FILE_NAME)
+        if path.exists(opus_file):
+            return
+        key = self._flight_key('opus')
+        if self.flights.get(key) is None:
+            _transcodes[key] = _Transcode(priority)
+        transcode = _transcodes[key]
+        transcode.promote(priority)
+        try:
+            await self.flights.do(key, self._transcode_opus, opus_file, transcode)
+        finally:
+            if self.flights.get(key) is None and _transcodes.get(key) is transcode:
+                del _transcodes[key]
+
+    async def _transcode_opus(self, opus_file, transcode):
+        segments = await self._read_segments()
+        if transcode.priority == BACKGROUND:
+            slots = _get_transcode_slots()
+            await slots.acquire(BACKGROUND, ticket=transcode)
+            try:
+                await self._run_transcode(segments, opus_file, transcode)
+            finally:
+                slots.release()
+        else:
+            await self._run_transcode(segments, opus_file, transcode)
+        self._stored()
+
+    async def _run_transcode(self, segments, opus_file, transcode):
+        if path.exists(opus_file):
+            return
+        logger.info('transcoding %s to opus' % self.name)
+        input_files = [path.join(self.path, segment.file_name) for segment in segments]
+        ffmpeg = Flv2Opus(input_files, opus_file, priority=transcode.priority)
+        transcode.runner = ffmpeg
+        await ffmpeg.run()
+        logger.info('opus transcode for %s finished with %s' % (self.name, ffmpeg.returncode))
+
+    async def get_player(self, voice, loop, *, after=None, gapless=False):
         logger.info('retriving player for %s' % self.name)
-        if self._is_downloaded():
-            d = self.db.get_video(self.video.aid)
+        if await self._is_downloaded():
+            d = await self.db.get_video(self.video.aid, self.page)
             logger.info('local player for %s' % self.name)
             video_info = VideoInfo.from_json(d['videoinfo'])
-            segments = self._read_segments()
-            return BiliLocalPlayer(voice, loop, segments, after, video_info=video_info, path=self.path)
+            segments = VideoSegmentInfo.from_json(d['segmentinfo'])
+            if not path.exists(path.join(self.path, OPUS_FILE_NAME)):
+                self._schedule_transcode()
+            return BiliLocalPlayer(voice, loop, segments, after, video_info=video_info, path=self.path,
+                                   gapless=gapless, guild=self.guild, workers=self.workers)
 
         logger.info('online player for %s' % self.name)
+        video_info, segments = await self.flights.do(self._flight_key('info'), self._get_online_info)
+        return BiliOnlinePlayer(voice, loop, segments, self.url, after, video_info=video_info, path=self.path,
+                                session=self.session, gapless=gapless, cached=self._cached, db=self.db,
+                                page=self.page, guild=self.guild, workers=self.workers)
+
+    def _cached(self):
+        '''Called by the online player once it saved every segment
+        '''
+        self._stored()
+        self._schedule_transcode()
+
+    async def _get_video_info(self):
         video_data = await self.video.get_video_data()
-        video_info = VideoInfo(self.url, video_data)
+        # name the part only for videos with several pages
+        page_data = await self.video.get_page_data() if len(video_data['pages']) > 1 else None
+        return VideoInfo(self.url, video_data, page_data)
+
+    async def _get_online_info(self):
+        video_info = await self._get_video_info()
         if self.path is not None:
-            self.db.insert_video(self.video.aid)
-            self.db.update_videoinfo(self.video.aid, video_info.to_json())
+            await self.db.save_video(self.video.aid, video_info.to_json(), page=self.page)
 
         logger.info('video info: %s, %s' % (self.name, str(video_info)))
         segments = await self.video.get_segment_info()
-        return BiliOnlinePlayer(voice, loop, segments, self.url, after, video_info=video_info, path=self.path)
+        return video_info, segments
 
     async def download_title_pic(self):
         logger.info('retriving title pic for %s' % self.name)
@@ -129,81 +346,104 @@ class BilibiliVideo:
         return ''.join([c for c in filename if c not in invalid])
 
     async def download_audio(self):
-        logger.info('retriving audio file for %s' % self.name)
-        if self.path is None:
-            return "Path is not set"
-        if not self._is_downloaded():
-            await self.download_segments()
+        '''Export the audio as m4a, or wait for the export already running
+        '''
+        return await self.flights.do(self._flight_key('audio'), self._download_audio)
 
+    async def _run_ffmpeg(self, runner):
+        if await runner.run() != 0:
+            raise IOError('ffmpeg failed with %s for %s' % (runner.returncode, runner.output_file))
+        return runner.output_file
+
+    async def _prepare_cover(self):
+        '''Download the title pic and crop it square for the album art,
+        None when the title pic is not available
+        '''
         title_file = path.join(self.path, 'title.png')
         cropped_title_file = path.join(self.path, 'cropped.png')
-
-        title_f = None
-        cropped_f = None
-        # if the title pic did not download, then download it
+        data = None
         if not path.exists(title_file):
             title_f = await self.download_title_pic()
-        else:
-            title_f = open(title_file, 'rb')
+            if title_f is None:
+                return None
+            data = title_f.getvalue()
+            await run_io(save_to_file, title_file, title_f, priority=self.priority)
+        if not path.exists(cropped_title_file):
+            if data is None:
+                data = await run_io(read_file, title_file, priority=self.priority)
+            cropped = await run_cpu(square_crop_data, data, priority=self.priority)
+            await run_io(write_file, cropped_title_file, cropped, priority=self.priority)
+        return cropped_title_file
 
-        if title_f is None:
-            msg = 'fail to download title pic for %s' % self.name
-            logger.error(msg)
-            return msg
+    async def _download_audio(self):
+        '''Export all segments as one m4a
 
-        json_vi = self.db.get_video(self.video.aid)['videoinfo']
-        video_info = VideoInfo.from_json(json_vi)
-        segments = self._read_segments()
-        file_name = self.get_filename(video_info.title) + '.m4a'
+        The audio of every segment is extracted in parallel (as many at a
+        time as the ffmpeg scheduler allows) while the cover is prepared,
+        then one ffmpeg pass joins the audio losslessly and adds tags and
+        cover art. When one step fails the others are cancelled, and the
+        extracted audio is removed either way.
+        '''
+        logger.info('retriving audio file for %s' % self.name)
+        if self.path is None:
+            return "Path is not set"
+        timings = []
+        start = time.time()
+        if not await self._is_downloaded():
+            await self.download_segments()
+        timings.append(('segments', time.time() - start))
+
+        d = await self.db.get_video(self.video.aid, self.page)
+        video_info = VideoInfo.from_json(d['videoinfo'])
+        segments = VideoSegmentInfo.from_json(d['segmentinfo'])
+        file_name = self.get_filename(video_info.full_title) + '.m4a'
         file_name = path.join(self.path, file_name)
         msg = None
         if path.exists(file_name):
             msg = 'audio file existed for %s' % self.name
             logger.info(msg)
-            # return msg
-
-        # crop to square for album
-        cropped_f = io.BytesIO()
-        square_crop(title_f, cropped_f)
 
-        # used for asyncio
-        loop = asyncio.get_event_loop()
-        event = asyncio.Event()
+        start = time.time()
+        cover_task = self.loop.create_task(self._prepare_cover())
+        extracts = [ExtractAudio(path.join(self.path, segment.file_name), priority=INTERACTIVE)
+                    for segment in segments]
+        extract_tasks = [self.loop.create_task(self._run_ffmpeg(extract)) for extract in extracts]
+        try:
+            audio_files = await asyncio.gather(*extract_tasks)
+            timings.append(('extract %d segments' % len(segments), time.time() - start))
+            cover_file = await cover_task
+            if cover_file is None:
+                msg = 'fail to download title pic for %s' % self.name
+                logger.error(msg)
+                return msg
 
-        def after(): return loop.call_soon_threadsafe(event.set)
-
-        # save to disk
-        if not path.exists(title_file):
-            await loop.run_in_executor(None, save_to_file, title_file, title_f)
-            title_f.close()
-
-        if not path.exists(cropped_title_file):
-            await loop.run_in_executor(None, save_to_file, cropped_title_file, cropped_f)
-            cropped_f.close()
-
-        ffmpeg = Flv2M4a(path.join(self.path, segments[0].file_name), after)
-        ffmpeg.start()
-        await event.wait()
-        event.clear()
-
-        output_file = ffmpeg.output_file
-        # album, composer, genre, copyright, encoded_by, title, language, artist, album_artist, performer
-        # disc, publisher, tracker, encoder, lyrics}
-        metadata = {
-            'title': video_info.title,
-            'lyrics': video_info.url + '\n' + video_info.description,
-            'artist': video_info.uploader,
-            'album_artist': video_info.uploader,
-            'album': 'BILIBILI',
-        }
-        ffmpeg = M4aAddMeta(output_file, metadata, cropped_title_file, after)
-        ffmpeg.start()
-        await event.wait()
-        event.clear()
+            # album, composer, genre, copyright, encoded_by, title, language, artist, album_artist, performer
+            # disc, publisher, tracker, encoder, lyrics}
+            metadata = {
+                'title': video_info.full_title,
+                'lyrics': video_info.url + '\n' + video_info.description,
+                'artist': video_info.uploader,
+                'album_artist': video_info.uploader,
+                'album': 'BILIBILI',
+            }
+            start = time.time()
+            await self._run_ffmpeg(M4aMux(audio_files, file_name, metadata, cover_file, priority=INTERACTIVE))
+            timings.append(('mux', time.time() - start))
+        finally:
+            tasks = extract_tasks + [cover_task]
+            for task in tasks:
+                task.cancel()
+            # ffmpeg is killed before its output is removed
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await run_io(self._remove_files, [extract.output_file for extract in extracts],
+                         priority=self.priority)
 
-        output_file = ffmpeg.output_file
-        os.rename(output_file, file_name)
+        logger.info('audio export for %s: %s' % (self.name, ', '.join('%s %.2fs' % t for t in timings)))
+        self._stored()
         return file_name if msg is None else msg
 
-    def __del__(self):
-        self.loop.call_soon(self.session.close)
+    @staticmethod
+    def _remove_files(file_names):
+        for file_name in file_names:
+            if path.exists(file_name):
+                os.remove(file_name)
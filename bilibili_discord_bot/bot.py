@@ -1,18 +1,33 @@
+import re
 import asyncio
+import collections
 import logging
 import traceback
 
 from discord.ext import commands
-from .bilibili_api import NotBilibiliVideo
+from .bilibili_api import NotBilibiliVideo, Video, get_download_counters
 from .bilibili_downloader import BilibiliVideo
+from .player import BiliOnlinePlayer
+from .common import RateLimiter, str2size
+from .session import SessionManager
+from .metadata_cache import MetadataCache
+from .single_flight import SingleFlight
+from .db import AsyncVideoDatabase
+from .cache_manager import CacheManager
+from .quality import QualitySelector, get_throughput_history
+from .download_scheduler import PREFETCH, get_download_scheduler
+from .playback_workers import PlaybackWorkers
+from .executors import get_executors
+from .simple_ffmpeg import BACKGROUND
 
 logger = logging.getLogger(__name__)
 
 class VoiceEntry:
-    def __init__(self, message, player):
+    def __init__(self, message, player, video=None):
         self.requester = message.author
         self.channel = message.channel
         self.player = player
+        self.video = video
 
     def __str__(self):
         fmt = '**{0.title}** uploadered by **{0.uploader}**'
@@ -27,13 +42,46 @@ class VoiceEntry:
 
 
 class VoiceState:
-    def __init__(self, bot):
+    def __init__(self, bot, *, prefetch_count=0, limiter=None):
+        '''prefetch_count entries waiting in the queue are downloaded into the
+        cache while the current one plays, limited by the RateLimiter limiter
+        '''
         self.current = None
         self.voice = None
         self.bot = bot
         self.play_next_song = asyncio.Event()
         self.songs = asyncio.Queue()
         self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+        # entries in the queue in order, for prefetching
+        self.pending = collections.deque()
+        self.prefetch_count = prefetch_count
+        self.limiter = limiter
+        self.prefetch_next = asyncio.Event()
+        self.prefetching = {}
+        self.prefetched = set()
+        self.prefetcher = None
+        if self.prefetch_count > 0:
+            self.prefetcher = self.bot.loop.create_task(self.prefetch_task())
+
+    async def enqueue(self, entry):
+        self.pending.append(entry)
+        self.prefetch_next.set()
+        await self.songs.put(entry)
+
+    async def enqueue_all(self, entries):
+        '''Enqueue entries in order, waking the prefetcher once
+        '''
+        self.pending.extend(entries)
+        self.prefetch_next.set()
+        for entry in entries:
+            await self.songs.put(entry)
+
+    def cancel(self):
+        self.audio_player.cancel()
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        for task in self.prefetching.values():
+            task.cancel()
 
     def toggle_next(self):
         self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
@@ -53,16 +101,57 @@ class VoiceState:
         if self.is_playing():
             self.player.stop()
 
+    async def prepare(self, entry):
+        '''Stop prefetching entry and switch it to the local player once its
+        segments are all in the cache
+        '''
+        task = self.prefetching.pop(entry, None)
+        if task is not None and not task.done():
+            logger.info('stop prefetching %s' % str(entry))
+            task.cancel()
+            await asyncio.wait([task])
+        self.prefetched.discard(entry)
+        if entry.video is None or not isinstance(entry.player, BiliOnlinePlayer):
+            return
+        if await entry.video._is_downloaded():
+            logger.info('switch to local player for %s' % str(entry))
+            entry.player = await entry.video.get_player(self.voice, self.bot.loop, after=self.toggle_next,
+                                                        gapless=entry.player.gapless)
+
+    async def prefetch_task(self):
+        while True:
+            await self.prefetch_next.wait()
+            self.prefetch_next.clear()
+            for entry in list(self.pending)[:self.prefetch_count]:
+                if entry in self.prefetched or entry.video is None:
+                    continue
+                logger.info('prefetching %s' % str(entry))
+                task = self.bot.loop.create_task(
+                    entry.video.download_segments(concurrent=False, limiter=self.limiter, klass=PREFETCH))
+                self.prefetching[entry] = task
+                # a cancelled prefetch must not cancel this task
+                await asyncio.wait([task])
+                if not task.cancelled() and task.exception() is not None:
+                    logger.error('prefetch failed for %s: %s' % (str(entry), task.exception()))
+                if self.prefetching.pop(entry, None) is not None:
+                    self.prefetched.add(entry)
+
     async def audio_player_task(self):
         while True:
             try:
                 self.play_next_song.clear()
                 self.current = await self.songs.get()
+                self.pending.popleft()
+                self.prefetch_next.set()
+                await self.prepare(self.current)
+                if self.current.video is not None:
+                    await self.current.video.played()
                 await self.bot.send_message(self.current.channel, 'Now playing %s' % str(self.current))
                 await self.current.player.run()
                 await self.play_next_song.wait()
-            except CancelledError:
+            except asyncio.CancelledError:
                 logger.info('audio player task cancelled')
+                raise
             except:
                 logger.exception('audio player task failed')
 
@@ -72,24 +161,137 @@ class Music:
     Works in multiple servers at once.
     Original from discord.py. Modified for bilibili.
     """
-    def __init__(self, bot, *, file_path=None):
+    _prefetch_count = 2
+    # playurl requests per second of all commands together
+    _api_rate = 4
+    # pages resolved or downloaded at the same time by one batch command
+    _batch_concurrency = 4
+
+    def __init__(self, bot, *, file_path=None, db_path=None, prefetch_count=None, prefetch_rate=None,
+                 gapless=False, opus_cache=False, cache_budget=None, cache_policy=None, api_rate=None,
+                 quality=None, playback_workers=None):
+        '''prefetch_rate caps the bytes per second used by all prefetching,
+        gapless decodes all segments of a video with one ffmpeg process and
+        opus_cache transcodes cached videos for playback without ffmpeg.
+        cache_budget (bytes or a size like 8G) limits the cache on disk,
+        evicting by cache_policy (lru or lfu). api_rate caps the playurl
+        requests per second, quality is auto, audio or a fixed qn.
+        playback_workers processes decode and encode the audio of the
+        guilds, none runs the players in this process
+        '''
         self.bot = bot
+        self.gapless = bool(gapless)
+        self.opus_cache = bool(opus_cache)
         self.voice_state = {}
         self.path = file_path
+        self.prefetch_count = prefetch_count if prefetch_count is not None else self._prefetch_count
+        self.prefetch_limiter = RateLimiter(prefetch_rate) if prefetch_rate else None
+        if self.path is None:
+            self.prefetch_count = 0
+        self.sessions = SessionManager()
+        self.db = AsyncVideoDatabase(db_path if db_path is not None else 'bot.sqlite', loop=self.bot.loop)
+        self.metadata = MetadataCache(self.db)
+        self.flights = SingleFlight()
+        self.api_limiter = RateLimiter(api_rate if api_rate else self._api_rate)
+        self.quality = QualitySelector(quality, history=get_throughput_history())
+        self.bot.loop.create_task(self.quality.history.attach(self.db))
+        self.bot.loop.create_task(self.metadata.expire())
+        self.workers = PlaybackWorkers(playback_workers) if playback_workers else None
+        self.cache_manager = None
+        if self.path is not None:
+            budget = str2size(cache_budget) if cache_budget else None
+            self.cache_manager = CacheManager(self.db, self.path, budget=budget, policy=cache_policy,
+                                              in_use=self.videos_in_use, loop=self.bot.loop)
+            self.cache_manager.start()
 
     def __unload(self):
         for state in self.voice_state.values():
             try:
-                state.audio_player.cancel()
+                state.cancel()
                 if state.voice:
                     self.bot.loop.create_task(state.voice.disconnnect())
             except:
                 pass
+        self.bot.loop.create_task(self.close())
+
+    async def close(self):
+        '''Release the shared resources owned by the cog
+        '''
+        if self.cache_manager is not None:
+            await self.cache_manager.close()
+        if self.workers is not None:
+            await self.workers.close()
+        get_executors().shutdown(wait=False)
+        await self.sessions.close()
+        self.db.close()
+
+    def create_video(self, url, video=None, guild=None):
+        '''video is a Video of url whose page data is already fetched, guild
+        the id of the server its downloads are scheduled for
+        '''
+        return BilibiliVideo(url, session=self.sessions.get(), db=self.db, file_path=self.path,
+                             cache=self.metadata, opus_cache=self.opus_cache, flights=self.flights,
+                             cache_manager=self.cache_manager, video=video, api_limiter=self.api_limiter,
+                             quality=self.quality, guild=guild, workers=self.workers)
+
+    async def resolve_videos(self, urls, guild=None):
+        '''BilibiliVideo of every page named by the whitespace separated urls
+
+        A url with p= names that page, one without it every page of the
+        video. All pages of a video share one fetch of its page data. Their
+        jobs in the executors queue behind those of single commands.
+        '''
+        videos = []
+        for url in urls.split():
+            video = Video(url, self.sessions.get(), self.metadata, limiter=self.api_limiter,
+                          quality=self.quality, priority=BACKGROUND)
+            if re.search(r'p=(\d+)', url) is not None:
+                await video.get_page_data()
+                pnums = [video.pnum]
+            else:
+                pnums = range(1, len(await video.get_pages()) + 1)
+            for pnum in pnums:
+                page = video.page(pnum)
+                videos.append(self.create_video(page.url, video=page, guild=guild))
+        return videos
+
+    async def _run_batch(self, func, videos):
+        '''Run func on every video, _batch_concurrency at a time
+
+        Returns the results in the order of videos, exceptions included.
+        '''
+        semaphore = asyncio.Semaphore(self._batch_concurrency)
+
+        async def run(video):
+            async with semaphore:
+                return await func(video)
+        return await asyncio.gather(*[run(video) for video in videos], return_exceptions=True)
+
+    @staticmethod
+    def _batch_failures(videos, results):
+        lines = []
+        for video, result in zip(videos, results):
+            if isinstance(result, Exception):
+                logger.error('batch command failed for %s: %s' % (video.name, result))
+                lines.append('`%s p%d`: %s' % (video.name, video.page, result))
+        return lines
+
+    def videos_in_use(self):
+        '''aids of the videos queued, playing or being downloaded
+        '''
+        aids = set(key[1] for key in self.flights.keys())
+        for state in self.voice_state.values():
+            entries = list(state.pending)
+            if state.current is not None:
+                entries.append(state.current)
+            aids.update(entry.video.aid for entry in entries if entry.video is not None)
+        return aids
 
     def get_voice_state(self, server):
         state = self.voice_state.get(server.id)
         if state is None:
-            state = VoiceState(self.bot)
+            state = VoiceState(self.bot, prefetch_count=self.prefetch_count,
+                               limiter=self.prefetch_limiter)
             self.voice_state[server.id] = state
         return state
 
@@ -128,23 +330,75 @@ class Music:
                 return
 
         try:
-            video = BilibiliVideo(url, file_path=self.path)
-            player = await video.get_player(state.voice, self.bot.loop, after=state.toggle_next)
+            video = self.create_video(url, guild=ctx.message.server.id)
+            player = await video.get_player(state.voice, self.bot.loop, after=state.toggle_next,
+                                            gapless=self.gapless)
         except NotBilibiliVideo as e:
             await self.bot.edit_message(msg, str(e))
         except Exception as e:
             await self.bot.edit_message(msg, self.get_exception_msg(e))
             logger.exception('command download error' % str(e))
         else:
-            entry = VoiceEntry(ctx.message, player)
+            entry = VoiceEntry(ctx.message, player, video)
             await self.bot.edit_message(msg, 'Enqueued ' + str(entry))
-            await state.songs.put(entry)
+            await state.enqueue(entry)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def play_all(self, ctx, *, urls: str):
+        """Enqueue every page of a multi-part video or a list of urls"""
+        msg = await self.bot.send_message(ctx.message.channel, 'Querying `%s`' % urls)
+        state = self.get_voice_state(ctx.message.server)
+        if state.voice is None:
+            success = await ctx.invoke(self.summon)
+            if not success:
+                return
+
+        try:
+            videos = await self.resolve_videos(urls, ctx.message.server.id)
+        except NotBilibiliVideo as e:
+            await self.bot.edit_message(msg, str(e))
+            return
+        except Exception as e:
+            await self.bot.edit_message(msg, self.get_exception_msg(e))
+            logger.exception('command play all failed')
+            return
+
+        players = await self._run_batch(
+            lambda video: video.get_player(state.voice, self.bot.loop, after=state.toggle_next,
+                                           gapless=self.gapless),
+            videos)
+        entries = [VoiceEntry(ctx.message, player, video)
+                   for video, player in zip(videos, players) if not isinstance(player, Exception)]
+        await state.enqueue_all(entries)
+        lines = ['Enqueued %d of %d videos' % (len(entries), len(videos))]
+        lines.extend(self._batch_failures(videos, players))
+        await self.bot.edit_message(msg, '\n'.join(lines))
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def download_all(self, ctx, *, urls: str):
+        """Download every page of a multi-part video or a list of urls"""
+        msg = await self.bot.send_message(ctx.message.channel, 'Downloading `%s`' % urls)
+        try:
+            videos = await self.resolve_videos(urls, ctx.message.server.id)
+        except NotBilibiliVideo as e:
+            await self.bot.edit_message(msg, str(e))
+            return
+        except Exception as e:
+            await self.bot.edit_message(msg, self.get_exception_msg(e))
+            logger.exception('command download all failed')
+            return
+
+        results = await self._run_batch(lambda video: video.download_segments(), videos)
+        done = sum(1 for result in results if not isinstance(result, Exception))
+        lines = ['Downloaded %d of %d videos' % (done, len(videos))]
+        lines.extend(self._batch_failures(videos, results))
+        await self.bot.edit_message(msg, '\n'.join(lines))
 
     @commands.command(pass_context=True, no_pm=True)
     async def download(self, ctx, *, url: str):
         msg = await self.bot.send_message(ctx.message.channel, 'Downloading `%s`' % url)
         try:
-            video = BilibiliVideo(url, file_path=self.path)
+            video = self.create_video(url, guild=ctx.message.server.id)
             file_name = await video.download_segments()
         except NotBilibiliVideo as e:
             await self.bot.edit_message(msg, str(e))
@@ -167,9 +421,11 @@ class Music:
             msg = await self.bot.send_message(ctx.message.channel, 'Not Playing')
 
         try:
-            state.audio_player.cancel()
+            state.cancel()
             await state.voice.disconnect()
             del self.voice_state[server.id]
+            if self.workers is not None:
+                self.workers.forget(server.id)
         except Exception as e:
             logger.exception('command stop failed')
 
@@ -199,7 +455,7 @@ class Music:
     async def download_audio(self, ctx, *, url: str):
         msg = await self.bot.send_message(ctx.message.channel, 'Downloading `%s`' % url)
         try:
-            video = BilibiliVideo(url, file_path=self.path)
+            video = self.create_video(url, guild=ctx.message.server.id)
             file_name = await video.download_audio()
         except NotBilibiliVideo as e:
             await self.bot.edit_message(msg, str(e))
@@ -208,3 +464,55 @@ class Music:
             logger.exception('command download audio failed')
         else:
             await self.bot.edit_message(msg, 'Downloaded `%s`' % file_name)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def downloads(self, ctx):
+        """Show the downloads running for this server"""
+        scheduler = get_download_scheduler()
+        tasks = [task for task in scheduler.tasks.values() if task.guild == ctx.message.server.id]
+        lines = [str(scheduler), str(get_download_counters())]
+        lines.extend(str(task) for task in tasks)
+        await self.bot.send_message(ctx.message.channel, '\n'.join(lines))
+
+    @commands.command(name='quality', pass_context=True, no_pm=True)
+    async def quality_stats(self, ctx):
+        """Show the quality selection and the measured CDN throughput"""
+        lines = [str(self.quality)]
+        history = str(self.quality.history)
+        if history:
+            lines.append(history)
+        await self.bot.send_message(ctx.message.channel, '\n'.join(lines))
+
+    @commands.command(name='workers', pass_context=True, no_pm=True)
+    async def workers_stats(self, ctx):
+        """Show the playback workers and the guilds sharded to them"""
+        msg = str(self.workers) if self.workers is not None else 'Playback workers are not enabled'
+        await self.bot.send_message(ctx.message.channel, msg)
+
+    @commands.command(name='executors', pass_context=True, no_pm=True)
+    async def executors_stats(self, ctx):
+        """Show the queues and latency of the CPU and I/O executors"""
+        await self.bot.send_message(ctx.message.channel, str(get_executors()))
+
+    async def _pin(self, ctx, url, pinned):
+        if self.cache_manager is None:
+            await self.bot.send_message(ctx.message.channel, 'Cache is not enabled')
+            return
+        try:
+            video = Video(url, self.sessions.get())
+            await self.cache_manager.pin(video.aid, pinned)
+        except NotBilibiliVideo as e:
+            await self.bot.send_message(ctx.message.channel, str(e))
+        else:
+            msg = 'Pinned `%s`' if pinned else 'Unpinned `%s`'
+            await self.bot.send_message(ctx.message.channel, msg % video.name)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def pin(self, ctx, *, url: str):
+        """Keep a video in the cache"""
+        await self._pin(ctx, url, True)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def unpin(self, ctx, *, url: str):
+        """Let a pinned video be evicted again"""
+        await self._pin(ctx, url, False)
@@ -1,6 +1,9 @@
 import io
+import os
+import time
 import threading
 import queue
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -8,74 +11,233 @@ logger = logging.getLogger(__name__)
 
 def save_to_file(file_name:str, content: io.BytesIO):
     with open(file_name, 'wb') as f:
-        f.write(content.getvalue())
+        f.write(content.getbuffer())
 
 
-class FileWriter(threading.Thread):
-    '''Queue file write operations to avoid thread blocking.
+def write_at(fd, data, offset):
+    '''Write data to fd at offset without moving a shared file position
     '''
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def preallocate(fd, size):
+    '''Reserve size bytes for fd, keeping any data already in it
+
+    posix_fallocate gets the blocks allocated up front so the writes that
+    follow do not fragment the file, filesystems without it get a sparse
+    file of the right size instead.
+    '''
+    if os.fstat(fd).st_size > size:
+        os.ftruncate(fd, size)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            logger.info('posix_fallocate not supported, truncating instead')
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
 
-    _page_size = 4096
-    _default_buff_size = 32 * _page_size
 
-    def __init__(self, f, *, buff_size=_default_buff_size):
-        '''f should be a file like object that support write(bytes)
-        '''
-        if isinstance(f, str):
-            self._f = open(f, 'wb')
-        else:
-            self._f = f
+class WriteBehind:
+    '''Write engine shared by every FileWriter of the process
+
+    Chunks are queued as memoryviews with their file offset and written
+    with pwrite by a small pool of threads, so no chunk is copied and the
+    order of writes does not matter. The bytes waiting are capped: writers
+    call drain() which waits while the queue is over max_pending.
+    '''
+    _workers = 2
+    _max_pending = 16 * 1024 * 1024
+
+    def __init__(self, *, workers=None, max_pending=None):
+        self.workers = workers if workers is not None else self._workers
+        self.max_pending = max_pending if max_pending is not None else self._max_pending
         self._queue = queue.Queue()
-        self.buff_size = buff_size
-        self._is_started = False
-        self._is_stopped = False
-        self.buff = None
-        super().__init__()
-
-    def run(self):
-        self._is_started = True
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._threads = []
+        # metrics
+        self.pending_bytes = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.stalls = 0
+        self.flushes = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, writer, offset, view):
+        with self._lock:
+            self.pending_bytes += len(view)
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self._start()
+        self._queue.put((writer, offset, view, time.time()))
+
+    async def wait_space(self, loop):
+        '''Wait until the bytes queued dropped below max_pending
+        '''
+        with self._lock:
+            if self.pending_bytes <= self.max_pending:
+                return
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+            self.stalls += 1
+        await future
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def _done(self, length, latency):
+        with self._lock:
+            self.pending_bytes -= length
+            self.depth -= 1
+            self.flushes += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            # wake the writers once half of the queue is written
+            if self.pending_bytes > self.max_pending // 2:
+                return
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._wake, future)
+
+    def _run(self):
         while True:
-            b = self._queue.get()
-            if b is None:
-                break
+            writer, offset, view, queued = self._queue.get()
+            writer._write(offset, view)
+            self._done(len(view), time.time() - queued)
 
-            self._f.write(b)
-            self._queue.task_done()
+    def __str__(self):
+        fmt = 'write behind: depth {0} (max {1}), {2} bytes pending, {3} stalls, flush latency avg {4:.3f}s max {5:.3f}s'
+        average = self.total_latency / self.flushes if self.flushes > 0 else 0
+        return fmt.format(self.depth, self.max_depth, self.pending_bytes, self.stalls, average, self.max_latency)
 
-    def write(self, content):
-        if self._is_stopped:
-            return
 
-        b = None
-        if isinstance(content, io.BytesIO):
-            b = content.getvalue()
-        else:
-            b = content
+_engine = None
+
 
-        if self.buff is None:
-            self.buff = io.BytesIO()
+def get_write_behind():
+    '''The process wide WriteBehind engine
+    '''
+    global _engine
+    if _engine is None:
+        _engine = WriteBehind()
+    return _engine
 
-        if not self._is_started:
-            self.start()
 
-        #logger.info('write bytes length: %s' % len(b))
-        self.buff.write(b)
-        length = len(self.buff.getbuffer())
-        if length >= self.buff_size:
-            self._queue.put(self.buff.getvalue())
-            self.buff.close()
-            self.buff = None
+class FileWriter:
+    '''Write behind handle of one file
 
-    def stop(self):
-        self._is_stopped = True
-        if self.buff is not None:
-            self._queue.put(self.buff.getvalue())
-            self.buff.close()
-            self.buff = None
+    write() and write_at() queue the bytes and return at once, await drain()
+    after them to respect the memory cap of the engine. close() waits for
+    everything queued, optionally fsyncs and closes the file.
+    '''
 
-        self._queue.join()
-        # stop worker
-        self._queue.put(None)
+    def __init__(self, f, *, size=None, offset=0, journal=None, fsync=False, engine=None, loop=None):
+        '''f is a file name or a file object, which the writer then owns
+
+        With size the file is preallocated, without it a file name is cut
+        at offset. offset is where write() starts, journal (a SegmentJournal)
+        is told about every chunk once it is written.
+        '''
+        if isinstance(f, str):
+            self._fd = os.open(f, os.O_WRONLY | os.O_CREAT, 0o644)
+            self._f = None
+            if not size:
+                os.ftruncate(self._fd, offset)
+        else:
+            f.flush()
+            self._fd = f.fileno()
+            self._f = f
+        if size:
+            preallocate(self._fd, size)
+        self.offset = offset
+        self.journal = journal
+        self.fsync = fsync
+        self.engine = engine if engine is not None else get_write_behind()
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.error = None
+        self._pending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        self.write_at(data, self.offset)
+        self.offset += len(data)
+
+    def write_at(self, data, offset):
+        if self._closed:
+            raise ValueError('write to closed FileWriter')
+        if len(data) == 0:
+            return
+        with self._cond:
+            self._pending += 1
+        self.engine.submit(self, offset, memoryview(data))
+
+    async def drain(self):
+        '''Wait for room in the engine, raise the error of a failed write
+        '''
+        if self.error is not None:
+            raise self.error
+        await self.engine.wait_space(self.loop)
+
+    def _write(self, offset, view):
+        # runs on a thread of the engine
+        try:
+            if self.error is None:
+                write_at(self._fd, view, offset)
+                if self.journal is not None:
+                    with self._cond:
+                        self.journal.add(offset, offset + len(view))
+        except Exception as e:
+            logger.exception('write behind failed at %d' % offset)
+            self.error = e
+        finally:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def flush(self):
+        '''Block until every queued chunk is written
+        '''
+        with self._cond:
+            while self._pending > 0:
+                self._cond.wait()
 
     def close(self):
-        self.stop()
+        '''Blocks, call it on an executor from the event loop
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        try:
+            if self.fsync and self.error is None:
+                os.fsync(self._fd)
+        finally:
+            if self._f is not None:
+                self._f.close()
+            else:
+                os.close(self._fd)
+            if self.journal is not None:
+                self.journal.save()
+        logger.info(str(self.engine))
+        if self.error is not None:
+            raise self.error
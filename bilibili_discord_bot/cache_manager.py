@@ -0,0 +1,170 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import asyncio
+import logging
+from os import path
+from .common import size2str
+from .executors import run_io
+from .simple_ffmpeg import BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+_video_dir = re.compile(r'av(\d+)$')
+
+
+def dir_size(dir_path):
+    '''Bytes used by the files under dir_path, 0 when it does not exist
+    '''
+    if not path.isdir(dir_path):
+        return 0
+    total = 0
+    for entry in os.scandir(dir_path):
+        if entry.is_dir(follow_symlinks=False):
+            total += dir_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+class CacheManager:
+    '''Keep the cached videos under file_path within a byte budget
+
+    Size, last play and play count of every cached video are recorded in
+    the cache table, a video not played yet counts as played when it was
+    stored. When the total goes over the budget the least recently played
+    (lru) or least often played (lfu) videos are deleted one at a time in
+    the background. Pinned videos and the ones in_use() returns
+    (queued, playing or downloading) are never deleted.
+    '''
+    LRU = 'lru'
+    LFU = 'lfu'
+    _interval = 10 * 60
+
+    def __init__(self, db, file_path, *, budget=None, policy=None, in_use=None, loop=None):
+        '''db is the AsyncVideoDatabase, budget the bytes allowed in total
+        (None keeps everything) and in_use a callable returning a set of aids
+        '''
+        policy = policy if policy is not None else self.LRU
+        if policy not in (self.LRU, self.LFU):
+            raise ValueError('unknown cache policy %s' % policy)
+        self.db = db
+        self.file_path = file_path
+        self.budget = budget
+        self.policy = policy
+        self.in_use = in_use
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.task = None
+        self._wake = asyncio.Event()
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = self.loop.create_task(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.wait([self.task])
+            self.task = None
+
+    async def _db_call(self, func, *args):
+        try:
+            return await func(*args)
+        except sqlite3.Error:
+            logger.exception('cache database access failed')
+            return None
+
+    def _video_path(self, aid):
+        return path.join(self.file_path, 'av%d' % aid)
+
+    async def stored(self, aid):
+        '''Measure the directory of a video after files were added to it
+        '''
+        size = await run_io(dir_size, self._video_path(aid), priority=BACKGROUND)
+        await self._db_call(self.db.update_cache_size, aid, size, time.time())
+        self._wake.set()
+
+    async def played(self, aid):
+        await self._db_call(self.db.record_cache_play, aid, time.time())
+
+    async def pin(self, aid, pinned=True):
+        await self._db_call(self.db.update_cache_pinned, aid, pinned)
+        self._wake.set()
+
+    async def scan(self):
+        '''Record the size of the video directories the table does not know,
+        one directory at a time
+        '''
+        rows = await self._db_call(self.db.get_cache_entries)
+        known = set(row['aid'] for row in rows or [] if row['size'] > 0)
+        names = await run_io(os.listdir, self.file_path, priority=BACKGROUND)
+        for name in names:
+            match = _video_dir.match(name)
+            if match is not None and int(match.group(1)) not in known:
+                await self.stored(int(match.group(1)))
+
+    def _sort_key(self, row):
+        if self.policy == self.LFU:
+            return (row['play_count'], row['last_played'])
+        return (row['last_played'],)
+
+    async def evict(self):
+        '''Delete videos until the cache fits the budget, return the bytes
+        freed
+        '''
+        if self.budget is None:
+            return 0
+        rows = await self._db_call(self.db.get_cache_entries)
+        if rows is None:
+            return 0
+        total = sum(row['size'] for row in rows)
+        if total <= self.budget:
+            return 0
+        busy = self.in_use() if self.in_use is not None else set()
+        candidates = sorted((row for row in rows
+                             if not row['pinned'] and row['size'] > 0 and row['aid'] not in busy),
+                            key=self._sort_key)
+        freed = 0
+        for row in candidates:
+            if total - freed <= self.budget:
+                break
+            await self._evict(row['aid'], row['size'])
+            freed += row['size']
+        if total - freed > self.budget:
+            logger.warning('cache stays over budget, the rest is pinned or in use: %s' % str(self))
+        return freed
+
+    async def _evict(self, aid, size):
+        # forget the segments first so no player picks the files up
+        await self._db_call(self.db.evict_video, aid)
+        await run_io(shutil.rmtree, self._video_path(aid), True, priority=BACKGROUND)
+        self.evictions += 1
+        self.evicted_bytes += size
+        logger.info('evicted av%d (%s) from the cache' % (aid, size2str(size)))
+
+    async def _run(self):
+        try:
+            await self.scan()
+        except OSError:
+            logger.exception('scanning the cache failed')
+        while True:
+            try:
+                await self.evict()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('cache eviction failed')
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def __str__(self):
+        budget = size2str(self.budget) if self.budget is not None else 'unlimited'
+        fmt = 'cache budget {0} ({1}), {2} evictions freed {3}'
+        return fmt.format(budget, self.policy, self.evictions, size2str(self.evicted_bytes))
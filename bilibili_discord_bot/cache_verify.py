@@ -0,0 +1,80 @@
+import os
+import hashlib
+import logging
+from os import path
+from .bilibili_data import VideoSegmentInfo
+from .download_journal import SegmentJournal
+
+logger = logging.getLogger(__name__)
+
+_block_size = 1024 * 1024
+
+
+def file_checksum(file_name, block_size=_block_size):
+    '''md5 of a file, read block by block
+    '''
+    checksum = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if len(data) == 0:
+                break
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+def segment_on_disk(file_name, size):
+    '''The segment file exists, has the expected size and no unfinished
+    journal, cheap enough to check before every local play
+    '''
+    if not path.exists(file_name):
+        return False
+    if size and path.getsize(file_name) != size:
+        return False
+    journal = SegmentJournal(file_name, size)
+    if path.exists(journal.journal_name) and not SegmentJournal.load(file_name, size).is_complete():
+        return False
+    return True
+
+
+def segments_on_disk(video_path, segments):
+    return all(segment_on_disk(path.join(video_path, segment.file_name), segment.size)
+               for segment in segments)
+
+
+def verify_segment(file_name, size, checksum=None):
+    '''Check size and content of a segment file
+
+    Returns the error found (None when the file is good) and the checksum
+    of the file, which is compared with checksum when one is given.
+    '''
+    if not path.exists(file_name):
+        return 'missing', None
+    if not segment_on_disk(file_name, size):
+        return 'incomplete, %d of %d bytes' % (path.getsize(file_name), size), None
+    actual = file_checksum(file_name)
+    if checksum is not None and actual != checksum:
+        return 'checksum mismatch', actual
+    return None, actual
+
+
+def verify_video(video_path, seg_json):
+    '''Verify every segment of a cached video, runs in a worker process
+
+    Returns a list of (order, error, checksum) for the segments.
+    '''
+    results = []
+    for segment in VideoSegmentInfo.from_json(seg_json):
+        file_name = path.join(video_path, segment.file_name)
+        error, checksum = verify_segment(file_name, segment.size, segment.checksum)
+        results.append((segment.order, error, checksum))
+    return results
+
+
+def remove_segment(file_name):
+    '''Delete a broken segment file and its journal
+    '''
+    journal = SegmentJournal(file_name, 0)
+    for name in (file_name, journal.journal_name):
+        if path.exists(name):
+            os.remove(name)
@@ -1,6 +1,8 @@
 # for croping the image
 from PIL import Image
+import io
 import time
+import asyncio
 import platform
 import logging
 
@@ -11,6 +13,10 @@ def is_linux_or_mac():
     return system == 'Linux' or system == 'Darwin'
 
 
+def is_linux():
+    return platform.system() == 'Linux'
+
+
 def size2str(num, suffix='B'):
     '''helper function to produce human readable size format'''
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
@@ -20,14 +26,42 @@ def size2str(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+def str2size(s):
+    '''helper function to read sizes like 512M or 8GiB, plain numbers are bytes'''
+    if isinstance(s, (int, float)):
+        return int(s)
+    s = s.strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1, 'M': 2, 'G': 3, 'T': 4}
+    if len(s) > 0 and s[-1] in units:
+        return int(float(s[:-1]) * 1024 ** units[s[-1]])
+    return int(float(s))
+
+
 def obj_dict(obj):
     '''helper function to json serialize object'''
     return obj.__dict__
 
 
+def read_file(file_name):
+    '''helper function to read a whole file'''
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def write_file(file_name, data):
+    '''helper function to write bytes into a file'''
+    with open(file_name, 'wb') as f:
+        f.write(data)
+
+
 def square_crop(file_in, file_out):
     '''helper function to crop image to square'''
-    im = Image.open(file_in)
+    write_file(file_out, square_crop_data(read_file(file_in)))
+
+
+def square_crop_data(data):
+    '''helper function to crop image bytes to a square PNG'''
+    im = Image.open(io.BytesIO(data))
     width, height = im.size
     new_dim = min(width, height)
     left = (width - new_dim) // 2
@@ -36,7 +70,9 @@ def square_crop(file_in, file_out):
     bottom = (height + new_dim) // 2
     logger.info('cropping: %d %d %d %d' % (left, top, right, bottom))
     om = im.crop((left, top, right, bottom))
-    om.save(file_out, 'PNG')
+    out = io.BytesIO()
+    om.save(out, 'PNG')
+    return out.getvalue()
 
 
 class FileDownloadInfo:
@@ -49,6 +85,8 @@ class FileDownloadInfo:
         self.end_time = None
         self.last_current = 0
         self.last_time = None
+        # seconds spent waiting for the consumer of the bytes
+        self.waited = 0
 
     def start(self):
         self.start_time = time.time()
@@ -64,6 +102,9 @@ class FileDownloadInfo:
     def log(self, length):
         self.current += length
 
+    def wait(self, seconds):
+        self.waited += seconds
+
     def get_status(self):
         current_time = time.time()
         fmt = 'Read ({0} / {1}) {2}'
@@ -78,3 +119,34 @@ class FileDownloadInfo:
             return 0
 
         return size2str(self.total / (self.end_time - self.start_time), 'B/s')
+
+    def throughput(self):
+        '''Bytes per second received, not counting the time spent waiting
+        for the consumer, 0 before the end
+        '''
+        if self.start_time is None or self.end_time is None:
+            return 0
+        elapsed = self.end_time - self.start_time - self.waited
+        return self.current / elapsed if elapsed > 0 else 0
+
+
+class RateLimiter:
+    '''Token bucket shared by downloads that together may not exceed rate
+    bytes per second
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    async def acquire(self, amount):
+        '''Take amount bytes from the bucket, sleeping while it is in debt
+        '''
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
@@ -2,6 +2,22 @@ import sqlite3
 import pkg_resources
 import click
 import enum
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# version of schema.sql, kept in PRAGMA user_version of the database
+SCHEMA_VERSION = 3
+
+
+def _schema_statements():
+    sql = pkg_resources.resource_string(__name__, 'schema.sql').decode('utf-8')
+    return [statement.strip() for statement in sql.split(';') if len(statement.strip()) > 0]
+
 
 class VideoStatus(enum.IntEnum):
     New = 1
@@ -12,47 +28,370 @@ class VideoStatus(enum.IntEnum):
 
 class VideoDatabase:
     '''Manage the downloaded files
+
+    With autocommit=False the caller decides when to commit(), which lets
+    several updates share one transaction. Opening the database brings its
+    tables up to SCHEMA_VERSION.
     '''
 
-    def __init__(self, db_path='bot.sqlite'):
+    def __init__(self, db_path='bot.sqlite', *, autocommit=True, wal=False, check_same_thread=True):
         self.db_path = db_path
+        self.autocommit = autocommit
         self.conn = sqlite3.connect(
             self.db_path,
-            detect_types=sqlite3.PARSE_DECLTYPES
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=check_same_thread
         )
         self.conn.row_factory = sqlite3.Row
+        if wal:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.upgrade()
 
-    def init_db(self):
-        resource_package = __name__
-        sql = pkg_resources.resource_string(resource_package, 'schema.sql')
-        self.conn.executescript(sql.decode('utf-8'))
+    def _commit(self):
+        if self.autocommit:
+            self.conn.commit()
+
+    def commit(self):
         self.conn.commit()
 
-    def get_video(self, aid):
-        sql = 'SELECT * FROM video WHERE aid=?'
-        return self.conn.execute(sql, (aid,)).fetchone()
+    def rollback(self):
+        self.conn.rollback()
 
-    def insert_video(self, aid):
-        if self.get_video(aid) is not None:
+    def version(self):
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def upgrade(self):
+        '''Create the missing tables and upgrade the old ones, keeping
+        their rows
+        '''
+        if self.version() >= SCHEMA_VERSION:
             return
-        sql = 'INSERT INTO video(aid, status) VALUES (?,?)'
-        self.conn.execute(sql, (aid, 0))
-        self.conn.commit()
+        # one connection upgrades, the others wait and find it done
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.version()
+            if version < SCHEMA_VERSION:
+                logger.info('upgrading %s from schema version %d to %d' % (self.db_path, version, SCHEMA_VERSION))
+                columns = self._columns('video')
+                if len(columns) > 0 and 'page' not in columns:
+                    # before version 2 the videos were keyed by aid alone, they become page 1
+                    self.conn.execute('ALTER TABLE video RENAME TO video_unpaged')
+                for statement in _schema_statements():
+                    self.conn.execute(statement)
+                if len(columns) > 0 and 'page' not in columns:
+                    self.conn.execute('INSERT INTO video(aid, page, status, videoinfo, segmentinfo) '
+                                      'SELECT aid, 1, status, videoinfo, segmentinfo FROM video_unpaged')
+                    self.conn.execute('DROP TABLE video_unpaged')
+                self.conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
 
-    def update_status(self, aid, status):
-        sql = 'UPDATE video SET status=? WHERE aid=?'
-        self.conn.execute(sql, (int(status), aid))
-        self.conn.commit()
+    def _columns(self, table):
+        return [row['name'] for row in self.conn.execute('PRAGMA table_info(%s)' % table)]
 
-    def update_videoinfo(self, aid, videoinfo):
-        sql = 'UPDATE video SET videoinfo=? WHERE aid=?'
-        self.conn.execute(sql, (videoinfo, aid))
-        self.conn.commit()
+    def init_db(self):
+        '''Create or upgrade the tables, the rows are kept
+        '''
+        self.upgrade()
 
-    def update_segmentinfo(self, aid, seginfo):
-        sql = 'UPDATE video SET segmentinfo=? WHERE aid=?'
-        self.conn.execute(sql, (seginfo, aid))
-        self.conn.commit()
+    def get_video(self, aid, page=1):
+        sql = 'SELECT * FROM video WHERE aid=? AND page=?'
+        return self.conn.execute(sql, (aid, page)).fetchone()
 
-    def __del__(self):
+    def insert_video(self, aid, page=1):
+        if self.get_video(aid, page) is not None:
+            return
+        sql = 'INSERT INTO video(aid, page, status) VALUES (?,?,?)'
+        self.conn.execute(sql, (aid, page, 0))
+        self._commit()
+
+    def update_status(self, aid, status, page=1):
+        sql = 'UPDATE video SET status=? WHERE aid=? AND page=?'
+        self.conn.execute(sql, (int(status), aid, page))
+        self._commit()
+
+    def update_videoinfo(self, aid, videoinfo, page=1):
+        sql = 'UPDATE video SET videoinfo=? WHERE aid=? AND page=?'
+        self.conn.execute(sql, (videoinfo, aid, page))
+        self._commit()
+
+    def update_segmentinfo(self, aid, seginfo, page=1):
+        sql = 'UPDATE video SET segmentinfo=? WHERE aid=? AND page=?'
+        self.conn.execute(sql, (seginfo, aid, page))
+        self._commit()
+
+    def save_video(self, aid, videoinfo=None, seginfo=None, page=1):
+        '''Insert the video if needed and update the given columns
+        '''
+        self.insert_video(aid, page)
+        if videoinfo is not None:
+            self.update_videoinfo(aid, videoinfo, page)
+        if seginfo is not None:
+            self.update_segmentinfo(aid, seginfo, page)
+
+    def get_cached_videos(self):
+        sql = 'SELECT aid, page, segmentinfo FROM video WHERE segmentinfo IS NOT NULL'
+        return self.conn.execute(sql).fetchall()
+
+    def get_metadata(self, aid, page, qn):
+        sql = 'SELECT * FROM metadata WHERE aid=? AND page=? AND qn=?'
+        return self.conn.execute(sql, (aid, page, qn)).fetchone()
+
+    def put_metadata(self, aid, page, qn, data, expires):
+        sql = 'INSERT OR REPLACE INTO metadata(aid, page, qn, data, expires) VALUES (?,?,?,?,?)'
+        self.conn.execute(sql, (aid, page, qn, data, expires))
+        self._commit()
+
+    def delete_expired_metadata(self, now):
+        sql = 'DELETE FROM metadata WHERE expires<?'
+        self.conn.execute(sql, (now,))
+        self._commit()
+
+    def get_cache_entries(self):
+        sql = 'SELECT * FROM cache'
+        return self.conn.execute(sql).fetchall()
+
+    def record_cache_play(self, aid, now):
+        sql = 'INSERT OR IGNORE INTO cache(aid) VALUES (?)'
+        self.conn.execute(sql, (aid,))
+        sql = 'UPDATE cache SET last_played=?, play_count=play_count+1 WHERE aid=?'
+        self.conn.execute(sql, (now, aid))
+        self._commit()
+
+    def update_cache_size(self, aid, size, now):
+        '''Record the bytes of a video in the cache. A video that had none,
+        new or evicted, counts as used at now, so it is not the first to go
+        before it is played.
+        '''
+        sql = 'INSERT OR IGNORE INTO cache(aid) VALUES (?)'
+        self.conn.execute(sql, (aid,))
+        sql = 'UPDATE cache SET last_played=MAX(last_played, ?) WHERE aid=? AND size=0'
+        self.conn.execute(sql, (now, aid))
+        sql = 'UPDATE cache SET size=? WHERE aid=?'
+        self.conn.execute(sql, (size, aid))
+        self._commit()
+
+    def update_cache_pinned(self, aid, pinned):
+        sql = 'INSERT OR IGNORE INTO cache(aid) VALUES (?)'
+        self.conn.execute(sql, (aid,))
+        sql = 'UPDATE cache SET pinned=? WHERE aid=?'
+        self.conn.execute(sql, (int(pinned), aid))
+        self._commit()
+
+    def evict_video(self, aid):
+        '''Forget the cached files of all pages of a video, keeping its play
+        history
+        '''
+        sql = 'UPDATE video SET segmentinfo=NULL WHERE aid=?'
+        self.conn.execute(sql, (aid,))
+        sql = 'UPDATE cache SET size=0 WHERE aid=?'
+        self.conn.execute(sql, (aid,))
+        self._commit()
+
+    def get_throughputs(self):
+        sql = 'SELECT * FROM throughput'
+        return self.conn.execute(sql).fetchall()
+
+    def update_throughput(self, host, speed, samples, updated):
+        sql = 'INSERT OR REPLACE INTO throughput(host, speed, samples, updated) VALUES (?,?,?,?)'
+        self.conn.execute(sql, (host, speed, samples, updated))
+        self._commit()
+
+    def close(self):
         self.conn.close()
+
+    def __del__(self):
+        conn = getattr(self, 'conn', None)
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except sqlite3.Error:
+            # closed already, or collected away from its thread
+            pass
+
+
+class DatabaseWriter(threading.Thread):
+    '''Run all database writes on one thread and connection
+
+    Every write queued while a transaction runs joins the next one, so a
+    burst of updates costs a single commit. Each write runs in its own
+    savepoint, a failed write is rolled back without undoing the others.
+    A write's future resolves once its transaction is committed.
+    '''
+    _max_batch = 64
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.daemon = True
+        self.db_path = db_path
+        self._queue = queue.Queue()
+        self.commits = 0
+        self.writes = 0
+
+    def submit(self, loop, func, *args):
+        future = loop.create_future()
+        self._queue.put((loop, future, func, args))
+        return future
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run(self):
+        db = VideoDatabase(self.db_path, autocommit=False, wal=True)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self._max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            try:
+                results = self._apply(db, batch)
+                db.commit()
+                self.commits += 1
+                self.writes += len(batch)
+            except Exception as e:
+                logger.exception('database commit failed')
+                db.rollback()
+                results = [(None, e)] * len(batch)
+            for (loop, future, func, args), (result, error) in zip(batch, results):
+                loop.call_soon_threadsafe(self._resolve, future, result, error)
+        db.close()
+
+    @staticmethod
+    def _apply(db, batch):
+        # the savepoints nest in one transaction, released they commit with it
+        db.conn.execute('BEGIN')
+        results = []
+        for loop, future, func, args in batch:
+            db.conn.execute('SAVEPOINT w')
+            try:
+                result = func(db, *args)
+            except Exception as e:
+                logger.exception('database write failed')
+                db.conn.execute('ROLLBACK TO w')
+                results.append((None, e))
+            else:
+                results.append((result, None))
+            db.conn.execute('RELEASE w')
+        return results
+
+    def stop(self, timeout=None):
+        '''Commit the queued writes and wait for the thread to exit
+        '''
+        self._queue.put(None)
+        self.join(timeout)
+
+
+class AsyncVideoDatabase:
+    '''Awaitable access to the video database for use from the bot
+
+    Writes go to a DatabaseWriter thread which batches them into shared
+    transactions, reads run on a small thread pool with one connection per
+    thread. The database runs in WAL mode so readers never wait for the
+    writer to commit.
+    '''
+    _readers = 2
+
+    def __init__(self, db_path='bot.sqlite', *, readers=None, loop=None):
+        self.db_path = db_path
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self._local = threading.local()
+        self._reader_dbs = []
+        self._reader = ThreadPoolExecutor(max_workers=readers if readers is not None else self._readers)
+        self._writer = DatabaseWriter(db_path)
+        self._writer.start()
+
+    def _reader_db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # the connection may be collected from another thread
+            db = VideoDatabase(self.db_path, wal=True, check_same_thread=False)
+            self._local.db = db
+            self._reader_dbs.append(db)
+        return db
+
+    def _read(self, func, *args):
+        def call():
+            return func(self._reader_db(), *args)
+        return self.loop.run_in_executor(self._reader, call)
+
+    def _write(self, func, *args):
+        return self._writer.submit(self.loop, func, *args)
+
+    async def get_video(self, aid, page=1):
+        return await self._read(VideoDatabase.get_video, aid, page)
+
+    async def insert_video(self, aid, page=1):
+        await self._write(VideoDatabase.insert_video, aid, page)
+
+    async def update_status(self, aid, status, page=1):
+        await self._write(VideoDatabase.update_status, aid, status, page)
+
+    async def update_videoinfo(self, aid, videoinfo, page=1):
+        await self._write(VideoDatabase.update_videoinfo, aid, videoinfo, page)
+
+    async def update_segmentinfo(self, aid, seginfo, page=1):
+        await self._write(VideoDatabase.update_segmentinfo, aid, seginfo, page)
+
+    async def save_video(self, aid, videoinfo=None, seginfo=None, page=1):
+        await self._write(VideoDatabase.save_video, aid, videoinfo, seginfo, page)
+
+    async def get_metadata(self, aid, page, qn):
+        return await self._read(VideoDatabase.get_metadata, aid, page, qn)
+
+    async def put_metadata(self, aid, page, qn, data, expires):
+        await self._write(VideoDatabase.put_metadata, aid, page, qn, data, expires)
+
+    async def delete_expired_metadata(self, now):
+        await self._write(VideoDatabase.delete_expired_metadata, now)
+
+    async def get_cache_entries(self):
+        return await self._read(VideoDatabase.get_cache_entries)
+
+    async def record_cache_play(self, aid, now):
+        await self._write(VideoDatabase.record_cache_play, aid, now)
+
+    async def update_cache_size(self, aid, size, now):
+        await self._write(VideoDatabase.update_cache_size, aid, size, now)
+
+    async def update_cache_pinned(self, aid, pinned):
+        await self._write(VideoDatabase.update_cache_pinned, aid, pinned)
+
+    async def evict_video(self, aid):
+        await self._write(VideoDatabase.evict_video, aid)
+
+    async def get_throughputs(self):
+        return await self._read(VideoDatabase.get_throughputs)
+
+    async def update_throughput(self, host, speed, samples, updated):
+        await self._write(VideoDatabase.update_throughput, host, speed, samples, updated)
+
+    def __str__(self):
+        fmt = 'database {0}: {1} writes in {2} commits'
+        return fmt.format(self.db_path, self._writer.writes, self._writer.commits)
+
+    def close(self):
+        self._writer.stop()
+        self._reader.shutdown(wait=True)
+        for db in self._reader_dbs:
+            db.close()
+        self._reader_dbs = []
@@ -0,0 +1,175 @@
+import os
+import json
+import asyncio
+import threading
+import logging
+from os import path
+from .executors import run_io
+from .simple_ffmpeg import INTERACTIVE
+
+logger = logging.getLogger(__name__)
+
+
+# journals of the segment files being written right now, by file name
+_active = {}
+# per file [asyncio.Lock, number of users] so one writer runs per file
+_locks = {}
+
+
+class SegmentJournal:
+    '''Record the byte ranges of a segment file that are on disk
+
+    The journal lives next to the segment file (N.flv.journal) so that an
+    interrupted download can continue with Range requests for the missing
+    parts only. Ranges are half open [start, end) and kept merged.
+    '''
+    _suffix = '.journal'
+    _save_interval = 1024 * 1024
+
+    def __init__(self, file_name, size):
+        self.file_name = file_name
+        self.journal_name = file_name + self._suffix
+        self.size = size
+        self.ranges = []
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, file_name, size):
+        '''Load the journal for file_name, or start an empty one if the
+        journal is missing or does not describe a file of this size
+        '''
+        journal = cls(file_name, size)
+        if not path.exists(file_name) or not path.exists(journal.journal_name):
+            return journal
+        try:
+            with open(journal.journal_name) as f:
+                data = json.load(f)
+            if data['size'] != size or path.getsize(file_name) < journal.prefix_of(sorted(data['ranges'])):
+                logger.info('journal does not match segment, restart %s' % file_name)
+                return journal
+            for start, end in data['ranges']:
+                journal._add(start, end)
+        except:
+            logger.exception('load journal failed for %s' % file_name)
+            journal.ranges = []
+        return journal
+
+    @classmethod
+    async def acquire(cls, file_name, size, *, priority=INTERACTIVE):
+        '''Wait until no other task writes file_name, then load its journal
+        in the I/O pool with priority
+
+        The journal stays registered as active, for readers following the
+        download, until release() is called.
+        '''
+        entry = _locks.get(file_name)
+        if entry is None:
+            entry = _locks[file_name] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except:
+            cls._unref(file_name)
+            raise
+        try:
+            journal = await run_io(cls.load, file_name, size, priority=priority)
+        except:
+            entry[0].release()
+            cls._unref(file_name)
+            raise
+        _active[file_name] = journal
+        return journal
+
+    @staticmethod
+    def _unref(file_name):
+        entry = _locks[file_name]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[file_name]
+
+    def release(self):
+        if _active.get(self.file_name) is self:
+            del _active[self.file_name]
+        entry = _locks.get(self.file_name)
+        if entry is not None:
+            entry[0].release()
+            self._unref(self.file_name)
+
+    @staticmethod
+    def active(file_name):
+        '''The journal of file_name if a download is writing it right now
+        '''
+        return _active.get(file_name)
+
+    @staticmethod
+    def prefix_of(ranges):
+        if len(ranges) > 0 and ranges[0][0] == 0:
+            return ranges[0][1]
+        return 0
+
+    def _add(self, start, end):
+        if end <= start:
+            return
+        merged = []
+        for r_start, r_end in self.ranges:
+            if r_end < start or r_start > end:
+                merged.append([r_start, r_end])
+            else:
+                start = min(start, r_start)
+                end = max(end, r_end)
+        merged.append([start, end])
+        merged.sort()
+        self.ranges = merged
+
+    def add(self, start, end):
+        '''Mark [start, end) as written, saving the journal every so often
+        '''
+        with self._lock:
+            self._add(start, end)
+            self._unsaved += end - start
+            if self._unsaved < self._save_interval:
+                return
+        self.save()
+
+    def prefix(self):
+        '''Length of the contiguous data from the start of the file
+        '''
+        with self._lock:
+            return self.prefix_of(self.ranges)
+
+    def missing(self):
+        '''Inclusive (start, end) byte ranges that still need downloading
+        '''
+        with self._lock:
+            result = []
+            offset = 0
+            for start, end in self.ranges:
+                if start > offset:
+                    result.append((offset, start - 1))
+                offset = max(offset, end)
+            if offset < self.size:
+                result.append((offset, self.size - 1))
+            return result
+
+    def is_complete(self):
+        return self.size > 0 and len(self.missing()) == 0
+
+    def save(self):
+        with self._lock:
+            data = {'size': self.size, 'ranges': self.ranges}
+            self._unsaved = 0
+            tmp_name = self.journal_name + '.tmp'
+            try:
+                with open(tmp_name, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_name, self.journal_name)
+            except:
+                logger.exception('save journal failed for %s' % self.file_name)
+
+    def __str__(self):
+        fmt = 'journal {0}: {1} / {2} bytes'
+        return fmt.format(self.file_name, sum(end - start for start, end in self.ranges), self.size)
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,273 @@
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from .common import FileDownloadInfo, size2str
+from .priority_slots import await_slot
+
+logger = logging.getLogger(__name__)
+
+# download classes, lower goes first
+LIVE = 0
+PREFETCH = 1
+ARCHIVE = 2
+
+CLASS_NAMES = {LIVE: 'live', PREFETCH: 'prefetch', ARCHIVE: 'archive'}
+
+
+class DownloadTask:
+    '''One download registered with the DownloadScheduler
+
+    Every connection of the task takes a slot with connection() and every
+    block received goes through transfer(), which waits for the bandwidth
+    and counts the bytes in info, a FileDownloadInfo.
+    '''
+    WAITING = 'waiting'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, scheduler, task_id, name, klass, guild=None, total=0):
+        self.scheduler = scheduler
+        self.task_id = task_id
+        self.name = name
+        self.klass = klass
+        self.guild = guild
+        self.info = FileDownloadInfo(total)
+        self.state = self.WAITING
+        self.connections = 0
+        self.error = None
+
+    def add_total(self, size):
+        self.info.total += size
+
+    async def run(self, awaitable):
+        '''Await awaitable and finish the task with its outcome
+        '''
+        try:
+            result = await awaitable
+        except asyncio.CancelledError:
+            self.finish(IOError('cancelled'))
+            raise
+        except Exception as e:
+            self.finish(e)
+            raise
+        self.finish()
+        return result
+
+    async def transfer(self, length):
+        if self.info.start_time is None:
+            self.info.start()
+        self.info.log(length)
+        await self.scheduler.throttle(self, length)
+
+    def finish(self, error=None):
+        '''Mark the task done, or failed with error, and unregister it
+        '''
+        if self.state in (self.DONE, self.FAILED):
+            return
+        self.error = error
+        self.state = self.FAILED if error is not None else self.DONE
+        self.info.end()
+        self.scheduler._finished(self)
+
+    def progress(self):
+        '''State, bytes and speed of the task as a dict
+        '''
+        info = self.info
+        elapsed = (info.end_time or time.time()) - info.start_time if info.start_time is not None else 0
+        return {
+            'id': self.task_id,
+            'name': self.name,
+            'class': CLASS_NAMES[self.klass],
+            'guild': self.guild,
+            'state': self.state,
+            'connections': self.connections,
+            'current': info.current,
+            'total': info.total,
+            'speed': info.current / elapsed if elapsed > 0 else 0,
+        }
+
+    def __str__(self):
+        progress = self.progress()
+        fmt = '{name} [{class}] {state} {0} / {1} at {2}, {connections} connections'
+        return fmt.format(size2str(progress['current']), size2str(progress['total']),
+                          size2str(progress['speed'], 'B/s'), **progress)
+
+
+class _Connection:
+    def __init__(self, task):
+        self.task = task
+
+    async def __aenter__(self):
+        if self.task is not None:
+            await self.task.scheduler.acquire(self.task)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.task is not None:
+            self.task.scheduler.release(self.task)
+
+
+def connection(task):
+    '''Connection slot of task, nothing to hold when task is None
+    '''
+    return _Connection(task)
+
+
+class DownloadScheduler:
+    '''Share the connections and the bandwidth of the process between
+    downloads
+
+    Connection slots are capped in total and per class. A freed slot goes to
+    the waiting connection of the best class, within a class to the guild
+    holding the fewest connections, then in arrival order. With a rate the
+    bytes go through a token bucket which, when short, serves the waiting
+    blocks in the same class order.
+    '''
+    _max_connections = 16
+    _class_limits = {LIVE: 8, PREFETCH: 4, ARCHIVE: 4}
+    _max_finished = 16
+
+    def __init__(self, *, max_connections=None, class_limits=None, rate=None, burst=None):
+        '''rate is the bytes per second of all downloads together, None for
+        no cap
+        '''
+        self.max_connections = max_connections if max_connections is not None else self._max_connections
+        self.class_limits = dict(self._class_limits)
+        if class_limits is not None:
+            self.class_limits.update(class_limits)
+        self.running = 0
+        self.class_running = dict((klass, 0) for klass in self.class_limits)
+        self.guild_running = {}
+        self.tasks = OrderedDict()
+        self.finished = []
+        self.max_depth = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._ids = itertools.count(1)
+        self._bytes_waiting = []
+        self._timer = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def task(self, name, klass, *, guild=None, total=0):
+        '''Register a new DownloadTask, finish() it when it is over
+        '''
+        task = DownloadTask(self, next(self._ids), name, klass, guild, total)
+        self.tasks[task.task_id] = task
+        return task
+
+    def _finished(self, task):
+        self.tasks.pop(task.task_id, None)
+        self.finished.append(task)
+        del self.finished[:-self._max_finished]
+        logger.info('download %s' % str(task))
+
+    @property
+    def depth(self):
+        '''Connections waiting for a slot
+        '''
+        return sum(1 for order, task, future in self._waiting if not future.done())
+
+    def _can_start(self, klass):
+        return self.running < self.max_connections and self.class_running[klass] < self.class_limits[klass]
+
+    def _start(self, task):
+        self.running += 1
+        self.class_running[task.klass] += 1
+        self.guild_running[task.guild] = self.guild_running.get(task.guild, 0) + 1
+        task.connections += 1
+        task.state = DownloadTask.RUNNING
+
+    async def acquire(self, task):
+        # waiters left in the queue are the ones that cannot start yet
+        if self._can_start(task.klass) and not any(self._can_start(waiting.klass)
+                                                   for order, waiting, future in self._waiting
+                                                   if not future.done()):
+            self._start(task)
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiting.append((next(self._counter), task, future))
+        self.max_depth = max(self.max_depth, self.depth)
+        await await_slot(future, lambda: self.release(task))
+
+    def release(self, task):
+        self.running -= 1
+        self.class_running[task.klass] -= 1
+        self.guild_running[task.guild] -= 1
+        if self.guild_running[task.guild] == 0:
+            del self.guild_running[task.guild]
+        task.connections -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        self._waiting = [entry for entry in self._waiting if not entry[2].done()]
+        while True:
+            ready = [entry for entry in self._waiting if self._can_start(entry[1].klass)]
+            if len(ready) == 0:
+                return
+            entry = min(ready, key=lambda entry: (entry[1].klass, self.guild_running.get(entry[1].guild, 0),
+                                                   entry[0]))
+            self._waiting.remove(entry)
+            self._start(entry[1])
+            entry[2].set_result(None)
+
+    async def throttle(self, task, length):
+        '''Wait until the bucket grants length bytes to task
+        '''
+        if self.rate is None:
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._bytes_waiting, (task.klass, next(self._counter), length, future))
+        self._grant()
+        await future
+
+    def _grant(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        # a grant may overdraw the bucket by one block, later ones wait for it
+        while len(self._bytes_waiting) > 0 and self._tokens > 0:
+            klass, order, length, future = heapq.heappop(self._bytes_waiting)
+            if not future.done():
+                self._tokens -= length
+                future.set_result(None)
+        if len(self._bytes_waiting) > 0 and self._timer is None:
+            delay = max(0.001, -self._tokens / self.rate)
+            self._timer = asyncio.get_event_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._grant()
+
+    def progress(self, guild=None):
+        '''Progress of the registered tasks, of one guild when given
+        '''
+        return [task.progress() for task in self.tasks.values() if guild is None or task.guild == guild]
+
+    def __str__(self):
+        rate = size2str(self.rate, 'B/s') if self.rate is not None else 'unlimited'
+        fmt = 'download scheduler: {0}/{1} connections ({2}), {3} waiting (max {4}), {5} tasks, rate {6}'
+        classes = ', '.join('%s %d/%d' % (CLASS_NAMES[klass], self.class_running[klass], limit)
+                            for klass, limit in sorted(self.class_limits.items()))
+        return fmt.format(self.running, self.max_connections, classes, self.depth, self.max_depth,
+                          len(self.tasks), rate)
+
+
+_scheduler = None
+
+
+def get_download_scheduler():
+    '''The process wide DownloadScheduler
+    '''
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = DownloadScheduler()
+    return _scheduler
@@ -0,0 +1,162 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from .priority_slots import PrioritySlots
+from .simple_ffmpeg import INTERACTIVE
+
+logger = logging.getLogger(__name__)
+
+CPU = 'cpu'
+IO = 'io'
+
+
+class ExecutorPool(PrioritySlots):
+    '''An executor that never holds more jobs than it has workers
+
+    Jobs beyond that wait here and start by priority, then in submission
+    order, so an interactive job overtakes the queued jobs of a bulk
+    import. The time jobs waited and ran is kept for the stats.
+    '''
+
+    def __init__(self, name, factory, max_jobs):
+        '''factory creates the executor with max_jobs workers on first use
+        '''
+        super().__init__(max_jobs)
+        self.name = name
+        self.finished = 0
+        self.failed = 0
+        self.wait_time = 0
+        self.max_wait = 0
+        self.run_time = 0
+        self._factory = factory
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = self._factory(self.max_jobs)
+        return self._executor
+
+    async def run(self, func, *args, priority=INTERACTIVE):
+        '''Run func(*args) in the executor once a worker is free
+        '''
+        queued = time.monotonic()
+        await self.acquire(priority)
+        started = time.monotonic()
+        self.wait_time += started - queued
+        self.max_wait = max(self.max_wait, started - queued)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(func, *args))
+        except BrokenExecutor:
+            # a worker died, the next job starts a new executor
+            logger.exception('%s executor broken' % self.name)
+            self.failed += 1
+            self._executor = None
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.release()
+            self.finished += 1
+            self.run_time += time.monotonic() - started
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def __str__(self):
+        fmt = ('{0} executor: {1}/{2} running, {3} waiting (max {4}), {5} finished ({6} failed), '
+               'average wait {7:.1f}ms (max {8:.1f}ms), average run {9:.1f}ms')
+        done = max(self.finished, 1)
+        return fmt.format(self.name, self.running, self.max_jobs, self.depth, self.max_depth, self.finished,
+                          self.failed, self.wait_time * 1000 / done, self.max_wait * 1000, self.run_time * 1000 / done)
+
+
+def _process_pool(max_jobs):
+    # a forked child would inherit the threads and the loop of the bot
+    return ProcessPoolExecutor(max_workers=max_jobs, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _thread_pool(max_jobs):
+    return ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='io')
+
+
+class ExecutorRegistry:
+    '''The executors of the process: a process pool for the CPU bound steps
+    and a thread pool for the blocking file operations
+
+    Functions run in the CPU pool are pickled with their arguments, they
+    take and return plain data such as bytes instead of open files.
+    '''
+    # one core is left to the event loop
+    _cpu_workers = max(1, (os.cpu_count() or 2) - 1)
+    _io_workers = 8
+
+    def __init__(self, *, cpu_workers=None, io_workers=None):
+        cpu_workers = cpu_workers if cpu_workers is not None else self._cpu_workers
+        io_workers = io_workers if io_workers is not None else self._io_workers
+        self.pools = {
+            CPU: ExecutorPool(CPU, _process_pool, cpu_workers),
+            IO: ExecutorPool(IO, _thread_pool, io_workers),
+        }
+
+    def get(self, kind):
+        return self.pools[kind]
+
+    async def run(self, kind, func, *args, priority=INTERACTIVE):
+        return await self.pools[kind].run(func, *args, priority=priority)
+
+    def shutdown(self, wait=True):
+        for pool in self.pools.values():
+            pool.shutdown(wait)
+
+    def __str__(self):
+        return '\n'.join(str(self.pools[kind]) for kind in (CPU, IO))
+
+
+_registry = None
+
+
+def get_executors():
+    '''The process wide ExecutorRegistry
+    '''
+    global _registry
+    if _registry is None:
+        _registry = ExecutorRegistry()
+    return _registry
+
+
+def set_executor_limits(cpu_workers=None, io_workers=None):
+    '''Size the executors, before they are first used
+    '''
+    global _registry
+    _registry = ExecutorRegistry(cpu_workers=cpu_workers, io_workers=io_workers)
+
+
+def run_cpu(func, *args, priority=INTERACTIVE):
+    '''Run func(*args) in the process pool of the ExecutorRegistry
+    '''
+    return get_executors().run(CPU, func, *args, priority=priority)
+
+
+def run_io(func, *args, priority=INTERACTIVE):
+    '''Run func(*args) in the I/O thread pool of the ExecutorRegistry
+    '''
+    return get_executors().run(IO, func, *args, priority=priority)
+
+
+def run_pipe(func, *args):
+    '''Run func(*args), a write into the stdin pipe of a player, in the
+    default executor of the loop
+
+    The write returns only as fast as ffmpeg takes the audio, in the I/O
+    pool it would hold a worker for the length of a track and starve the
+    file operations queued behind it.
+    '''
+    return asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args))
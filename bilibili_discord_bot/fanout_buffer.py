@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import logging
+import time
+from .common import size2str
+
+logger = logging.getLogger(__name__)
+
+# buffers of the downloads running right now, by name (the segment file)
+_active = {}
+
+
+class ReaderDetached(Exception):
+    '''Raised to a reader that fell too far behind and was cut off
+    '''
+    pass
+
+
+class FanoutReader:
+    '''One consumer of a FanoutBuffer with its own position
+
+    A BLOCK reader makes the producer wait when the buffer is full, a DETACH
+    reader is cut off instead so it can never stall the others.
+    '''
+    BLOCK = 'block'
+    DETACH = 'detach'
+
+    def __init__(self, buffer, position, policy, name):
+        self.buffer = buffer
+        self.position = position
+        self.policy = policy
+        self.name = name
+        self.detached = False
+        self.closed = False
+        self.bytes_read = 0
+
+    async def read(self):
+        '''Next bytes of the stream, b'' at the end
+
+        Raises ReaderDetached once cut off and the producer's error when the
+        download failed.
+        '''
+        return await self.buffer._read(self)
+
+    def close(self):
+        self.buffer._remove(self)
+
+    def __str__(self):
+        state = 'detached' if self.detached else self.policy
+        return '%s(%s) lag %s' % (self.name, state, size2str(self.buffer.end - self.position))
+
+
+class FanoutBuffer:
+    '''Bounded in memory buffer between one download and several readers
+
+    The producer appends blocks while every reader (the player pipe, the
+    cache file, other listeners of the same segment) consumes at its own
+    pace. A block is released once all readers are past it; when more than
+    capacity bytes are held the producer waits for BLOCK readers and cuts
+    off lagging DETACH readers. Once all buffers together hold more than
+    max_total bytes every producer waits until its readers caught up.
+    '''
+    max_total = 64 * 1024 * 1024
+    # bytes held by all buffers together
+    total_buffered = 0
+    total_high_water = 0
+
+    def __init__(self, capacity, *, start=0, name=None):
+        self.capacity = capacity
+        self.name = name
+        self.start = start
+        self.end = start
+        self._blocks = collections.deque()
+        self._readers = []
+        self._closed = False
+        self._error = None
+        self._changed = asyncio.Event()
+        # metrics
+        self.high_water = 0
+        self.stalls = 0
+        self.stall_time = 0
+        if name is not None:
+            _active[name] = self
+
+    @staticmethod
+    def active(name):
+        '''The buffer of the download named name if one is running
+        '''
+        return _active.get(name)
+
+    def reader(self, policy, name, position=None):
+        '''Attach a reader at position (default the oldest byte held), None
+        if those bytes are no longer in the buffer
+
+        A closed buffer still hands out the bytes it holds, the reader
+        drains them and then gets the end of the stream.
+        '''
+        position = self.start if position is None else position
+        if position < self.start or position > self.end:
+            return None
+        reader = FanoutReader(self, position, policy, name)
+        self._readers.append(reader)
+        return reader
+
+    @property
+    def occupancy(self):
+        return self.end - self.start
+
+    def _over_limit(self):
+        if self.occupancy > self.capacity:
+            return True
+        return FanoutBuffer.total_buffered > FanoutBuffer.max_total and self.occupancy > 0
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _wait(self):
+        await self._changed.wait()
+
+    def _attached(self):
+        return [r for r in self._readers if not r.detached and not r.closed]
+
+    def _trim(self):
+        readers = self._attached()
+        low = min(r.position for r in readers) if len(readers) > 0 else self.end
+        while len(self._blocks) > 0:
+            offset, data = self._blocks[0]
+            if offset + len(data) > low:
+                break
+            self._blocks.popleft()
+            FanoutBuffer.total_buffered -= len(data)
+        self.start = self._blocks[0][0] if len(self._blocks) > 0 else self.end
+
+    def _slice(self, position):
+        for offset, data in self._blocks:
+            if offset <= position < offset + len(data):
+                if offset == position:
+                    return data
+                return data[position - offset:]
+        return b''
+
+    async def write(self, data):
+        '''Append data, waiting while BLOCK readers keep the buffer full
+        '''
+        if len(data) == 0:
+            return
+        self._blocks.append((self.end, data))
+        self.end += len(data)
+        FanoutBuffer.total_buffered += len(data)
+        self._trim()
+        self.high_water = max(self.high_water, self.occupancy)
+        FanoutBuffer.total_high_water = max(FanoutBuffer.total_high_water, FanoutBuffer.total_buffered)
+        self._notify()
+        while self._over_limit():
+            lagging = [r for r in self._attached()
+                       if r.policy == FanoutReader.DETACH and self.end - r.position > self.capacity]
+            if len(lagging) > 0:
+                for reader in lagging:
+                    logger.warning('detach lagging reader %s of %s' % (str(reader), self.name))
+                    reader.detached = True
+                self._trim()
+                self._notify()
+                continue
+            self.stalls += 1
+            start = time.time()
+            await self._wait()
+            self.stall_time += time.time() - start
+
+    async def _read(self, reader):
+        while True:
+            if reader.detached:
+                raise ReaderDetached('reader %s of %s was detached' % (reader.name, self.name))
+            if reader.position < self.end:
+                data = self._slice(reader.position)
+                reader.position += len(data)
+                reader.bytes_read += len(data)
+                self._trim()
+                self._notify()
+                return data
+            if self._closed:
+                if self._error is not None:
+                    raise self._error
+                return b''
+            await self._wait()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    async def wait_buffered(self, reader, amount):
+        '''Wait until amount bytes are held ahead of reader or the stream
+        ended
+        '''
+        while self.end - reader.position < amount and not self._closed and not reader.detached:
+            await self._wait()
+
+    def _remove(self, reader):
+        reader.closed = True
+        if reader in self._readers:
+            self._readers.remove(reader)
+        self._trim()
+        self._notify()
+
+    def close(self, error=None):
+        '''End of the stream, readers get error once they drained the buffer
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._error = error
+        self._trim()
+        if self.name is not None and _active.get(self.name) is self:
+            del _active[self.name]
+        self._notify()
+        logger.info(self.stats())
+
+    def stats(self):
+        fmt = '{0}: held {1} high water {2} stalls {3} ({4:.2f}s) readers [{5}]'
+        return fmt.format(self.name, size2str(self.occupancy), size2str(self.high_water), self.stalls,
+                          self.stall_time, ', '.join(map(str, self._readers)))
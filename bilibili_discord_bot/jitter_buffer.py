@@ -0,0 +1,142 @@
+import time
+import statistics
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def stream_bitrate(segments):
+    '''Bytes per second of the segments, from their sizes and lengths
+    '''
+    size = sum(segment.size or 0 for segment in segments)
+    length = sum(segment.length or 0 for segment in segments)
+    return size * 1000 / length if size > 0 and length > 0 else 0
+
+
+class JitterBuffer:
+    '''Decide when the online player feeds the ffmpeg pipe
+
+    The bytes fed are compared with the bitrate to estimate the audio left
+    in the pipe. Before the first byte, and whenever that runs dry while the
+    download has nothing more, the pipe is held until target seconds are
+    buffered. The target grows with the variance of the measured throughput
+    and after every underrun, and shrinks back while playback is smooth.
+    '''
+    _target = 2.0
+    _min_target = 1.0
+    _max_target = 12.0
+    # weight of the coefficient of variation of the throughput
+    _variance_weight = 2.0
+    _underrun_growth = 1.5
+    # seconds without underrun before the target shrinks
+    _calm = 30
+    _sample_interval = 0.5
+    _samples = 20
+
+    def __init__(self, bitrate, *, target=None, name=None):
+        '''bitrate is the bytes per second the pipe is played at
+        '''
+        self.bitrate = bitrate
+        self.base = target if target is not None else self._target
+        self.target = self.base
+        self.name = name
+        self.floor = self._min_target
+        self.samples = collections.deque(maxlen=self._samples)
+        self._last_sample = None
+        self._last_underrun = None
+        self._clock = None
+        self._written = 0
+        self._fresh = True
+        # report
+        self.startup_time = 0
+        self.underruns = 0
+        self.underrun_time = 0
+
+    def new_pipe(self):
+        '''A new ffmpeg pipe starts empty, waiting for it is no underrun
+        '''
+        self._fresh = True
+        self._reset_clock()
+
+    def _reset_clock(self):
+        self._clock = None
+        self._written = 0
+
+    def pipe_level(self):
+        '''Estimated seconds of audio left in the pipe
+        '''
+        if self._clock is None or self.bitrate <= 0:
+            return 0
+        return self._written / self.bitrate - (time.time() - self._clock)
+
+    def fed(self, length):
+        if self._clock is None:
+            self._clock = time.time()
+            self._written = 0
+        self._written += length
+        self._fresh = False
+
+    async def ready(self, reader):
+        '''Wait, when the pipe is starving, until target seconds are held
+        ahead of the FanoutReader reader or the download ended
+        '''
+        buffer = reader.buffer
+        self._sample(buffer)
+        if self.bitrate <= 0 or buffer.closed or self.pipe_level() > 0:
+            return
+        # the buffer must leave the download room to fill it
+        amount = min(int(self.target * self.bitrate), buffer.capacity // 2)
+        if buffer.end - reader.position >= amount:
+            return
+        underrun = not self._fresh
+        if underrun:
+            self.underruns += 1
+            self._last_underrun = time.time()
+            self.floor = min(self._max_target, self.target * self._underrun_growth)
+            self._adapt()
+            amount = min(int(self.target * self.bitrate), buffer.capacity // 2)
+            logger.warning('%s: playback underrun %d, buffering %.1fs' % (self.name, self.underruns, self.target))
+        start = time.time()
+        await buffer.wait_buffered(reader, amount)
+        if underrun:
+            self.underrun_time += time.time() - start
+        else:
+            self.startup_time += time.time() - start
+        # the pipe ran dry, playback restarts with the next byte
+        self._reset_clock()
+
+    def _sample(self, buffer):
+        now = time.time()
+        if self._last_sample is None or self._last_sample[0] is not buffer:
+            self._last_sample = (buffer, now, buffer.end)
+            return
+        last_buffer, last_time, last_end = self._last_sample
+        if now - last_time < self._sample_interval:
+            return
+        # a full buffer measures the player, not the network
+        if buffer.occupancy < buffer.capacity * 0.9 and not buffer.closed:
+            self.samples.append((buffer.end - last_end) / (now - last_time))
+            self._adapt()
+        self._last_sample = (buffer, now, buffer.end)
+
+    def variation(self):
+        '''Coefficient of variation of the throughput samples
+        '''
+        if len(self.samples) < 3:
+            return 0
+        mean = statistics.mean(self.samples)
+        return statistics.pstdev(self.samples) / mean if mean > 0 else 1
+
+    def _adapt(self):
+        if self._last_underrun is not None and time.time() - self._last_underrun > self._calm:
+            self.floor = max(self._min_target, self.floor * 0.9)
+        wanted = self.base * (1 + self._variance_weight * self.variation())
+        if len(self.samples) >= 3 and statistics.mean(self.samples) < self.bitrate:
+            # the network is slower than playback, buffer as much as allowed
+            wanted = self._max_target
+        self.target = max(self._min_target, min(self._max_target, max(wanted, self.floor)))
+
+    def report(self):
+        fmt = 'target {0:.1f}s, startup {1:.2f}s, {2} underruns ({3:.2f}s), throughput variation {4:.2f}'
+        return fmt.format(self.target, self.startup_time, self.underruns, self.underrun_time, self.variation())
@@ -0,0 +1,109 @@
+import re
+import json
+import time
+import sqlite3
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# page and qn of the entry holding the parsed video page (all pages share it)
+WEB_PAGE = 0
+WEB_QN = 0
+
+
+def playurl_expires(data, default_ttl, margin):
+    '''Time the CDN urls of a playurl response stop working
+
+    Bilibili signs the urls with a deadline parameter, the earliest one wins.
+    '''
+    deadlines = []
+    for durl in data.get('durl', []):
+        match = re.search(r'deadline=(\d+)', durl.get('url', ''))
+        if match is not None:
+            deadlines.append(int(match.group(1)))
+    if len(deadlines) == 0:
+        return time.time() + default_ttl
+    return min(deadlines) - margin
+
+
+class MetadataCache:
+    '''Process wide cache for parsed video pages and playurl responses
+
+    Entries are keyed by (aid, page, qn) and carry an absolute expiry time.
+    The most recent entries are kept in memory and everything is written
+    through to the metadata table so a restarted bot starts warm.
+    '''
+    _max_entries = 256
+    _web_ttl = 6 * 3600
+    _playurl_ttl = 30 * 60
+    _expire_margin = 60
+
+    def __init__(self, db=None, *, max_entries=None):
+        '''db is an AsyncVideoDatabase, without it the cache is memory only
+        '''
+        self.db = db
+        self.max_entries = max_entries if max_entries is not None else self._max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def _db_call(self, func, *args):
+        try:
+            return await func(*args)
+        except sqlite3.Error:
+            logger.exception('metadata cache database access failed')
+            return None
+
+    async def expire(self):
+        '''Drop the persisted entries that expired
+        '''
+        if self.db is not None:
+            await self._db_call(self.db.delete_expired_metadata, time.time())
+
+    async def get(self, aid, page, qn):
+        key = (aid, page, qn)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self.db is not None:
+            row = await self._db_call(self.db.get_metadata, aid, page, qn)
+            if row is not None:
+                entry = (json.loads(row['data']), row['expires'])
+                self._store(key, entry)
+        if entry is None or entry[1] <= now:
+            self.misses += 1
+            self._entries.pop(key, None)
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def put(self, aid, page, qn, data, expires):
+        key = (aid, page, qn)
+        self._store(key, (data, expires))
+        if self.db is not None:
+            await self._db_call(self.db.put_metadata, aid, page, qn, json.dumps(data), expires)
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_web_data(self, aid):
+        return await self.get(aid, WEB_PAGE, WEB_QN)
+
+    async def put_web_data(self, aid, data):
+        await self.put(aid, WEB_PAGE, WEB_QN, data, time.time() + self._web_ttl)
+
+    async def get_playurl(self, aid, page, qn):
+        return await self.get(aid, page, qn)
+
+    async def put_playurl(self, aid, page, qn, data):
+        expires = playurl_expires(data, self._playurl_ttl, self._expire_margin)
+        if expires > time.time():
+            await self.put(aid, page, qn, data, expires)
+
+    def __str__(self):
+        fmt = 'metadata cache: {0} entries, {1} hits, {2} misses'
+        return fmt.format(len(self._entries), self.hits, self.misses)
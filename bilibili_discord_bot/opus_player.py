@@ -0,0 +1,161 @@
+import struct
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# name of the pre transcoded audio next to the cached segments
+OPUS_FILE_NAME = 'audio.opus'
+
+_ogg_capture = b'OggS'
+# capture, version, type, granule, serial, sequence, crc, segment count
+_ogg_header = struct.Struct('<4sBBqIIIB')
+
+
+def read_ogg_packets(f):
+    '''Yield the packets of an Ogg stream read from the file object f
+    '''
+    packet = []
+    while True:
+        header = f.read(_ogg_header.size)
+        if len(header) < _ogg_header.size:
+            return
+        capture, version, header_type, granule, serial, sequence, crc, count = _ogg_header.unpack(header)
+        if capture != _ogg_capture:
+            raise ValueError('invalid ogg page at %d' % (f.tell() - len(header)))
+        lacing = f.read(count)
+        body = f.read(sum(lacing))
+        offset = 0
+        for size in lacing:
+            packet.append(body[offset:offset + size])
+            offset += size
+            # a lacing value below 255 ends the packet
+            if size < 255:
+                yield b''.join(packet)
+                packet = []
+
+
+def opus_packet_duration(packet):
+    '''Duration of an Opus packet in seconds, read from its TOC byte
+    '''
+    if len(packet) == 0:
+        return 0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (0.01, 0.02, 0.04, 0.06)[config % 4]
+    elif config < 16:
+        frame = (0.01, 0.02)[config % 2]
+    else:
+        frame = (0.0025, 0.005, 0.01, 0.02)[config % 4]
+    code = toc & 0x3
+    if code == 0:
+        count = 1
+    elif code < 3:
+        count = 2
+    else:
+        count = packet[1] & 0x3f if len(packet) > 1 else 0
+    return frame * count
+
+
+def read_opus_packets(f):
+    '''Yield the audio packets of an Ogg/Opus file, skipping the headers
+    '''
+    for packet in read_ogg_packets(f):
+        if packet.startswith(b'OpusHead') or packet.startswith(b'OpusTags'):
+            continue
+        yield packet
+
+
+class OpusPacketPlayer(threading.Thread):
+    '''Send ready Opus packets to the voice client in real time
+
+    Works like the players returned by create_ffmpeg_player, but no ffmpeg
+    process runs and nothing is encoded: every 48kHz stereo packet yielded
+    by packets() goes to play_audio unchanged.
+    '''
+    # behind by more than this the clock restarts instead of bursting
+    _max_lag = 0.2
+
+    def __init__(self, voice, *, after=None):
+        super().__init__()
+        self.daemon = True
+        self.voice = voice
+        # sends one packet, like the player attribute of the ffmpeg players
+        self.player = voice.play_audio
+        self.after = after
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._connected = getattr(voice, '_connected', None)
+        self._current_error = None
+
+    def packets(self):
+        raise NotImplementedError()
+
+    def _do_run(self):
+        start = time.time()
+        elapsed = 0
+        for packet in self.packets():
+            if self._end.is_set():
+                break
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                start = time.time() - elapsed
+            if self._connected is not None and not self._connected.is_set():
+                break
+            if time.time() - (start + elapsed) > self._max_lag:
+                start = time.time() - elapsed
+            self.player(packet, encode=False)
+            elapsed += opus_packet_duration(packet)
+            delay = start + elapsed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.stop()
+
+    def run(self):
+        try:
+            self._do_run()
+        except Exception as e:
+            logger.exception('opus packet player failed')
+            self._current_error = e
+            self.stop()
+        finally:
+            if self.after is not None:
+                try:
+                    self.after()
+                except:
+                    logger.exception('opus packet player after failed')
+
+    def stop(self):
+        self._end.set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def is_playing(self):
+        return self._resumed.is_set() and not self.is_done()
+
+    def is_done(self):
+        return not self.is_alive() or self._end.is_set()
+
+    @property
+    def error(self):
+        return self._current_error
+
+
+class OpusFilePlayer(OpusPacketPlayer):
+    '''Play an Ogg/Opus file transcoded to 48kHz stereo Opus beforehand
+    '''
+
+    def __init__(self, voice, file_name, *, after=None):
+        super().__init__(voice, after=after)
+        self.file_name = file_name
+
+    def packets(self):
+        with open(self.file_name, 'rb') as f:
+            yield from read_opus_packets(f)
@@ -0,0 +1,464 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import discord
+from .executors import run_io
+from .opus_player import OpusPacketPlayer
+
+logger = logging.getLogger(__name__)
+
+# main process to worker
+_OPEN = 'open'
+_DATA = 'data'
+_EOF = 'eof'
+_CREDIT = 'credit'
+_CLOSE = 'close'
+_SHUTDOWN = 'shutdown'
+# worker to main process
+_FRAMES = 'frames'
+_TAKEN = 'taken'
+_END = 'end'
+
+_SAMPLING_RATE = 48000
+_CHANNELS = 2
+
+
+class WorkerPipe:
+    '''File like input of a worker session, replacing the ffmpeg pipe
+
+    A write blocks while the worker holds more than window bytes ffmpeg has
+    not taken yet, just like a full pipe, and raises BrokenPipeError once
+    the session ended.
+    '''
+
+    def __init__(self, session, window):
+        self.session = session
+        self.window = window
+        self._pending = 0
+        self._eof = False
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        with self._cond:
+            while not self.session.closed and self._pending > self.window:
+                self._cond.wait()
+            if self.session.closed:
+                raise BrokenPipeError('playback session %d ended' % self.session.sid)
+            self._pending += len(data)
+        self.session.worker.send((_DATA, self.session.sid, bytes(data)))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self._eof and not self.session.closed:
+            self._eof = True
+            self.session.worker.send((_EOF, self.session.sid))
+
+    def _taken(self, length):
+        with self._cond:
+            self._pending -= length
+            self._cond.notify_all()
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+class WorkerPlayer(OpusPacketPlayer):
+    '''Play the Opus frames a worker session encodes
+
+    The worker encodes at most the frames it was credited ahead of
+    playback, every played batch credits it again.
+    '''
+
+    def __init__(self, voice, session, *, after=None):
+        super().__init__(voice, after=after)
+        self.session = session
+
+    def packets(self):
+        played = 0
+        while True:
+            packet = self.session.frames.get()
+            if packet is None:
+                break
+            yield packet
+            played += 1
+            if played >= self.session.credit_batch:
+                self.session.credit(played)
+                played = 0
+        if self.session.error is not None:
+            raise IOError('playback worker failed: %s' % self.session.error)
+
+    def stop(self):
+        super().stop()
+        self.session.close()
+
+
+class PlaybackSession:
+    '''Main process end of one decoding in a playback worker
+
+    The pipe feeds the bytes of a piped session, the player sends the
+    frames coming back to the voice client.
+    '''
+
+    def __init__(self, worker, sid, guild, voice, *, piped, window, credit_batch, after=None):
+        self.worker = worker
+        self.sid = sid
+        self.guild = guild
+        self.credit_batch = credit_batch
+        self.frames = queue.Queue()
+        self.closed = False
+        self.error = None
+        self.pipe = WorkerPipe(self, window) if piped else None
+        self.player = WorkerPlayer(voice, self, after=after)
+
+    def credit(self, count):
+        if not self.closed:
+            self.worker.send((_CREDIT, self.sid, count))
+
+    def close(self):
+        '''Stop the decoding, the frames not played yet are dropped
+        '''
+        if not self.closed:
+            self.worker.send((_CLOSE, self.sid))
+        self._ended(None)
+
+    def _ended(self, error):
+        if self.closed:
+            return
+        self.closed = True
+        self.error = error
+        self.worker.sessions.pop(self.sid, None)
+        self.frames.put(None)
+        if self.pipe is not None:
+            self.pipe._wake()
+
+
+class _Worker:
+    '''Main process handle of one worker process
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        context = multiprocessing.get_context('spawn')
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child, index),
+                                       name='playback worker %d' % index, daemon=True)
+        self.process.start()
+        child.close()
+        self.sessions = {}
+        self.frames = 0
+        self.started = time.time()
+        self.dead = False
+        self._lock = threading.Lock()
+        self._receiver = threading.Thread(target=self._receive, name='playback worker %d receiver' % index,
+                                          daemon=True)
+        self._receiver.start()
+
+    @property
+    def alive(self):
+        return not self.dead and self.process.is_alive()
+
+    def send(self, message):
+        try:
+            with self._lock:
+                self.conn.send(message)
+        except (OSError, ValueError):
+            if not self.dead:
+                logger.exception('sending to playback worker %d failed' % self.index)
+            self.dead = True
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                self._dispatch(message)
+            except Exception:
+                logger.exception('playback worker %d message failed' % self.index)
+        if not self.dead:
+            logger.error('playback worker %d exited with %s' % (self.index, self.process.exitcode))
+        self.dead = True
+        for session in list(self.sessions.values()):
+            session._ended('worker exited')
+
+    def _dispatch(self, message):
+        kind, sid = message[0], message[1]
+        session = self.sessions.get(sid)
+        if session is None:
+            return
+        if kind == _FRAMES:
+            for packet in message[2]:
+                session.frames.put(packet)
+            self.frames += len(message[2])
+        elif kind == _TAKEN:
+            session.pipe._taken(message[2])
+        elif kind == _END:
+            session._ended(message[2])
+
+    def close(self):
+        if not self.dead:
+            self.dead = True
+            self.send((_SHUTDOWN, None))
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+    def __str__(self):
+        fmt = 'worker {0} (pid {1}): {2}, {3} sessions, {4} frames'
+        state = 'running' if self.alive else 'dead'
+        return fmt.format(self.index, self.process.pid, state, len(self.sessions), self.frames)
+
+
+class PlaybackWorkers:
+    '''Decode and encode the audio of the guilds in worker processes
+
+    The voice connections stay in the main process, which only paces the
+    Opus frames coming back. Every guild is sharded to one worker, the one
+    serving the fewest guilds when it first plays, and keeps it until
+    forgotten. Workers are started with the pool and again when one died.
+    '''
+    # bytes a piped session may hold ahead of ffmpeg
+    _window = 1024 * 1024
+    # frames of 20ms encoded ahead of playback
+    _frame_window = 150
+    _credit_batch = 25
+
+    def __init__(self, count, *, window=None, frame_window=None):
+        self.count = count
+        self.window = window if window is not None else self._window
+        self.frame_window = frame_window if frame_window is not None else self._frame_window
+        self.workers = [_Worker(index) for index in range(count)]
+        self.shards = {}
+        self._ids = itertools.count(1)
+
+    def _shard(self, guild):
+        index = self.shards.get(guild)
+        if index is None:
+            loads = [0] * self.count
+            for shard in self.shards.values():
+                loads[shard] += 1
+            index = loads.index(min(loads))
+            self.shards[guild] = index
+            logger.info('guild %s plays on worker %d' % (guild, index))
+        worker = self.workers[index]
+        if not worker.alive:
+            logger.warning('restarting playback worker %d' % index)
+            worker.close()
+            worker = self.workers[index] = _Worker(index)
+        return worker
+
+    def open(self, voice, guild, *, inputs=None, after=None):
+        '''Start decoding for guild, the files named by inputs one after
+        the other or the bytes written to the pipe of the PlaybackSession
+        when inputs is None
+        '''
+        worker = self._shard(guild)
+        session = PlaybackSession(worker, next(self._ids), guild, voice, piped=inputs is None,
+                                  window=self.window, credit_batch=self._credit_batch, after=after)
+        worker.sessions[session.sid] = session
+        worker.send((_OPEN, session.sid, inputs, self.frame_window))
+        return session
+
+    def forget(self, guild):
+        '''Let guild be sharded again on its next play
+        '''
+        self.shards.pop(guild, None)
+
+    async def close(self):
+        for worker in self.workers:
+            await run_io(worker.close)
+
+    def __str__(self):
+        lines = ['%d playback workers, %d guilds' % (self.count, len(self.shards))]
+        for worker in self.workers:
+            guilds = sum(1 for shard in self.shards.values() if shard == worker.index)
+            lines.append('%s, %d guilds' % (str(worker), guilds))
+        return '\n'.join(lines)
+
+
+class _WorkerSession:
+    '''Worker end of a session: ffmpeg decodes every input to PCM which is
+    encoded into Opus frames of 20ms
+    '''
+    _read_size = 4 * 3840
+
+    def __init__(self, server, sid, inputs, credit):
+        self.server = server
+        self.sid = sid
+        self.inputs = inputs
+        self.credit = credit
+        self.input = asyncio.Queue()
+        self.encoder = discord.opus.Encoder(_SAMPLING_RATE, _CHANNELS)
+        self.pcm = bytearray()
+        self.packets = []
+        self._credited = asyncio.Event()
+
+    def add_credit(self, count):
+        self.credit += count
+        self._credited.set()
+
+    async def run(self):
+        error = None
+        try:
+            for name in (self.inputs if self.inputs is not None else [None]):
+                await self._decode(name)
+            await self._send_packets(flush=True)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.exception('playback session %d failed' % self.sid)
+            error = str(e)
+        finally:
+            self.server.sessions.pop(self.sid, None)
+            self.server.send((_END, self.sid, error))
+
+    def _command(self, name):
+        return ['ffmpeg', '-i', name if name is not None else 'pipe:0',
+                '-f', 's16le', '-ar', str(_SAMPLING_RATE), '-ac', str(_CHANNELS), '-loglevel', 'warning', 'pipe:1']
+
+    async def _decode(self, name):
+        process = await asyncio.create_subprocess_exec(
+            *self._command(name),
+            stdin=asyncio.subprocess.PIPE if name is None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE)
+        feeder = asyncio.ensure_future(self._feed(process.stdin)) if name is None else None
+        try:
+            while True:
+                data = await process.stdout.read(self._read_size)
+                if len(data) == 0:
+                    break
+                self.pcm.extend(data)
+                self._encode()
+                await self._send_packets()
+            await process.wait()
+            if process.returncode != 0:
+                logger.warning('ffmpeg of session %d exited with %d' % (self.sid, process.returncode))
+        finally:
+            # once ffmpeg stopped the rest of the input is of no use
+            if feeder is not None:
+                feeder.cancel()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    async def _feed(self, stdin):
+        try:
+            while True:
+                data = await self.input.get()
+                if data is None:
+                    break
+                stdin.write(data)
+                await stdin.drain()
+                self.server.send((_TAKEN, self.sid, len(data)))
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning('ffmpeg of session %d closed its input' % self.sid)
+        finally:
+            stdin.close()
+
+    def _encode(self):
+        size = self.encoder.frame_size
+        while len(self.pcm) >= size:
+            self.packets.append(self.encoder.encode(bytes(self.pcm[:size]), self.encoder.samples_per_frame))
+            del self.pcm[:size]
+
+    async def _send_packets(self, flush=False):
+        if flush and len(self.pcm) > 0:
+            # pad the last partial frame with silence
+            self.pcm.extend(bytes(self.encoder.frame_size - len(self.pcm)))
+            self._encode()
+        while len(self.packets) > 0:
+            while self.credit <= 0:
+                self._credited.clear()
+                await self._credited.wait()
+            count = min(self.credit, len(self.packets))
+            self.server.send((_FRAMES, self.sid, self.packets[:count]))
+            del self.packets[:count]
+            self.credit -= count
+
+
+class _WorkerServer:
+    '''Event loop of a worker process serving the sessions of its guilds
+    '''
+
+    def __init__(self, conn, index, loop):
+        self.conn = conn
+        self.index = index
+        self.loop = loop
+        self.sessions = {}
+        self.tasks = {}
+        self._stopped = asyncio.Event()
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+        except (OSError, ValueError):
+            logger.exception('playback worker %d lost the main process' % self.index)
+            self._stopped.set()
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                message = (_SHUTDOWN, None)
+            self.loop.call_soon_threadsafe(self._dispatch, message)
+            if message[0] == _SHUTDOWN:
+                return
+
+    def _dispatch(self, message):
+        kind, sid = message[0], message[1]
+        if kind == _SHUTDOWN:
+            self._stopped.set()
+        elif kind == _OPEN:
+            session = _WorkerSession(self, sid, message[2], message[3])
+            self.sessions[sid] = session
+            task = self.loop.create_task(session.run())
+            self.tasks[sid] = task
+            task.add_done_callback(lambda task: self._finished(sid))
+        elif sid in self.sessions:
+            session = self.sessions[sid]
+            if kind == _DATA:
+                session.input.put_nowait(message[2])
+            elif kind == _EOF:
+                session.input.put_nowait(None)
+            elif kind == _CREDIT:
+                session.add_credit(message[2])
+            elif kind == _CLOSE:
+                self.tasks[sid].cancel()
+
+    def _finished(self, sid):
+        self.tasks.pop(sid, None)
+        self.sessions.pop(sid, None)
+
+    async def serve(self):
+        receiver = threading.Thread(target=self._receive, daemon=True)
+        receiver.start()
+        await self._stopped.wait()
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _worker_main(conn, index):
+    logging.basicConfig(level=logging.INFO)
+    if not discord.opus.is_loaded():
+        discord.opus.load_opus('opus')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = _WorkerServer(conn, index, loop)
+    try:
+        loop.run_until_complete(server.serve())
+    finally:
+        loop.close()
+        conn.close()
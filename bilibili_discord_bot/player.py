@@ -2,11 +2,14 @@ import aiohttp
 import asyncio
 import io
 import os
+import errno
 import queue
 import shutil
 import logging
 import inspect
+import itertools
 import re
+import time
 from os import path
 # for setting pipe buffer size
 try:
@@ -18,12 +21,25 @@ except:
 from .common import *
 # for segments downloader
 from .bilibili_api import VideoSegmentDownloader
+from .download_scheduler import LIVE, get_download_scheduler
+from .jitter_buffer import JitterBuffer, stream_bitrate
 # for bilibili data classes
 from .bilibili_data import *
-# for unblocked file io
+# for write behind of the cache file
 from .buffered_writer import FileWriter
+# for sharing one download between the pipe, the cache and listeners
+from .fanout_buffer import FanoutBuffer, FanoutReader, ReaderDetached
+# for resuming interrupted downloads
+from .download_journal import SegmentJournal
+# for checking the cached segments
+from .cache_verify import verify_segment
+# for the file operations and the segment JSON, not the pipe feeding
+from .executors import run_io, run_pipe
+from .simple_ffmpeg import PLAYBACK
+# for playing pre transcoded audio
+from .opus_player import OpusFilePlayer, OPUS_FILE_NAME, opus_packet_duration
 # for database update
-from .db import VideoDatabase, VideoStatus
+from .db import VideoStatus
 
 logger = logging.getLogger(__name__)
 
@@ -41,20 +57,113 @@ def save_to_file(file_name, content):
             content.close()
 
 
+class PipeSink:
+    '''File like wrapper around the player pipe for one segment
+
+    Drops the first skip bytes (the FLV header of a later segment when all
+    segments share one pipe).
+    '''
+
+    # sendfile into a pipe only works on linux
+    _zero_copy = hasattr(os, 'sendfile') and is_linux()
+    _sendfile_size = 1024 * 1024
+
+    def __init__(self, pin, *, skip=0):
+        self.pin = pin
+        self.skip = skip
+
+    def write(self, data):
+        if self.skip > 0:
+            data, self.skip = data[self.skip:], max(0, self.skip - len(data))
+            if len(data) == 0:
+                return
+        self.pin.write(data)
+
+    def copy_file(self, fin, start=0, end=None, block_size=32 * 4096):
+        '''Copy bytes [start, end) of the file object fin into the pipe
+
+        On linux the bytes go from the page cache to the pipe with sendfile
+        without passing through python buffers, elsewhere (or when sendfile
+        is refused) they are copied block by block.
+        '''
+        size = os.fstat(fin.fileno()).st_size
+        end = size if end is None else min(end, size)
+        skipped = min(self.skip, max(0, end - start))
+        self.skip -= skipped
+        offset = start + skipped
+        if offset >= end:
+            return
+        if self._zero_copy and hasattr(self.pin, 'fileno'):
+            offset = self._sendfile(fin, offset, end)
+        fin.seek(offset)
+        remaining = end - offset
+        while remaining > 0:
+            data = fin.read(min(block_size, remaining))
+            if len(data) == 0:
+                break
+            self.pin.write(data)
+            remaining -= len(data)
+
+    def _sendfile(self, fin, offset, end):
+        '''Send [offset, end) of fin, return where the copy stopped
+        '''
+        self.pin.flush()
+        out_fd = self.pin.fileno()
+        in_fd = fin.fileno()
+        while offset < end:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, min(self._sendfile_size, end - offset))
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                logger.info('sendfile to pipe not supported, copying instead')
+                PipeSink._zero_copy = False
+                break
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+
+
 class DiscordPlayer:
     '''Base class for bilibili player
+
+    With gapless all segments are decoded by one ffmpeg process instead of
+    one process per segment. The silence between the last audio of one
+    segment and the first audio of the next, measured as the frames are sent
+    to Discord, is recorded in transition_gaps either way. With
+    workers, a PlaybackWorkers, the decoding runs in the worker process of
+    guild instead of an ffmpeg player of this process.
     '''
     _page_size = 4096
     _block_size = 32 * _page_size
     _pipe_buffer_size = 256 * _page_size
-
-    def __init__(self, voice, loop, segments, after, *, video_info=None, path=None, **kwargs):
+    # FLV file header and the first PreviousTagSize
+    _flv_header_size = 13
+    # 48kHz 16 bit stereo, the PCM play_audio encodes
+    _pcm_bytes_per_second = 48000 * 2 * 2
+    # audio on both sides of a segment end searched for the gap when one
+    # player plays several segments
+    _boundary_window = 0.5
+
+    def __init__(self, voice, loop, segments, after, *, video_info=None, path=None, gapless=False, guild=None,
+                 workers=None, **kwargs):
         self.voice = voice
         self.loop = loop if loop is not None else asyncio.get_event_loop()
         self.segments = segments
         self.after = after
         self.video_info = video_info
         self.path = path
+        self.gapless = gapless
+        self.guild = guild
+        self.workers = workers
+        self.transition_gaps = []
+        # wall clock time the audio sent so far ends playing
+        self._audio_end = None
+        self._output_time = 0
+        self._boundaries = []
+        self._boundary_gap = 0
+        self._new_output = False
 
         self.finish_event = asyncio.Event()
         self.task = None
@@ -79,6 +188,10 @@ class DiscordPlayer:
             logger.exception('player called after failed')
 
     def _create_piped_player(self):
+        if self.workers is not None:
+            session = self.workers.open(self.voice, self.guild, after=self._after_callback)
+            self.player = session.player
+            return session.pipe
         pipeout, pipein = os.pipe()
         self._set_pipe_buffer_size(pipein, self._pipe_buffer_size)
         self._set_pipe_buffer_size(pipeout, self._pipe_buffer_size)
@@ -86,12 +199,78 @@ class DiscordPlayer:
             os.fdopen(pipeout, 'rb'), pipe=True, after=self._after_callback)
         return os.fdopen(pipein, 'wb')
 
+    def _can_pipe_gapless(self):
+        '''FLV segments stay decodable when concatenated in one pipe
+        '''
+        return all(segment.format == 'flv' for segment in self.segments)
+
+    def _start_player(self, segments):
+        '''Start self.player, which plays segments one after the other
+
+        Every frame it sends to Discord goes through _audio_out first.
+        '''
+        self._output_time = 0
+        self._boundaries = list(itertools.accumulate(segment.length / 1000 for segment in segments[:-1]))
+        self._boundary_gap = 0
+        self._new_output = True
+        send = self.player.player
+
+        def play_audio(data, *, encode=True):
+            self._audio_out(data, encode)
+            return send(data, encode=encode)
+        self.player.player = play_audio
+        self.player.start()
+
+    def _audio_out(self, data, encode):
+        '''Measure the segment transitions as the audio leaves, called from
+        the thread of the player
+
+        The gap after a player is the silence from its last audio to the
+        first audio of the next one. Within one player it is the longest
+        silence around the end of a segment on the audio timeline.
+        '''
+        now = time.time()
+        silence = max(0, now - self._audio_end) if self._audio_end is not None else 0
+        if self._new_output:
+            self._new_output = False
+            if self._audio_end is not None:
+                self._transition(silence)
+        elif len(self._boundaries) > 0 and self._output_time >= self._boundaries[0] - self._boundary_window:
+            self._boundary_gap = max(self._boundary_gap, silence)
+            if self._output_time >= self._boundaries[0] + self._boundary_window:
+                self._boundaries.pop(0)
+                self._transition(self._boundary_gap)
+                self._boundary_gap = 0
+        duration = len(data) / self._pcm_bytes_per_second if encode else opus_packet_duration(data)
+        self._output_time += duration
+        self._audio_end = max(now, self._audio_end or now) + duration
+
+    def _transition(self, gap):
+        self.transition_gaps.append(gap)
+        logger.info('segment transition %d gap: %.3fs' % (len(self.transition_gaps), gap))
+
+    def _segment_sink(self, idx):
+        '''Sink for the idx-th segment in the current pipe
+        '''
+        skip = self._flv_header_size if self.gapless and idx > 0 else 0
+        return PipeSink(self.pin, skip=skip)
+
+    def gap_report(self):
+        if len(self.transition_gaps) == 0:
+            return 'no segment transitions'
+        fmt = '{0} transitions, max gap {1:.3f}s, total {2:.3f}s'
+        return fmt.format(len(self.transition_gaps), max(self.transition_gaps), sum(self.transition_gaps))
+
+    async def _wait_finish(self):
+        await self.finish_event.wait()
+        self.finish_event.clear()
+
     async def run(self):
         logger.info('start running of discord player')
         try:
             self.task = self.loop.create_task(self._task())
             await self.task
-        except CancelledError:
+        except asyncio.CancelledError:
             logger.info('player task have been cancelled')
         except:
             logger.exception('player task running failed')
@@ -99,6 +278,7 @@ class DiscordPlayer:
     async def _task(self):
         self.finish_event.clear()
         await self._do_run()
+        logger.info('%s: %s' % (self.title, self.gap_report()))
 
     def _call_after(self):
         if self.after is not None:
@@ -128,7 +308,7 @@ class DiscordPlayer:
     @property
     def title(self):
         if self.video_info is not None:
-            return self.video_info.title
+            return self.video_info.full_title
         return ''
 
     @property
@@ -152,78 +332,334 @@ class BiliLocalPlayer(DiscordPlayer):
         super().__init__(voice, loop, segments, after,
                          video_info=video_info, path=path, **kwargs)
 
-    def _feedFile(self, segment):
+    def _feedFile(self, segment, sink):
         logger.info('local player feed file started for segment: %s' %
                     str(segment))
         file_name = path.join(self.path, segment.file_name)
         try:
             with open(file_name, 'rb') as fin:
-                shutil.copyfileobj(fin, self.pin)
+                sink.copy_file(fin, block_size=self._block_size)
         except:
             logger.exception('feed file failed')
 
+    def _write_concat_list(self):
+        list_file = path.join(self.path, 'concat.txt')
+        with open(list_file, 'w') as f:
+            for segment in self.segments:
+                f.write("file '%s'\n" % segment.file_name)
+        return list_file
+
     async def _do_run(self):
         logger.info('start local player')
-        for segment in self.segments:
+        opus_file = path.join(self.path, OPUS_FILE_NAME)
+        if hasattr(self.voice, 'play_audio') and path.exists(opus_file):
+            await self._do_run_opus(opus_file)
+        elif self.workers is not None:
+            await self._do_run_worker()
+        elif self.gapless and self._can_pipe_gapless():
+            await self._do_run_pipe()
+        elif self.gapless:
+            await self._do_run_concat()
+        else:
+            await self._do_run_segments()
+
+    async def _do_run_segments(self):
+        for idx, segment in enumerate(self.segments):
             self.pin = self._create_piped_player()
-            self.player.start()
-            await self.loop.run_in_executor(None, self._feedFile, segment)
+            self._start_player([segment])
+            await run_pipe(self._feedFile, segment, self._segment_sink(idx))
             self.pin.close()
-            await self.finish_event.wait()
+            await self._wait_finish()
+
+    async def _do_run_pipe(self):
+        '''Feed every segment into the pipe of one ffmpeg process
+        '''
+        self.pin = self._create_piped_player()
+        self._start_player(self.segments)
+        for idx, segment in enumerate(self.segments):
+            await run_pipe(self._feedFile, segment, self._segment_sink(idx))
+        self.pin.close()
+        await self._wait_finish()
+
+    async def _do_run_opus(self, opus_file):
+        '''Send the pre transcoded Opus packets without starting ffmpeg
+        '''
+        logger.info('local player streams pre transcoded %s' % opus_file)
+        self.player = OpusFilePlayer(self.voice, opus_file, after=self._after_callback)
+        self.player.start()
+        await self._wait_finish()
+
+    async def _do_run_worker(self):
+        '''Let a playback worker read and decode the segments one after the
+        other, its frames carry on across segments without a gap
+        '''
+        inputs = [path.join(self.path, segment.file_name) for segment in self.segments]
+        session = self.workers.open(self.voice, self.guild, inputs=inputs, after=self._after_callback)
+        self.player = session.player
+        self._start_player(self.segments)
+        await self._wait_finish()
+
+    async def _do_run_concat(self):
+        '''Let the ffmpeg concat demuxer join segments that cannot share a pipe
+        '''
+        list_file = await run_io(self._write_concat_list, priority=PLAYBACK)
+        self.player = self.voice.create_ffmpeg_player(
+            list_file, before_options='-f concat -safe 0', after=self._after_callback)
+        self._start_player(self.segments)
+        await self._wait_finish()
 
 
 class BiliOnlinePlayer(DiscordPlayer):
     '''Online Player for bilibili
+
+    A segment is downloaded once into a FanoutBuffer. The player pipe reads
+    it as fast as ffmpeg takes it and holds the download back when it falls
+    behind, the cache file and other players following the segment read it
+    on their own and are cut off if they lag more than the buffer size.
     '''
+    _tail_interval = 0.2
+    _buffer_size = 4 * 1024 * 1024
     _bili_address = 'https://www.bilibili.com'
     _user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.117 Safari/537.36'
 
-    def __init__(self, voice, loop, segments, ref_url, after, *, video_info=None, path=path, **kwargs):
+    def __init__(self, voice, loop, segments, ref_url, after, *, session, db=None, video_info=None, path=path,
+                 cached=None, page=1, guild=None, **kwargs):
+        '''db is the AsyncVideoDatabase the cached segments of page are
+        recorded in, cached is called once every segment has been saved to
+        the cache. The download is scheduled as live for guild
+        '''
         super().__init__(voice, loop, segments, after,
-                         video_info=video_info, path=path, **kwargs)
+                         video_info=video_info, path=path, guild=guild, **kwargs)
         logger.info('created online player for %s' % ref_url)
         self.segments = segments
         self.url = ref_url
-        self.session = aiohttp.ClientSession()
+        self.session = session
+        self.cached = cached
+        self.db = db
+        self.page = page
+        self.download_task = None
+        self.jitter = JitterBuffer(stream_bitrate(segments), name=ref_url)
+
+    def _feed_cached(self, file_name, start, end, sink):
+        '''Feed bytes [start, end) of a segment that is (partly) in the cache
+        '''
+        logger.info('online player feed cached bytes %d-%d from %s' % (start, end, file_name))
+        with open(file_name, 'rb') as fin:
+            sink.copy_file(fin, start, end, self._block_size)
+
+    async def _follow_buffer(self, buffer, fed, sink):
+        '''Read a running download from byte fed, return where it stopped
+        or None when the bytes at fed already left the buffer
+        '''
+        reader = buffer.reader(FanoutReader.DETACH, 'listener', fed)
+        if reader is None:
+            return None
+        logger.info('online player listens to the download of %s from %d' % (buffer.name, fed))
+        try:
+            while True:
+                data = await reader.read()
+                if len(data) == 0:
+                    break
+                await run_pipe(sink.write, data)
+        except ReaderDetached:
+            logger.info('listener fell behind, following the cache file instead')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('followed download failed')
+        finally:
+            reader.close()
+        return reader.position
+
+    async def _tail_segment(self, file_name, sink):
+        '''Follow a segment that another task is downloading into the cache
+
+        Bytes already on disk are fed from the cache file, then the running
+        download is read from its buffer. Returns how many bytes were fed
+        once that download stops.
+        '''
+        logger.info('online player follows download of %s' % file_name)
+        fed = 0
+        while True:
+            journal = SegmentJournal.active(file_name)
+            if journal is None:
+                return fed
+            available = journal.prefix()
+            if available > fed:
+                await run_pipe(self._feed_cached, file_name, fed, available, sink)
+                fed = available
+                continue
+            buffer = FanoutBuffer.active(file_name)
+            position = await self._follow_buffer(buffer, fed, sink) if buffer is not None else None
+            if position is not None and position > fed:
+                fed = position
+            else:
+                await asyncio.sleep(self._tail_interval)
+
+    async def _pipe_reader(self, reader, sink):
+        try:
+            while True:
+                await self.jitter.ready(reader)
+                data = await reader.read()
+                if len(data) == 0:
+                    break
+                await run_pipe(sink.write, data)
+                self.jitter.fed(len(data))
+        finally:
+            reader.close()
+
+    async def _cache_reader(self, reader, segment, file_name, journal):
+        '''Write the segment into the cache without ever holding up the pipe
+
+        When the disk cannot keep up the reader is detached, the journal
+        keeps what was written and a later play resumes from there.
+        '''
+        try:
+            writer = await run_io(lambda: FileWriter(
+                file_name, size=segment.size, offset=reader.position, journal=journal, loop=self.loop))
+        except OSError:
+            logger.exception('open %s for caching failed' % file_name)
+            reader.close()
+            return
+        try:
+            while True:
+                data = await reader.read()
+                if len(data) == 0:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ReaderDetached:
+            logger.warning('cache writer of %s fell behind at %d, caching stopped' % (file_name, reader.position))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('caching %s failed' % file_name)
+        finally:
+            reader.close()
+            try:
+                await run_io(writer.close)
+            except OSError:
+                logger.exception('closing cache file %s failed' % file_name)
+
+    async def _tee_segment(self, segment, file_name, journal, offset, sink):
+        '''Download the segment from offset once for the pipe and the cache
+        '''
+        buffer = FanoutBuffer(self._buffer_size, start=offset, name=file_name)
+        pipe_reader = buffer.reader(FanoutReader.BLOCK, 'player')
+        cache_reader = buffer.reader(FanoutReader.DETACH, 'cache')
+        downloader = VideoSegmentDownloader(
+            self.url, self.session, segment, self.loop, task=self.download_task)
+        logger.info('online player download started from %d' % offset)
+        tasks = [
+            self.loop.create_task(downloader.stream(buffer, offset=offset)),
+            self.loop.create_task(self._pipe_reader(pipe_reader, sink)),
+            self.loop.create_task(self._cache_reader(cache_reader, segment, file_name, journal)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            buffer.close()
+
+    async def _stream_segment(self, segment, sink):
+        '''Stream one segment into sink, teeing it into the cache
+
+        When another task is already downloading the segment its bytes are
+        followed instead, and whatever it left missing is downloaded
+        afterwards.
+        '''
+        logger.info('start online player for %s' % str(segment))
+        if self.path is None:
+            downloader = VideoSegmentDownloader(
+                self.url, self.session, segment, self.loop, task=self.download_task)
+            await downloader.download(sink)
+            return
+
+        file_name = path.join(self.path, segment.file_name)
+        fed = 0
+        if SegmentJournal.active(file_name) is not None:
+            fed = await self._tail_segment(file_name, sink)
+        journal = await SegmentJournal.acquire(file_name, segment.size, priority=PLAYBACK)
+        try:
+            offset = journal.prefix()
+            if offset > fed:
+                await run_pipe(self._feed_cached, file_name, fed, offset, sink)
+            elif offset < fed:
+                # already played, do not feed it twice
+                sink.skip += fed - offset
+            if not journal.is_complete():
+                await self._tee_segment(segment, file_name, journal, offset, sink)
+        finally:
+            journal.release()
 
     async def _do_download(self):
-        for segment in self.segments:
-            logger.info('start online player for %s' % str(segment))
-            f = None
-            if self.path is not None:
-                file_name = path.join(self.path, segment.file_name)
-                f = FileWriter(file_name)
+        total = sum(segment.size or 0 for segment in self.segments)
+        self.download_task = get_download_scheduler().task(self.title or self.url, LIVE, guild=self.guild, total=total)
+        if self.gapless and self._can_pipe_gapless():
+            await self.download_task.run(self._do_download_pipe())
+        else:
+            await self.download_task.run(self._do_download_segments())
+        if await self._write_segments(self.segments) and self.cached is not None:
+            self.cached()
+
+    async def _do_download_segments(self):
+        for idx, segment in enumerate(self.segments):
             try:
                 self.pin = self._create_piped_player()
-                downloader = VideoSegmentDownloader(
-                    self.url, self.session, segment, self.loop)
-                logger.info('online player download started')
-                self.player.start()
-                await downloader.download(self.pin, f)
+                self.jitter.new_pipe()
+                self._start_player([segment])
+                await self._stream_segment(segment, self._segment_sink(idx))
                 self.pin.close()
-                await self.finish_event.wait()
-            except CancelledError:
-                return
+                await self._wait_finish()
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logger.exception('online player failed')
-            finally:
-                if f is not None:
-                    f.close()
-
-        await self.loop.run_in_executor(None, self._write_segments, self.segments)
-
-    def _write_segments(self, segments):
-        if self.path is None:
-            return
 
-        db = VideoDatabase()
-        aid = int(re.search(r'av(\d+)', url).group(1))
-        seg_json = json.dumps(segments, default=obj_dict)
-        db.update_segmentinfo(aid, seg_json)
+    async def _do_download_pipe(self):
+        '''Stream every segment into the pipe of one ffmpeg process
+        '''
+        self.pin = self._create_piped_player()
+        self.jitter.new_pipe()
+        self._start_player(self.segments)
+        for idx, segment in enumerate(self.segments):
+            try:
+                await self._stream_segment(segment, self._segment_sink(idx))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('online player failed')
+        self.pin.close()
+        await self._wait_finish()
+
+    async def _verify_segments(self, segments):
+        '''All segments are fully cached, recording their checksums
+        '''
+        for segment in segments:
+            file_name = path.join(self.path, segment.file_name)
+            error, checksum = await run_io(verify_segment, file_name, segment.size)
+            if error is not None:
+                logger.info('%s is not cached: %s' % (file_name, error))
+                return False
+            segment.checksum = checksum
+        return True
+
+    async def _write_segments(self, segments):
+        if self.path is None or self.db is None:
+            return False
+        if not await self._verify_segments(segments):
+            return False
+
+        aid = int(re.search(r'av(\d+)', self.url).group(1))
+        seg_json = segments_to_json(segments)
+        await self.db.update_segmentinfo(aid, seg_json, self.page)
+        return True
 
     async def _do_run(self):
         logger.info('start online player')
-        await self._do_download()
-
-    def __del__(self):
-        self.loop.call_soon(self.session.close)
+        try:
+            await self._do_download()
+        finally:
+            logger.info('%s: jitter buffer %s' % (self.title, self.jitter.report()))
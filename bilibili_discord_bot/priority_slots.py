@@ -0,0 +1,76 @@
+import asyncio
+import heapq
+import itertools
+
+
+async def await_slot(future, release):
+    '''Wait until future is set, the slot is then handed over
+
+    A cancel that comes right after the hand over gives the slot back with
+    release().
+    '''
+    try:
+        await future
+    except asyncio.CancelledError:
+        if future.done() and not future.cancelled():
+            release()
+        raise
+
+
+class PrioritySlots:
+    '''At most max_jobs jobs at once, the waiting ones start by priority
+    and then in submission order
+
+    A waiting job can be moved up with promote() when it becomes more
+    urgent, such as a background transcode that a prefetch now waits for.
+    '''
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.running = 0
+        self.max_depth = 0
+        self._waiting = []
+        self._tickets = {}
+        self._counter = itertools.count()
+
+    @property
+    def depth(self):
+        '''Jobs waiting for a slot
+        '''
+        # a promoted job has an entry per priority
+        return len(set(future for priority, order, future in self._waiting if not future.done()))
+
+    async def acquire(self, priority, ticket=None):
+        '''Wait for a slot, ticket names the job for promote()
+        '''
+        if self.running < self.max_jobs and self.depth == 0:
+            self.running += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._counter), future))
+        if ticket is not None:
+            self._tickets[ticket] = future
+        self.max_depth = max(self.max_depth, self.depth)
+        try:
+            await await_slot(future, self.release)
+        finally:
+            if ticket is not None and self._tickets.get(ticket) is future:
+                del self._tickets[ticket]
+
+    def promote(self, ticket, priority):
+        '''Move the job waiting with ticket up to priority, nothing happens
+        when it is not waiting
+        '''
+        future = self._tickets.get(ticket)
+        if future is not None and not future.done():
+            # the old entry is skipped once the future is set
+            heapq.heappush(self._waiting, (priority, next(self._counter), future))
+
+    def release(self):
+        while len(self._waiting) > 0:
+            priority, order, future = heapq.heappop(self._waiting)
+            if not future.done():
+                # the slot goes to the next job, running stays the same
+                future.set_result(None)
+                return
+        self.running -= 1
@@ -0,0 +1,182 @@
+import time
+import asyncio
+import sqlite3
+import logging
+from urllib.parse import urlparse
+from .common import size2str
+
+logger = logging.getLogger(__name__)
+
+# qn of the flv streams served by the playurl api, best first
+QN_1080P = 80
+QN_720P = 64
+QN_480P = 32
+QN_360P = 16
+QUALITIES = (QN_1080P, QN_720P, QN_480P, QN_360P)
+# the audio only DASH stream, not a qn of the api
+QN_AUDIO = 30000
+
+
+class ThroughputHistory:
+    '''Throughput of every CDN host measured by the downloads
+
+    Each host keeps an exponentially weighted average of the bytes per
+    second of one connection, written through to the throughput table so a
+    restarted bot picks the quality right away.
+    '''
+    _alpha = 0.3
+    # smaller transfers are mostly latency
+    _min_bytes = 512 * 1024
+
+    def __init__(self, db=None):
+        self.db = db
+        # host -> (speed, samples, updated)
+        self.hosts = {}
+        self.last_host = None
+
+    async def attach(self, db):
+        '''Load the persisted measurements from the AsyncVideoDatabase db and
+        write the new ones to it
+        '''
+        self.db = db
+        try:
+            rows = await db.get_throughputs()
+        except sqlite3.Error:
+            logger.exception('loading the throughput history failed')
+            return
+        for row in rows:
+            self.hosts.setdefault(row['host'], (row['speed'], row['samples'], row['updated']))
+        if self.last_host is None and len(self.hosts) > 0:
+            self.last_host = max(self.hosts, key=lambda host: self.hosts[host][2])
+
+    def record(self, url, length, speed):
+        '''Add a transfer of length bytes from url at speed bytes per second
+        '''
+        if length < self._min_bytes or speed <= 0:
+            return
+        host = urlparse(url).hostname
+        if host is None:
+            return
+        old = self.hosts.get(host)
+        samples = 1
+        if old is not None:
+            speed = old[0] + self._alpha * (speed - old[0])
+            samples = old[1] + 1
+        self.hosts[host] = (speed, samples, time.time())
+        self.last_host = host
+        logger.info('throughput of %s: %s' % (host, size2str(speed, 'B/s')))
+        if self.db is not None:
+            asyncio.ensure_future(self._save(host))
+
+    async def _save(self, host):
+        try:
+            await self.db.update_throughput(host, *self.hosts[host])
+        except sqlite3.Error:
+            logger.exception('saving the throughput of %s failed' % host)
+
+    def get(self, url=None):
+        '''Expected bytes per second from the host of url, or from the host
+        measured last without url, None when it was never measured
+        '''
+        host = urlparse(url).hostname if url is not None else self.last_host
+        entry = self.hosts.get(host)
+        return entry[0] if entry is not None else None
+
+    def __str__(self):
+        hosts = sorted(self.hosts.items(), key=lambda item: -item[1][2])
+        return ', '.join('%s %s (%d)' % (host, size2str(speed, 'B/s'), samples)
+                         for host, (speed, samples, updated) in hosts)
+
+
+_history = None
+
+
+def get_throughput_history():
+    '''The process wide ThroughputHistory
+    '''
+    global _history
+    if _history is None:
+        _history = ThroughputHistory()
+    return _history
+
+
+class QualitySelector:
+    '''Choose the qn asked from the playurl api
+
+    In auto mode it is the best qn whose bitrate the measured throughput of
+    the CDN host sustains with headroom. Audio mode asks for the audio only
+    DASH stream and, where it is not served, for the smallest flv stream that
+    still carries full quality audio. A number is a fixed qn.
+    '''
+    AUTO = 'auto'
+    AUDIO = 'audio'
+    # bits per second of every qn until playurl responses tell better
+    _bitrates = {QN_1080P: 3000000, QN_720P: 1500000, QN_480P: 700000, QN_360P: 350000}
+    # below 480p the flv audio is encoded with a lower bitrate too
+    _audio_qn = QN_480P
+    _default_qn = QN_1080P
+    _headroom = 2.0
+    _alpha = 0.3
+
+    def __init__(self, mode=None, *, history=None, headroom=None):
+        '''mode is auto, audio or a qn, history the ThroughputHistory to use
+        '''
+        mode = mode if mode is not None else self.AUDIO
+        if mode not in (self.AUTO, self.AUDIO):
+            mode = int(mode)
+        self.mode = mode
+        self.history = history if history is not None else get_throughput_history()
+        self.headroom = headroom if headroom is not None else self._headroom
+        self.bitrates = dict(self._bitrates)
+
+    def fits(self, qn, speed):
+        return self.bitrates[qn] / 8 * self.headroom <= speed
+
+    def _best(self, speed):
+        if speed is None:
+            return self._default_qn
+        for qn in QUALITIES:
+            if self.fits(qn, speed):
+                return qn
+        return QUALITIES[-1]
+
+    def pick(self):
+        '''The qn for the next playurl request
+        '''
+        if self.mode == self.AUDIO:
+            return QN_AUDIO
+        if self.mode != self.AUTO:
+            return self.mode
+        return self._best(self.history.get())
+
+    def fallback(self):
+        '''The flv qn used when the audio only stream is not served
+        '''
+        if self.mode == self.AUTO:
+            return self._best(self.history.get())
+        return self._audio_qn
+
+    def adjust(self, data):
+        '''Learn the bitrate from a playurl response and return a lower qn
+        when the host it points to is too slow for it, None otherwise
+        '''
+        qn = data.get('quality')
+        durls = data.get('durl', [])
+        if qn not in self.bitrates or len(durls) == 0:
+            return None
+        length = sum(durl['length'] for durl in durls)
+        if length > 0:
+            bitrate = sum(durl['size'] for durl in durls) * 8 * 1000 / length
+            self.bitrates[qn] += self._alpha * (bitrate - self.bitrates[qn])
+        if self.mode != self.AUTO:
+            return None
+        best = self._best(self.history.get(durls[0]['url']))
+        if best < qn:
+            logger.info('%s too slow for qn %d, switching to %d' % (urlparse(durls[0]['url']).hostname, qn, best))
+            return best
+        return None
+
+    def __str__(self):
+        speed = self.history.get()
+        fmt = 'quality {0}, next qn {1}, last host {2}'
+        return fmt.format(self.mode, self.pick(), size2str(speed, 'B/s') if speed is not None else 'unmeasured')
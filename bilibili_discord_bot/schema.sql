@@ -1,8 +1,32 @@
-DROP TABLE IF EXISTS video;
-
-CREATE TABLE video(
-  aid INTEGER PRIMARY KEY,
+CREATE TABLE IF NOT EXISTS video(
+  aid INTEGER NOT NULL,
+  page INTEGER NOT NULL DEFAULT 1,
   status INTEGER NOT NULL,
   videoinfo TEXT,
-  segmentinfo TEXT
+  segmentinfo TEXT,
+  PRIMARY KEY (aid, page)
+);
+
+CREATE TABLE IF NOT EXISTS metadata(
+  aid INTEGER NOT NULL,
+  page INTEGER NOT NULL,
+  qn INTEGER NOT NULL,
+  data TEXT NOT NULL,
+  expires REAL NOT NULL,
+  PRIMARY KEY (aid, page, qn)
+);
+
+CREATE TABLE IF NOT EXISTS cache(
+  aid INTEGER PRIMARY KEY,
+  size INTEGER NOT NULL DEFAULT 0,
+  last_played REAL NOT NULL DEFAULT 0,
+  play_count INTEGER NOT NULL DEFAULT 0,
+  pinned INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS throughput(
+  host TEXT PRIMARY KEY,
+  speed REAL NOT NULL,
+  samples INTEGER NOT NULL,
+  updated REAL NOT NULL
 );
@@ -0,0 +1,56 @@
+import aiohttp
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager:
+    '''Own the aiohttp ClientSession shared by all API, page and CDN requests
+
+    One pooled connector keeps connections to the bilibili hosts alive
+    between commands and caches DNS lookups. The session is created on first
+    use and has to be released with close().
+    '''
+    _limit = 64
+    _limit_per_host = 8
+    _keepalive_timeout = 60
+    _dns_cache_ttl = 300
+
+    def __init__(self, *, limit=None, limit_per_host=None):
+        self.limit = limit if limit is not None else self._limit
+        self.limit_per_host = limit_per_host if limit_per_host is not None else self._limit_per_host
+        self._session = None
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self._keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self._dns_cache_ttl,
+        )
+        logger.info('create shared client session limit: %d per host: %d' %
+                    (self.limit, self.limit_per_host))
+        return aiohttp.ClientSession(connector=connector)
+
+    def get(self):
+        '''Return the shared session, creating it if needed
+        '''
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    @property
+    def session(self):
+        return self.get()
+
+    async def close(self):
+        if self._session is None:
+            return
+        session, self._session = self._session, None
+        if not session.closed:
+            logger.info('closing shared client session')
+            await session.close()
+            # give the ssl transports a chance to shut down
+            await asyncio.sleep(0.25)
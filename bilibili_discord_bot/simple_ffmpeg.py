@@ -1,64 +1,203 @@
-import subprocess
-import threading
 import asyncio
+import collections
 import logging
+import os
 from os import path
 from .common import *
+from .priority_slots import PrioritySlots
 
 logger = logging.getLogger(__name__)
 
-class FFMpegRunner(threading.Thread):
-    def __init__(self, input_file=None, output_file=None, args=None, *, after=None):
+# job priorities, lower runs first
+PLAYBACK = 0
+INTERACTIVE = 1
+BACKGROUND = 2
+
+
+class FFMpegScheduler(PrioritySlots):
+    '''Limit the ffmpeg processes running at once, starting the waiting
+    jobs by priority and then in submission order
+    '''
+    _max_jobs = os.cpu_count() or 2
+
+    def __init__(self, max_jobs=None):
+        super().__init__(max_jobs if max_jobs is not None else self._max_jobs)
+        self.finished = 0
+
+    async def run(self, runner):
+        await self.acquire(runner.priority, ticket=runner)
+        try:
+            return await runner._execute()
+        finally:
+            self.release()
+            self.finished += 1
+            logger.info(str(self))
+
+    def __str__(self):
+        fmt = 'ffmpeg scheduler: {0}/{1} running, {2} waiting (max {3}), {4} finished'
+        return fmt.format(self.running, self.max_jobs, self.depth, self.max_depth, self.finished)
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    '''The process wide FFMpegScheduler
+    '''
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = FFMpegScheduler()
+    return _scheduler
+
+
+class FFMpegRunner:
+    '''One ffmpeg job run as an asyncio subprocess
+
+    await run() queues the job on the scheduler and returns the exit code.
+    Cancelling it, or running past timeout seconds, kills ffmpeg. Progress
+    reported by ffmpeg on -progress pipe:1 is kept in progress_info and
+    passed to the progress callback as it arrives.
+    '''
+    _ffmpeg = 'ffmpeg'
+    _stderr_lines = 20
+
+    def __init__(self, input_file=None, output_file=None, args=None, *, priority=BACKGROUND, timeout=None,
+                 progress=None):
         self.input_file = input_file
         self.output_file = output_file
         self.args = args
-        self.after = after
-        super().__init__()
+        self.priority = priority
+        self.timeout = timeout
+        self.progress = progress
+        self.progress_info = {}
+        self.returncode = None
+        self.process = None
+        self.scheduler = None
+        self.stderr = collections.deque(maxlen=self._stderr_lines)
 
-    def _do_run(self):
+    def _command(self):
         args = []
         # run in lower priority
         if is_linux_or_mac():
             args.extend(['nice'])
-        # overwrite without confirm
-        args.extend(['ffmpeg', '-y'])
+        # overwrite without confirm, report progress on stdout
+        args.extend([self._ffmpeg, '-y', '-nostdin', '-nostats', '-progress', 'pipe:1'])
         if self.input_file is not None:
             args.extend(['-i', self.input_file])
-
         if self.args is not None:
-            try:
-                args.extend(self.args)
-            except:
-                pass
-
+            args.extend(self.args)
         if self.output_file is not None:
             args.append(self.output_file)
+        return args
+
+    @property
+    def out_time(self):
+        '''Seconds of output written so far
+        '''
+        try:
+            return int(self.progress_info.get('out_time_us', 0)) / 1000000
+        except ValueError:
+            return 0
+
+    async def run(self, scheduler=None):
+        self.scheduler = scheduler if scheduler is not None else get_scheduler()
+        return await self.scheduler.run(self)
+
+    def promote(self, priority):
+        '''Raise the priority of the job, which moves it up while it waits
+        for the scheduler
+        '''
+        if priority >= self.priority:
+            return
+        self.priority = priority
+        if self.scheduler is not None:
+            self.scheduler.promote(self, priority)
+
+    async def _read_progress(self, stream):
+        info = {}
+        while True:
+            line = await stream.readline()
+            if len(line) == 0:
+                break
+            key, sep, value = line.decode('utf-8', errors='replace').strip().partition('=')
+            if len(sep) == 0:
+                continue
+            info[key] = value
+            # every report ends with progress=continue or progress=end
+            if key == 'progress':
+                self.progress_info = info
+                info = {}
+                if self.progress is not None:
+                    try:
+                        self.progress(self)
+                    except:
+                        logger.exception('ffmpeg progress callback failed')
+
+    async def _read_stderr(self, stream):
+        while True:
+            line = await stream.readline()
+            if len(line) == 0:
+                break
+            self.stderr.append(line.decode('utf-8', errors='replace').rstrip())
 
-        subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        logger.info('ffmpeg running finished')
+    async def _communicate(self):
+        await asyncio.gather(self._read_progress(self.process.stdout),
+                             self._read_stderr(self.process.stderr))
+        return await self.process.wait()
 
-    def _call_after(self):
-        if self.after is not None:
-            self.after()
+    def stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
 
-    def run(self):
+    async def _execute(self):
+        command = self._command()
+        logger.info('ffmpeg started: %s' % ' '.join(command))
+        self.process = await asyncio.create_subprocess_exec(
+            *command, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
         try:
-            self._do_run()
-        except Exception as e:
-            logger.exception('ffmpeg runner failed')
-            self.error = e
+            self.returncode = await asyncio.wait_for(self._communicate(), self.timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            logger.warning('ffmpeg killed for %s' % self.output_file)
             self.stop()
-        finally:
-            self._call_after()
+            await self.process.wait()
+            self.returncode = self.process.returncode
+            raise
+        if self.returncode != 0:
+            logger.error('ffmpeg failed with %d for %s:\n%s' %
+                         (self.returncode, self.output_file, '\n'.join(self.stderr)))
+        else:
+            logger.info('ffmpeg running finished')
+        await self._finish()
+        return self.returncode
+
+    async def _finish(self):
+        '''Called once ffmpeg exited, with returncode set
+        '''
+        pass
+
+
+def concat_input_args(input_files, concat_file):
+    '''ffmpeg input arguments reading input_files one after another
+
+    More than one file goes through the concat demuxer with a list written
+    to concat_file, which has to be in the same directory as the inputs.
+    '''
+    if len(input_files) == 1:
+        return ['-i', input_files[0]]
+    with open(concat_file, 'w') as f:
+        for input_file in input_files:
+            f.write("file '%s'\n" % path.basename(input_file))
+    return ['-f', 'concat', '-safe', '0', '-i', concat_file]
 
 
 class Flv2Mp3(FFMpegRunner):
     _ext = '.mp3'
 
-    def __init__(self, input_file, after=None):
+    def __init__(self, input_file, **kwargs):
         filename, file_extension = path.splitext(input_file)
         self.output_file = filename + self._ext
-        super().__init__(input_file, self.output_file, after=after)
+        super().__init__(input_file, self.output_file, **kwargs)
 
 
 class Mp3AddMeta(FFMpegRunner):
@@ -68,7 +207,7 @@ class Mp3AddMeta(FFMpegRunner):
     # album, composer, genre, copyright, encoded_by, title, language, artist, album_artist, performer
     # disc, publisher, tracker, encoder, lyrics
 
-    def __init__(self, input_file, meta_dict, art_file, after=None):
+    def __init__(self, input_file, meta_dict, art_file, **kwargs):
         filename, file_extension = path.splitext(input_file)
         output_file = filename + self._new_suffix
         # use args store all parameters
@@ -83,18 +222,91 @@ class Mp3AddMeta(FFMpegRunner):
         for k, v in meta_dict.items():
             args.extend(['-metadata', k + '=' + v])
 
-        super().__init__(None, output_file, args, after=after)
+        super().__init__(None, output_file, args, **kwargs)
 
 
 class Flv2M4a(FFMpegRunner):
     _ext = '.m4a'
 
-    def __init__(self, input_file, after=None):
+    def __init__(self, input_file, **kwargs):
         filename, file_extension = path.splitext(input_file)
         self.output_file = filename + self._ext
         args = []
         args.extend(['-vn', '-acodec', 'copy'])
-        super().__init__(input_file, self.output_file, args, after=after)
+        super().__init__(input_file, self.output_file, args, **kwargs)
+
+
+class Flv2Opus(FFMpegRunner):
+    '''Transcode the segments of a video into one Ogg/Opus file
+
+    The output is 48kHz stereo with 20ms frames, which is what the discord
+    voice client sends, so the packets can be played without re-encoding.
+    The file only appears under its final name once ffmpeg succeeded.
+    '''
+    _concat_file = 'opus_concat.txt'
+    _tmp_suffix = '.tmp'
+
+    def __init__(self, input_files, output_file, *, bitrate='96k', **kwargs):
+        self.final_file = output_file
+        args = concat_input_args(input_files, path.join(path.dirname(output_file), self._concat_file))
+        args.extend(['-vn', '-ac', '2', '-ar', '48000', '-c:a', 'libopus',
+                     '-b:a', bitrate, '-frame_duration', '20', '-application', 'audio',
+                     '-f', 'ogg'])
+        super().__init__(None, output_file + self._tmp_suffix, args, **kwargs)
+
+    async def _finish(self):
+        if self.returncode == 0:
+            os.replace(self.output_file, self.final_file)
+            self.output_file = self.final_file
+        else:
+            logger.error('opus transcode failed for %s' % self.final_file)
+
+
+class ExtractAudio(FFMpegRunner):
+    '''Copy the AAC stream of a segment into an ADTS file
+
+    ADTS frames carry their own headers, so the files of all segments can
+    be joined without re-encoding.
+    '''
+    _ext = '.aac'
+
+    def __init__(self, input_file, **kwargs):
+        filename, file_extension = path.splitext(input_file)
+        self.output_file = filename + self._ext
+        args = ['-vn', '-acodec', 'copy', '-f', 'adts']
+        super().__init__(input_file, self.output_file, args, **kwargs)
+
+
+class M4aMux(FFMpegRunner):
+    '''Join audio files into one m4a with metadata and cover art
+
+    Concatenation, tags and the attached picture are written in a single
+    pass without re-encoding. The file only appears under its final name
+    once ffmpeg succeeded.
+    '''
+    _concat_file = 'audio_concat.txt'
+    _tmp_suffix = '.tmp'
+
+    def __init__(self, input_files, output_file, meta_dict, art_file=None, **kwargs):
+        self.final_file = output_file
+        args = concat_input_args(input_files, path.join(path.dirname(output_file), self._concat_file))
+        if art_file is not None:
+            args.extend(['-i', art_file, '-map', '0:a', '-map', '1:v',
+                         '-disposition:v:0', 'attached_pic'])
+        else:
+            args.extend(['-map', '0:a'])
+        args.extend(['-c', 'copy', '-bsf:a', 'aac_adtstoasc'])
+        for k, v in meta_dict.items():
+            args.extend(['-metadata', k + '=' + v])
+        args.extend(['-f', 'mp4'])
+        super().__init__(None, output_file + self._tmp_suffix, args, **kwargs)
+
+    async def _finish(self):
+        if self.returncode == 0:
+            os.replace(self.output_file, self.final_file)
+            self.output_file = self.final_file
+        else:
+            logger.error('m4a mux failed for %s' % self.final_file)
 
 
 class M4aAddMeta(FFMpegRunner):
@@ -105,7 +317,7 @@ class M4aAddMeta(FFMpegRunner):
     # disc, publisher, tracker, encoder, lyrics
     # atomicparsley 1.m4a --artwork cropped.png --overWrite
 
-    def __init__(self, input_file, meta_dict, art_file, after=None):
+    def __init__(self, input_file, meta_dict, art_file, **kwargs):
         self.art_file = art_file
         filename, file_extension = path.splitext(input_file)
         output_file = filename + self._new_suffix
@@ -117,14 +329,17 @@ class M4aAddMeta(FFMpegRunner):
         for k, v in meta_dict.items():
             args.extend(['-metadata', k + '=' + v])
 
-        super().__init__(input_file, output_file, args, after=after)
+        super().__init__(input_file, output_file, args, **kwargs)
 
-    def _do_run(self):
-        super()._do_run()
+    async def _finish(self):
+        if self.returncode != 0:
+            return
         # set art file
         args = []
         if is_linux_or_mac():
             args.extend(['nice'])
-        args = ['AtomicParsley', self.output_file]
+        args.extend(['AtomicParsley', self.output_file])
         args.extend(['--artwork', self.art_file, '--overWrite'])
-        subprocess.run(args)
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await process.wait()
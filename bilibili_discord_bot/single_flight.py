@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    '''Registry of the work in progress per key, such as
+    ('download', aid, page, klass)
+
+    do() runs a coroutine once for all concurrent callers with the same key.
+    '''
+
+    def __init__(self):
+        self._flights = {}
+        self._waiters = {}
+
+    def get(self, key):
+        '''The future of the work in progress for key, or None
+        '''
+        return self._flights.get(key)
+
+    def _remove(self, key, future):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+
+    async def do(self, key, func, *args, **kwargs):
+        '''Await func(*args, **kwargs), or the call already running for key
+
+        The shared call is shielded, one caller giving up does not cancel it
+        for the others. Once the last caller gives up the call is cancelled,
+        a prefetch that is no longer wanted stops downloading.
+        '''
+        future = self._flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._flights[key] = future
+            future.add_done_callback(lambda f: self._remove(key, f))
+        else:
+            logger.info('joining work in progress for %s' % str(key))
+        self._waiters[future] = self._waiters.get(future, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self._waiters[future] -= 1
+            if self._waiters[future] == 0:
+                del self._waiters[future]
+                if not future.done():
+                    logger.info('cancelling work in progress for %s' % str(key))
+                    # the next caller starts over instead of joining the cancel
+                    self._remove(key, future)
+                    future.cancel()
+
+    async def cancel(self, key):
+        '''Cancel the call running for key and wait until it stopped
+
+        Its callers get a CancelledError. Until it stopped new callers join
+        the cancelled call instead of starting another one beside it.
+        '''
+        future = self._flights.get(key)
+        if future is None:
+            return
+        logger.info('cancelling work in progress for %s' % str(key))
+        future.cancel()
+        await asyncio.wait([future])
+
+    def keys(self):
+        return list(self._flights.keys())
+
+    def __len__(self):
+        return len(self._flights)
+
+
+# process wide registry used when none is given
+default_flights = SingleFlight()
@@ -0,0 +1,100 @@
+import asyncio
+import unittest
+from os import path
+import aiohttp
+from aiohttp import web
+from bilibili_discord_bot.bilibili_api import VideoPlayUrlDash, set_dash_api_url
+from bilibili_discord_bot.bilibili_data import VideoSegmentInfo, segments_to_json
+from bilibili_discord_bot.quality import QN_AUDIO, QN_480P
+
+_fixture = path.join(path.dirname(__file__), 'data', 'playurl_dash.json')
+_size = 3437312
+
+
+class FakeApi:
+    '''The DASH playurl api answering with the saved response, whose
+    stream urls point back at this server
+    '''
+
+    def __init__(self, found=True):
+        self.found = found
+        self.params = None
+        self.runner = None
+        self.base = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/x/player/playurl', self.playurl)
+        app.router.add_get('/upgcxcode/{name}', self.stream)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.base = 'http://127.0.0.1:%d' % self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def playurl(self, request):
+        self.params = dict(request.query)
+        if not self.found:
+            return web.json_response({'code': -404, 'message': 'not found', 'ttl': 1})
+        with open(_fixture, encoding='utf-8') as f:
+            text = f.read().replace('{cdn}', self.base)
+        return web.Response(text=text, content_type='application/json')
+
+    async def stream(self, request):
+        # the size is read from the answer to a request for the first byte
+        return web.Response(status=206, body=b'\0', headers={'Content-Range': 'bytes 0-0/%d' % _size})
+
+
+class DashTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(set_dash_api_url)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _get_data(self, api):
+        async def get_data():
+            await api.start()
+            set_dash_api_url(api.base + '/x/player/playurl')
+            try:
+                async with aiohttp.ClientSession() as session:
+                    player = VideoPlayUrlDash('https://www.bilibili.com/video/av170001', 170001, 279786, QN_480P)
+                    return await player.get_data(session)
+            finally:
+                await api.stop()
+        return self.loop.run_until_complete(get_data())
+
+    def test_durl(self):
+        api = FakeApi()
+        data = self._get_data(api)
+        self.assertEqual(api.params['fnval'], '16')
+        self.assertEqual(api.params['avid'], '170001')
+        self.assertEqual(data['quality'], QN_AUDIO)
+        self.assertEqual(data['format'], 'm4a')
+        self.assertEqual(data['timelength'], 213461)
+        self.assertEqual(len(data['durl']), 1)
+        durl = data['durl'][0]
+        # the audio stream with the highest bandwidth
+        self.assertEqual(durl['url'], api.base + '/upgcxcode/30280.m4s?deadline=1600000000')
+        self.assertEqual(durl['backup_url'], [api.base + '/backup/30280.m4s', api.base + '/backup2/30280.m4s'])
+        self.assertEqual(durl['size'], _size)
+        self.assertEqual(durl['length'], 213461)
+
+        segment = VideoSegmentInfo(durl, data['format'], data['quality'])
+        self.assertEqual(segment.file_name, '1.m4a')
+        self.assertEqual(segment.qn, QN_AUDIO)
+        restored = VideoSegmentInfo.from_json(segments_to_json([segment]))[0]
+        self.assertEqual((restored.url, restored.size, restored.format), (segment.url, _size, 'm4a'))
+
+    def test_no_audio(self):
+        self.assertIsNone(self._get_data(FakeApi(found=False)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from os import path
+from unittest import mock
+from bilibili_discord_bot.simple_ffmpeg import FFMpegRunner, FFMpegScheduler, PLAYBACK, INTERACTIVE, BACKGROUND
+
+# stands in for ffmpeg: logs when it starts and ends, reports progress and
+# exits with the code in the name of its output file
+_stub = '''#!%s
+import sys, time
+output = sys.argv[-1]
+with open(%r, 'a') as log:
+    log.write('start %%s\\n' %% output)
+time.sleep(0.1)
+print('out_time_us=2500000')
+print('progress=end')
+with open(%r, 'a') as log:
+    log.write('end %%s\\n' %% output)
+sys.exit(1 if output.startswith('fail') else 0)
+'''
+
+
+class FFMpegSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.path = tempfile.mkdtemp()
+        self.log = path.join(self.path, 'log')
+        stub = path.join(self.path, 'ffmpeg')
+        with open(stub, 'w') as f:
+            f.write(_stub % (sys.executable, self.log, self.log))
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR)
+        patcher = mock.patch.object(FFMpegRunner, '_ffmpeg', stub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.path)
+
+    def _events(self):
+        with open(self.log) as f:
+            return [line.split() for line in f.read().splitlines()]
+
+    def _run(self, scheduler, jobs):
+        '''Start every (name, priority) job in order, return their runners
+        once all have finished
+        '''
+        async def run():
+            runners = [FFMpegRunner(output_file=name, priority=priority) for name, priority in jobs]
+            tasks = []
+            for runner in runners:
+                tasks.append(self.loop.create_task(runner.run(scheduler)))
+                # let the job reach the scheduler before the next one
+                await asyncio.sleep(0)
+            await asyncio.gather(*tasks)
+            return runners
+        return self.loop.run_until_complete(run())
+
+    def test_priority_order(self):
+        scheduler = FFMpegScheduler(max_jobs=1)
+        runners = self._run(scheduler, [('first', BACKGROUND), ('bulk', BACKGROUND), ('export1', INTERACTIVE),
+                                        ('play', PLAYBACK), ('export2', INTERACTIVE)])
+        started = [name for event, name in self._events() if event == 'start']
+        # the first job took the free slot, the waiting ones go by priority then in order
+        self.assertEqual(started, ['first', 'play', 'export1', 'export2', 'bulk'])
+        self.assertEqual([runner.returncode for runner in runners], [0] * 5)
+        self.assertEqual(runners[0].out_time, 2.5)
+        self.assertEqual((scheduler.running, scheduler.depth, scheduler.finished), (0, 0, 5))
+
+    def test_max_jobs(self):
+        scheduler = FFMpegScheduler(max_jobs=2)
+        self._run(scheduler, [('job%d' % i, INTERACTIVE) for i in range(5)])
+        running = 0
+        most = 0
+        for event, name in self._events():
+            running += 1 if event == 'start' else -1
+            most = max(most, running)
+        self.assertEqual(most, 2)
+        self.assertEqual(scheduler.max_depth, 3)
+
+    def test_failure_releases_slot(self):
+        scheduler = FFMpegScheduler(max_jobs=1)
+        runners = self._run(scheduler, [('fail', INTERACTIVE), ('next', INTERACTIVE)])
+        self.assertEqual([runner.returncode for runner in runners], [1, 0])
+        self.assertEqual(scheduler.running, 0)
+
+    def test_cancel_waiting_job(self):
+        scheduler = FFMpegScheduler(max_jobs=1)
+
+        async def run():
+            first = self.loop.create_task(FFMpegRunner(output_file='first').run(scheduler))
+            await asyncio.sleep(0)
+            waiting = self.loop.create_task(FFMpegRunner(output_file='cancelled').run(scheduler))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            await asyncio.gather(first, waiting, return_exceptions=True)
+            return await FFMpegRunner(output_file='last').run(scheduler)
+        self.assertEqual(self.loop.run_until_complete(run()), 0)
+        started = [name for event, name in self._events() if event == 'start']
+        self.assertEqual(started, ['first', 'last'])
+        self.assertEqual(scheduler.running, 0)
+
+    def test_promote_waiting_job(self):
+        scheduler = FFMpegScheduler(max_jobs=1)
+
+        async def run():
+            runners = [FFMpegRunner(output_file=name, priority=priority)
+                       for name, priority in [('first', BACKGROUND), ('export', INTERACTIVE),
+                                              ('prefetched', BACKGROUND)]]
+            tasks = []
+            for runner in runners:
+                tasks.append(self.loop.create_task(runner.run(scheduler)))
+                await asyncio.sleep(0)
+            runners[2].promote(PLAYBACK)
+            # the promoted job is counted once while it waits
+            depth = scheduler.depth
+            await asyncio.gather(*tasks)
+            return depth
+        self.assertEqual(self.loop.run_until_complete(run()), 2)
+        started = [name for event, name in self._events() if event == 'start']
+        self.assertEqual(started, ['first', 'prefetched', 'export'])
+        self.assertEqual(scheduler.running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
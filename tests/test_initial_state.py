@@ -0,0 +1,47 @@
+import json
+import unittest
+from bilibili_discord_bot.bilibili_api import InitialStateExtractor, extract_initial_state, parse_initial_state
+
+_state = {
+    'aid': 170001,
+    'videoData': {
+        'title': '【测试】{braces} in "quotes" \\ and a backslash',
+        'desc': 'line one\nline two }}}',
+        'pages': [{'page': 1, 'cid': 279786, 'part': 'P1 ✨'}, {'page': 2, 'cid': 279787, 'part': ''}],
+    },
+    'empty': {},
+}
+
+_page = ('<html><head><title>test</title>'
+         '<script>var x = "{ not the state }";</script>'
+         '<script>window.__INITIAL_STATE__=' + json.dumps(_state, ensure_ascii=False) +
+         ';(function(){var s;(s=document.currentScript||document.scripts[document.scripts.length-1])'
+         '.parentNode.removeChild(s);}());</script>'
+         '</head><body>' + 'x' * 10000 + '</body></html>')
+
+
+class InitialStateTest(unittest.TestCase):
+    def test_matches_parser(self):
+        expected = parse_initial_state(_page)
+        self.assertEqual(expected, _state)
+        html = _page.encode('utf-8')
+        # small sizes split the marker, multi byte characters and escapes
+        for block_size in (1, 2, 3, 7, 25, 64, 1000, 32 * 4096):
+            with self.subTest(block_size=block_size):
+                self.assertEqual(extract_initial_state(html, block_size), expected)
+
+    def test_stops_after_the_state(self):
+        extractor = InitialStateExtractor()
+        html = _page.encode('utf-8')
+        end = html.index(b';(function()')
+        self.assertFalse(extractor.feed(html[:end - 1]))
+        self.assertTrue(extractor.feed(html[end - 1:end]))
+        self.assertEqual(extractor.get_data(), _state)
+
+    def test_missing_state(self):
+        html = '<html><script>var a = {"b": 1};</script></html>'.encode('utf-8')
+        self.assertIsNone(extract_initial_state(html, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
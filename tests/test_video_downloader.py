@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+from unittest import mock
+import aiohttp
+from aiohttp import web
+from bilibili_discord_bot.bilibili_api import CdnReader, VideoDownloader
+from bilibili_discord_bot.bilibili_data import VideoSegmentInfo
+
+_size = 1024 * 1024 + 123
+_chunk_size = 256 * 1024
+
+
+class FakeCdn:
+    '''CDN serving one payload on /v.flv, ignoring the Range header on
+    /norange.flv and answering 403 on /forbidden.flv
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        # (path, first byte) of every request
+        self.requests = []
+        self.runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/v.flv', self.ranged)
+        app.router.add_get('/norange.flv', self.whole)
+        app.router.add_get('/forbidden.flv', self.forbidden)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.port, name)
+
+    def _range(self, request):
+        value = request.headers.get('Range')
+        if value is None or not value.startswith('bytes='):
+            return 0, len(self.data) - 1
+        start, end = value[len('bytes='):].split('-')
+        return int(start), int(end) if len(end) > 0 else len(self.data) - 1
+
+    async def ranged(self, request):
+        start, end = self._range(request)
+        self.requests.append(('v.flv', start))
+        headers = {'Content-Range': 'bytes %d-%d/%d' % (start, end, len(self.data))}
+        return web.Response(status=206, body=self.data[start:end + 1], headers=headers)
+
+    async def whole(self, request):
+        self.requests.append(('norange.flv', 0))
+        return web.Response(body=self.data)
+
+    async def forbidden(self, request):
+        self.requests.append(('forbidden.flv', 0))
+        return web.Response(status=403, text='forbidden')
+
+
+class VideoDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.data = os.urandom(_size)
+        self.cdn = FakeCdn(self.data)
+        self.session = None
+        self.loop.run_until_complete(self._start())
+        self.path = tempfile.mkdtemp()
+        # retry at once instead of backing off
+        patcher = mock.patch.object(CdnReader, '_backoff_base', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def _start(self):
+        await self.cdn.start()
+        self.session = aiohttp.ClientSession()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.session.close())
+        self.loop.run_until_complete(self.cdn.stop())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.path)
+
+    def _segments(self, name, count=2, backup=()):
+        return [VideoSegmentInfo({'url': self.cdn.url(name), 'backup_url': [self.cdn.url(b) for b in backup],
+                                  'length': 1000, 'size': len(self.data), 'order': order}, 'flv')
+                for order in range(1, count + 1)]
+
+    def _download(self, segments, concurrent):
+        downloader = VideoDownloader('https://www.bilibili.com/video/av1', self.session, segments,
+                                     concurrent=concurrent, chunk_size=_chunk_size, loop=self.loop)
+        return self.loop.run_until_complete(downloader.download(self.path))
+
+    def _assert_downloaded(self, segments):
+        for segment in segments:
+            with open(path.join(self.path, segment.file_name), 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+
+    def test_concurrent(self):
+        segments = self._segments('v.flv')
+        self._download(segments, True)
+        self._assert_downloaded(segments)
+        # every segment is fetched in chunk sized ranges
+        chunks = -(-_size // _chunk_size)
+        self.assertEqual(len(self.cdn.requests), 2 * chunks)
+
+    def test_single(self):
+        segments = self._segments('v.flv')
+        self._download(segments, False)
+        self._assert_downloaded(segments)
+        self.assertEqual(self.cdn.requests, [('v.flv', 0), ('v.flv', 0)])
+
+    def test_range_ignored(self):
+        segments = self._segments('norange.flv', count=1)
+        self._download(segments, True)
+        self._assert_downloaded(segments)
+        # the probe finds out, then one request downloads the whole segment
+        self.assertEqual(len(self.cdn.requests), 2)
+
+    def test_forbidden_fails_over(self):
+        segments = self._segments('forbidden.flv', count=1, backup=['v.flv'])
+        self._download(segments, False)
+        self._assert_downloaded(segments)
+        self.assertEqual(self.cdn.requests, [('forbidden.flv', 0), ('v.flv', 0)])
+
+    def _write_partial(self, segment, ranges):
+        file_name = path.join(self.path, segment.file_name)
+        with open(file_name, 'wb') as f:
+            f.truncate(len(self.data))
+            for start, end in ranges:
+                f.seek(start)
+                f.write(self.data[start:end])
+        with open(file_name + '.journal', 'w') as f:
+            json.dump({'size': len(self.data), 'ranges': ranges}, f)
+
+    def test_resume_single(self):
+        segments = self._segments('v.flv', count=1)
+        half = len(self.data) // 2
+        self._write_partial(segments[0], [[0, half]])
+        self._download(segments, False)
+        self._assert_downloaded(segments)
+        self.assertEqual(self.cdn.requests, [('v.flv', half)])
+
+    def test_resume_concurrent(self):
+        segments = self._segments('v.flv', count=1)
+        # only the hole between the journaled ranges is downloaded
+        start, end = _chunk_size, 2 * _chunk_size
+        self._write_partial(segments[0], [[0, start], [end, len(self.data)]])
+        self._download(segments, True)
+        self._assert_downloaded(segments)
+        self.assertEqual(self.cdn.requests, [('v.flv', start)])
+
+
+if __name__ == '__main__':
+    unittest.main()